@@ -4,18 +4,23 @@ import pickle
 import json
 import click
 from datagen.loadmatlab import mat_to_spectra
+from datagen.dataset_view import DatasetView, create_view
 
 
 """
-This is a 'quick and dirty' script to split a sharded dataset into a subset
+This is a 'quick and dirty' script to split a sharded dataset into a subset.
+By default "crop" and "reclass" create a dataset view, which only stores the selected record indices and label map
+and reads the spectra from the base dataset. Use --materialize to write a full copy instead.
 """
 
 @click.command()
 @click.option('--set-name', prompt='Name of dataset to crop from')
 @click.option('--new-set-name', prompt='Name of where to save new dataset')
-@click.option('--shard-size', type=int, prompt='How many spectra to put in each shard')
+@click.option('--shard-size', type=int, default=1000, prompt='How many spectra to put in each shard')
 @click.option('--action', type=str, prompt='"crop" or "reclass" or "convert"')
-def main(set_name, new_set_name, shard_size, action):
+@click.option('--view/--materialize', 'as_view', default=True,
+              help='create a view of the dataset for "crop" and "reclass" (default) or write a full copy')
+def main(set_name, new_set_name, shard_size, action, as_view):
     dataset_path = os.path.join(DATA_DIR, set_name)
     new_dataset_path = os.path.join(DATA_DIR, new_set_name)
 
@@ -23,13 +28,24 @@ def main(set_name, new_set_name, shard_size, action):
     class_groups = {1: [1, 2],
                     2: [3, 4]}
 
+    if action in ('crop', 'reclass') and not as_view and DatasetView.is_view(set_name):
+        print(f"{set_name} is a dataset view, it can only be cropped or reclassed into another view.")
+        return
+
     if action == 'crop':
         print("Saving classes:", save_classes)
-        crop_dataset(dataset_path=dataset_path, save_classes=save_classes, new_dataset_path=new_dataset_path, shard_size=shard_size)
+        if as_view:
+            crop_view(set_name=set_name, save_classes=save_classes, new_set_name=new_set_name)
+        else:
+            crop_dataset(dataset_path=dataset_path, save_classes=save_classes, new_dataset_path=new_dataset_path,
+                         shard_size=shard_size)
     if action == 'reclass':
         print("Saving groups:", class_groups)
-        reclass_dataset(dataset_path=dataset_path, class_groups=class_groups, new_dataset_path=new_dataset_path,
-                        shard_size=shard_size)
+        if as_view:
+            reclass_view(set_name=set_name, class_groups=class_groups, new_set_name=new_set_name)
+        else:
+            reclass_dataset(dataset_path=dataset_path, class_groups=class_groups, new_dataset_path=new_dataset_path,
+                            shard_size=shard_size)
     if action == 'convert':
         print("Converting matlab files")
         matlab_path = os.path.join(DATA_ROOT, "matlab", set_name)
@@ -75,6 +91,35 @@ def convert_matlab_collection(matlab_collection_path, new_dataset_path, shard_si
 
 
 
+def crop_view(set_name, save_classes, new_set_name):
+    """
+    Same as `crop_dataset`, as a view of the dataset.
+
+    :param set_name: name of the dataset (or view) to crop
+    :param save_classes: list of classes to keep
+    :param new_set_name: name of the view
+    :return: DatasetView
+    """
+    view = create_view(base=set_name, name=new_set_name, select_labels=save_classes)
+    print(f"Created view {new_set_name} of {set_name} with {sum(map(len, view.indices.values()))} spectra.")
+    return view
+
+
+def reclass_view(set_name, class_groups, new_set_name):
+    """
+    Same as `reclass_dataset`, as a view of the dataset.
+
+    :param set_name: name of the dataset (or view) to reclass
+    :param class_groups: dict: {<new_class>: [<old_class>, <old_class>], ...}
+    :param new_set_name: name of the view
+    :return: DatasetView
+    """
+    label_map = {old_class: new_class for new_class, old_classes in class_groups.items() for old_class in old_classes}
+    view = create_view(base=set_name, name=new_set_name, select_labels=list(label_map), label_map=label_map)
+    print(f"Created view {new_set_name} of {set_name} with {sum(map(len, view.indices.values()))} spectra.")
+    return view
+
+
 def reclass_dataset(dataset_path, class_groups, new_dataset_path, shard_size):
     """
     Transform the classes in a dataset.
@@ -0,0 +1,237 @@
+from utils import *
+from datagen.spectra_loader import SpectraLoader, NUM_WORKERS
+from datagen.label_index import LabelIndex
+import json
+import numpy as np
+
+
+VIEW_CONFIG = "view.json"
+VIEW_INDICES = "view_indices.npz"
+VIEW_SUBSETS = (TRAIN_DATASET_PREFIX, TEST_DATASET_PREFIX)
+
+
+class DatasetView:
+    """
+    A dataset defined as a selection of the records of another dataset (its base), with optional label remapping and
+    channel subset, instead of a materialized copy.
+
+    A view is stored in its own dataset directory as `view.json` (base, label map and channels), `view_indices.npz`
+    (the selected records of every subset) and a derived `gen_info.json`, so it can be used wherever a dataset name is
+    expected. Record indices refer to the global record numbering of the base's `LabelIndex`. The base may itself be
+    a view: views are resolved lazily, down to the dataset that stores the shards, when they are loaded.
+    """
+
+    def __init__(self, name, base, indices, label_map=None, channels=None, split=None):
+        """
+        :param name: str Name of the view.
+        :param base: str Name of the dataset (or view) the view selects records from.
+        :param indices: dict {subset prefix: np.array global record indices in the base}
+        :param label_map: dict (optional) {base label: view label}, labels missing from the map are kept.
+        :param channels: list (optional) Channels of the base kept by the view, in order.
+        :param split: dict (optional) Description of the split the view is a part of, see `datagen.splits`.
+        """
+        self.name = name
+        self.base = base
+        self.indices = {subset: np.unique(np.asarray(subset_indices, dtype=np.int64))
+                        for subset, subset_indices in indices.items()}
+        self.label_map = None if label_map is None else {int(k): int(v) for k, v in label_map.items()}
+        self.channels = None if channels is None else [int(c) for c in channels]
+        self.split = split
+
+    def __repr__(self):
+        return f"view of {self.base}"
+
+    @staticmethod
+    def is_view(dataset_name):
+        return os.path.exists(os.path.join(SpectraLoader.get_dataset_path(dataset_name), VIEW_CONFIG))
+
+    @staticmethod
+    def load(name):
+        """
+        :param name: str Name of the view.
+        :return: DatasetView
+        """
+        view_path = SpectraLoader.get_dataset_path(name)
+        config = json.load(open(os.path.join(view_path, VIEW_CONFIG), "r"))
+        stored = np.load(os.path.join(view_path, VIEW_INDICES))
+        return DatasetView(name, config['base'], {subset: stored[subset] for subset in stored.files},
+                           label_map=config.get('label_map'), channels=config.get('channels'),
+                           split=config.get('split'))
+
+    def save(self):
+        """
+        Write the view, and the dataset config derived from its base, to the view's dataset directory.
+
+        :return: path of the view directory
+        """
+        view_path = SpectraLoader.get_dataset_path(self.name)
+        try_create_directory(view_path, silent=True)
+
+        config = {'base': self.base,
+                  'label_map': None if self.label_map is None else {str(k): v for k, v in self.label_map.items()},
+                  'channels': self.channels,
+                  'split': self.split}
+        json.dump(config, open(os.path.join(view_path, VIEW_CONFIG), "w"), indent=4)
+        np.savez(os.path.join(view_path, VIEW_INDICES), **self.indices)
+        json.dump(self.get_dataset_config(), open(os.path.join(view_path, DATAGEN_CONFIG), "w"))
+        return view_path
+
+    def get_dataset_config(self):
+        """
+        :return: dict config of the base dataset, updated for the records, labels and channels of the view
+        """
+        gen_info = SpectraLoader.read_dataset_config(self.base)
+        base_index = get_label_index(self.base)
+        gen_info['num_instances'] = int(sum(len(subset_indices) for subset_indices in self.indices.values()))
+        if self.label_map is not None:
+            labels = np.concatenate([base_index.labels[subset_indices] for subset_indices in self.indices.values()])
+            gen_info['n_max'] = int(max(self.map_label(label) for label in np.unique(labels)))
+        if self.channels is not None:
+            gen_info['num_channels'] = len(self.channels)
+        gen_info['view_of'] = self.base
+        return gen_info
+
+    def map_label(self, label):
+        if self.label_map is None:
+            return int(label)
+        return self.label_map.get(int(label), int(label))
+
+    def resolve(self):
+        """
+        Compose the view with its base views, if any.
+
+        :return: DatasetView whose base stores the shards
+        """
+        if not DatasetView.is_view(self.base):
+            return self
+
+        parent = DatasetView.load(self.base).resolve()
+        # Global record numbering of the parent view: its training records, then its test records
+        parent_records = np.concatenate([parent.indices.get(subset, np.array([], dtype=np.int64))
+                                         for subset in VIEW_SUBSETS])
+        indices = {subset: parent_records[subset_indices] for subset, subset_indices in self.indices.items()}
+
+        label_map = None
+        if parent.label_map is not None or self.label_map is not None:
+            root_labels = np.unique(get_label_index(parent.base).labels)
+            label_map = {int(label): self.map_label(parent.map_label(label)) for label in root_labels}
+
+        channels = self.channels
+        if parent.channels is not None:
+            channels = parent.channels if channels is None else [parent.channels[c] for c in channels]
+
+        return DatasetView(self.name, parent.base, indices, label_map=label_map, channels=channels, split=self.split)
+
+    def get_selection(self, subset_prefix):
+        """
+        Locate the records of a subset of a resolved view in the shards of its base.
+
+        :param subset_prefix: str
+        :return: list of (shard file name, offsets in the shard), in record order
+        """
+        base_index = LabelIndex.load(self.base)
+        shard_ids, offsets = base_index.locate(self.indices.get(subset_prefix, np.array([], dtype=np.int64)))
+        return [(base_index.files[shard_id], offsets[shard_ids == shard_id]) for shard_id in np.unique(shard_ids)]
+
+    def get_label_index(self):
+        """
+        Label index of a resolved view. Every shard of the index is a shard of the base restricted to the records of
+        one subset of the view, so loading it with a `ViewSpectraLoader` of that subset yields exactly its records.
+
+        :return: LabelIndex
+        """
+        base_index = LabelIndex.load(self.base)
+        files, shard_sizes, labels, subsets = [], [], [], []
+        for subset in VIEW_SUBSETS:
+            for file, offsets in self.get_selection(subset):
+                shard_id = base_index.files.index(file)
+                files.append(file)
+                shard_sizes.append(len(offsets))
+                labels.extend(self.map_label(label) for label in base_index.labels[base_index.offsets[shard_id] + offsets])
+                subsets.append(subset)
+        return LabelIndex(self.name, files, shard_sizes, labels, subsets=subsets, source_name=self.base)
+
+    def apply(self, spectrum_json):
+        """
+        :param spectrum_json: dict record of the base dataset
+        :return: dict record as seen through the view
+        """
+        spectrum_json = dict(spectrum_json)
+        spectrum_json['n'] = self.map_label(spectrum_json['n'])
+        if self.channels is not None:
+            spectrum_json['dm'] = [spectrum_json['dm'][c] for c in self.channels]
+            spectrum_json['num_channels'] = len(self.channels)
+        return spectrum_json
+
+
+class ViewSpectraLoader(SpectraLoader):
+    """
+    SpectraLoader of a dataset view. Shards are read from the dataset the view resolves to, and only the selected
+    records are kept, relabelled and restricted to the view's channels.
+    """
+
+    def __init__(self, dataset_name, subset_prefix, eval_now=True, num_workers=NUM_WORKERS):
+        self.view = DatasetView.load(dataset_name).resolve()
+        self.selection = dict(self.view.get_selection(subset_prefix))
+        super().__init__(dataset_name=dataset_name, subset_prefix=subset_prefix, eval_now=eval_now,
+                         num_workers=num_workers)
+
+    def get_data_files(self):
+        base_path = SpectraLoader.get_dataset_path(self.view.base)
+        return [os.path.join(base_path, file) for file in self.selection]
+
+    def get_shard_task(self, filepath):
+        return filepath, self.view, self.selection.get(os.path.basename(filepath), [])
+
+    def get_label_index(self):
+        if self.label_index is None:
+            self.label_index = self.view.get_label_index()
+        return self.label_index
+
+    def get_cache_token(self):
+        view_config = os.path.join(SpectraLoader.get_dataset_path(self.dataset_name), VIEW_CONFIG)
+        return f"{super().get_cache_token()}:{os.path.getmtime(view_config)}"
+
+
+def get_spectra_loader(dataset_name, subset_prefix, eval_now=True, num_workers=NUM_WORKERS):
+    """
+    :return: SpectraLoader of a dataset or view
+    """
+    if DatasetView.is_view(dataset_name):
+        return ViewSpectraLoader(dataset_name=dataset_name, subset_prefix=subset_prefix, eval_now=eval_now,
+                                 num_workers=num_workers)
+    return SpectraLoader(dataset_name=dataset_name, subset_prefix=subset_prefix, eval_now=eval_now,
+                         num_workers=num_workers)
+
+
+def get_label_index(dataset_name):
+    """
+    :return: LabelIndex of a dataset or view
+    """
+    if DatasetView.is_view(dataset_name):
+        return DatasetView.load(dataset_name).resolve().get_label_index()
+    return LabelIndex.load(dataset_name)
+
+
+def create_view(base, name, select_labels=None, label_map=None, channels=None):
+    """
+    Create and save a view of a dataset (or view), selecting records by label from its label index.
+
+    :param base: str Name of the base dataset.
+    :param name: str Name of the view.
+    :param select_labels: list (optional) Labels of the base to keep, all records are kept by default.
+    :param label_map: dict (optional) {base label: view label}
+    :param channels: list (optional) Channels of the base to keep.
+    :return: DatasetView
+    """
+    base_index = get_label_index(base)
+    indices = {}
+    for subset in VIEW_SUBSETS:
+        subset_indices = base_index.get_subset_indices(subset)
+        if select_labels is not None:
+            subset_indices = subset_indices[np.isin(base_index.labels[subset_indices], select_labels)]
+        indices[subset] = subset_indices
+
+    view = DatasetView(name, base, indices, label_map=label_map, channels=channels)
+    view.save()
+    return view
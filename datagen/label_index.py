@@ -0,0 +1,172 @@
+from utils import *
+import numpy as np
+import pickle
+import re
+
+
+LABEL_INDEX_FILENAME = "label_index.npz"
+
+
+def get_dataset_path(dataset_name):
+    return os.path.join(DATA_DIR, dataset_name)
+
+
+def collect_sharded_files(dataset_name, subset):
+    """
+    :param dataset_name: str
+    :param subset: str subset prefix, e.g. TRAIN_DATASET_PREFIX
+    :return: sorted list of paths of the shards of a subset
+    """
+    dataset_path = get_dataset_path(dataset_name)
+    files = os.listdir(dataset_path)
+    files_filtered = sorted([os.path.join(dataset_path, file)
+                             for file in files if re.match(f"{subset}_.+.{DATASET_FILE_TYPE}", file)])
+    return files_filtered
+
+
+class LabelIndex:
+    """
+    Per-record index of a dataset: the label (number of peaks) of every spectrum and the shard it is stored in.
+
+    Records are numbered globally over all shards of the dataset, training shards first and then test shards, each in
+    the order returned by `collect_sharded_files`. Building the index requires reading every shard once;
+    afterwards it is stored under `CACHE_DIR` and reused until a shard changes, so labels, class counts and record
+    locations are available without loading `dm`.
+
+    The shards of an index may be stored in another dataset (`source_name`), as is the case for dataset views.
+    """
+
+    def __init__(self, dataset_name, files, shard_sizes, labels, subsets=None, source_name=None, mtimes=None):
+        """
+        :param dataset_name: str Name of the dataset.
+        :param files: list of shard file names (without directory), in global record order.
+        :param shard_sizes: np.array Number of records in every shard.
+        :param labels: np.array Number of peaks of every record.
+        :param subsets: list (optional) Subset prefix of every shard, inferred from the file names by default.
+        :param source_name: str (optional) Dataset whose directory stores the shards, defaults to `dataset_name`.
+        :param mtimes: np.array (optional) Modification times of the shards when the index was built.
+        """
+        self.dataset_name = dataset_name
+        self.source_name = dataset_name if source_name is None else source_name
+        self.files = list(files)
+        self.shard_sizes = np.asarray(shard_sizes, dtype=np.int64)
+        self.offsets = np.concatenate(([0], np.cumsum(self.shard_sizes)))
+        self.labels = np.asarray(labels, dtype=np.int64)
+        if subsets is None:
+            subsets = [file.split("_")[0] for file in self.files]
+        self.subsets = list(subsets)
+        self.mtimes = mtimes
+
+    def __len__(self):
+        return len(self.labels)
+
+    @staticmethod
+    def get_shard_files(dataset_name):
+        """
+        :param dataset_name: str
+        :return: list of shard paths in global record order
+        """
+        return collect_sharded_files(dataset_name, TRAIN_DATASET_PREFIX) + \
+            collect_sharded_files(dataset_name, TEST_DATASET_PREFIX)
+
+    @staticmethod
+    def get_index_path(dataset_name):
+        return os.path.join(CACHE_DIR, dataset_name, LABEL_INDEX_FILENAME)
+
+    @staticmethod
+    def build(dataset_name):
+        """
+        Build the index by reading every shard of a dataset.
+
+        :param dataset_name: str
+        :return: LabelIndex
+        """
+        files = LabelIndex.get_shard_files(dataset_name)
+        shard_sizes = []
+        labels = []
+        for filepath in files:
+            print(f"Indexing {filepath}")
+            spectra_json = pickle.load(open(filepath, 'rb'))
+            shard_sizes.append(len(spectra_json))
+            labels.extend(int(spectrum['n']) for spectrum in spectra_json)
+            del spectra_json
+
+        mtimes = np.array([os.path.getmtime(filepath) for filepath in files])
+        return LabelIndex(dataset_name, [os.path.basename(filepath) for filepath in files], shard_sizes, labels,
+                          mtimes=mtimes)
+
+    @staticmethod
+    def load(dataset_name, rebuild=False):
+        """
+        Load the stored index of a dataset, (re)building it if it is missing or out of date.
+
+        :param dataset_name: str
+        :param rebuild: bool Force rebuilding the index.
+        :return: LabelIndex
+        """
+        files = LabelIndex.get_shard_files(dataset_name)
+        index_path = LabelIndex.get_index_path(dataset_name)
+
+        if not rebuild and os.path.exists(index_path):
+            stored = np.load(index_path)
+            mtimes = np.array([os.path.getmtime(filepath) for filepath in files])
+            if list(stored['files']) == [os.path.basename(filepath) for filepath in files] and \
+                    np.array_equal(stored['mtimes'], mtimes):
+                return LabelIndex(dataset_name, stored['files'], stored['shard_sizes'], stored['labels'],
+                                  mtimes=stored['mtimes'])
+
+        label_index = LabelIndex.build(dataset_name)
+        label_index.save()
+        return label_index
+
+    def save(self):
+        """
+        Store the index under `CACHE_DIR`.
+
+        :return: path of the stored index
+        """
+        index_path = LabelIndex.get_index_path(self.dataset_name)
+        try_create_directory(os.path.dirname(index_path), silent=True)
+        # Replaced at once, so processes loading the index concurrently never read a partial file
+        tmp_path = f"{index_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, files=np.array(self.files), shard_sizes=self.shard_sizes, labels=self.labels,
+                     mtimes=self.mtimes)
+        os.replace(tmp_path, index_path)
+        return index_path
+
+    def get_file(self, shard_idx):
+        """
+        :param shard_idx: int
+        :return: str path of a shard
+        """
+        return os.path.join(get_dataset_path(self.source_name), self.files[shard_idx])
+
+    def get_subset_indices(self, subset_prefix):
+        """
+        :param subset_prefix: str e.g. TRAIN_DATASET_PREFIX
+        :return: np.array global indices of the records stored in shards of a subset
+        """
+        ranges = [np.arange(self.offsets[i], self.offsets[i + 1]) for i, subset in enumerate(self.subsets)
+                  if subset == subset_prefix]
+        return np.concatenate(ranges) if ranges else np.array([], dtype=np.int64)
+
+    def locate(self, indices):
+        """
+        Find where records are stored.
+
+        :param indices: np.array global record indices
+        :return: (shard indices, offsets within the shards)
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        shard_ids = np.searchsorted(self.offsets, indices, side='right') - 1
+        return shard_ids, indices - self.offsets[shard_ids]
+
+    def get_class_counts(self, indices=None):
+        """
+        :param indices: np.array (optional) restrict the counts to these records
+        :return: dict {label: count}
+        """
+        labels = self.labels if indices is None else self.labels[indices]
+        classes, counts = np.unique(labels, return_counts=True)
+        return {int(c): int(count) for c, count in zip(classes, counts)}
@@ -121,11 +121,11 @@ def main(name, version, num_instances, shard_size, num_channels, n_max, n_max_s,
         #save_images(directory, spectra_loader, math.ceil(NUM_EXAMPLE_IMAGES/num_shards))
 
         print(f"  Splitting data...")
-        spectra_train, spectra_test = spectra_loader.spectra_train_test_splitter()
-        train_set_buffer.extend([spectrum.__dict__ for spectrum in spectra_train])
-        test_set_buffer.extend([spectrum.__dict__ for spectrum in spectra_test])
-        num_gen += len(spectra_train) + len(spectra_test)
-        print(f"    {len(spectra_train)} Train, {len(spectra_test)} Test")
+        train_idx, test_idx = spectra_loader.get_train_test_indices()
+        train_set_buffer.extend([spectra_json[i] for i in train_idx])
+        test_set_buffer.extend([spectra_json[i] for i in test_idx])
+        num_gen += len(train_idx) + len(test_idx)
+        print(f"    {len(train_idx)} Train, {len(test_idx)} Test")
 
         while len(train_set_buffer) >= shard_size or (shard_i == num_shards - 1 and len(train_set_buffer) > 0):
             print("  Saving training data...")
@@ -1,23 +1,89 @@
 from utils import *
-from datagen.spectrum import Spectrum
+from datagen.spectrum import Spectrum, LazySpectra
+from datagen.label_index import LabelIndex, collect_sharded_files, get_dataset_path
 from s3 import S3, DEFAULT_BUCKET, MAX_RETRIES
+from memory_accounting import memory_stage, SHARD_LOAD, SPECTRUM_CONSTRUCTION
+from collections import OrderedDict
 
+import multiprocessing
 import pickle
 import numpy as np
 import os
 import time
 from sklearn.model_selection import train_test_split
-import re
 import json
 import traceback
 
 
+SHARD_CACHE_SIZE = 4  # Default number of decoded shards kept in memory for random access
+NUM_WORKERS = os.cpu_count() or 1  # Default number of processes decoding shards
+
+
+def read_shard(filepath, view=None, offsets=None):
+    """
+    :param filepath: str path of a shard
+    :param view: DatasetView (optional) resolved view the records are seen through
+    :param offsets: np.array (optional) offsets of the records of the view in the shard
+    :return: list of record dicts
+    """
+    spectra_json = pickle.load(open(filepath, 'rb'))
+    if view is not None:
+        spectra_json = [view.apply(spectra_json[offset]) for offset in offsets]
+    return spectra_json
+
+
+def decode_shard(shard_task):
+    """
+    Read a shard into columns. Runs in the worker processes of `SpectraLoader.load_columns`, so only arrays are sent
+    back to the loader instead of every record object.
+
+    :param shard_task: tuple of `read_shard` arguments
+    :return: dict of columns
+    """
+    return records_to_columns(read_shard(*shard_task))
+
+
+def records_to_columns(spectra_json):
+    """
+    :param spectra_json: list of record dicts
+    :return: dict {field: values of every record}, 'n' and 'dm' are np.arrays, other fields are lists
+    """
+    if not spectra_json:
+        return {}
+    columns = {key: [spectrum_json.get(key) for spectrum_json in spectra_json] for key in spectra_json[0]}
+    columns['n'] = np.asarray(columns['n'])
+    columns['dm'] = np.asarray(columns['dm'])
+    return columns
+
+
+def concatenate_columns(columns_list):
+    """
+    :param columns_list: list of column dicts, in record order
+    :return: dict of columns
+    """
+    columns_list = [columns for columns in columns_list if columns]
+    if not columns_list:
+        return {}
+    return {key: np.concatenate([columns[key] for columns in columns_list]) if isinstance(values, np.ndarray)
+            else [value for columns in columns_list for value in columns[key]]
+            for key, values in columns_list[0].items()}
+
+
 class SpectraLoader:
-    def __init__(self, spectra_json=None, dataset_name=None, subset_prefix=None, eval_now=True):
+    def __init__(self, spectra_json=None, dataset_name=None, subset_prefix=None, eval_now=True,
+                 shard_cache_size=SHARD_CACHE_SIZE, num_workers=NUM_WORKERS):
         self.spectra_json = spectra_json
         self.spectra = None
+        self.columns = {}
+        self.num_workers = num_workers
         self.dataset_name = dataset_name
         self.subset_prefix = subset_prefix
+        self.loaded_files = []
+        self.fully_loaded = False
+        self.shard_cache = OrderedDict()
+        self.shard_cache_size = shard_cache_size
+        self.label_index = None
+        self.record_positions = None
         self.s3 = S3(DEFAULT_BUCKET)
 
         if eval_now and spectra_json is not None:
@@ -55,32 +121,57 @@ class SpectraLoader:
         self.subset_prefix = subset_prefix
 
         files = self.get_data_files()
-        return self.load_spectra(files)
+        spectra = self.load_spectra(files)
+        self.fully_loaded = True
+        return spectra
 
     def load_from_json(self, spectra_json):
         self.spectra_json = spectra_json
+        self.loaded_files = []
         return self.load_spectra()
 
-    def load_spectra_json_files(self, datafiles):
-        all_data = []
-        for filepath in datafiles:
-            spectra_json = self.load_spectra_json(filepath)
-            all_data.extend(spectra_json)
+    def load_columns(self, datafiles):
+        """
+        Decode shards into columns, with a pool of `num_workers` processes when there is more than one shard.
+        The columns of the shards are concatenated in the order of `datafiles`.
+
+        :param datafiles: list of shard paths
+        :return: dict of columns
+        """
+        shard_tasks = [self.get_shard_task(filepath) for filepath in datafiles]
+        num_workers = min(self.num_workers or 1, len(shard_tasks))
+        if num_workers <= 1:
+            return concatenate_columns([decode_shard(shard_task) for shard_task in shard_tasks])
 
-        return all_data
+        with multiprocessing.Pool(processes=num_workers) as pool:
+            return concatenate_columns(pool.map(decode_shard, shard_tasks, chunksize=1))
+
+    def get_shard_task(self, filepath):
+        """
+        :param filepath: str path of a shard
+        :return: tuple of `read_shard` arguments reading the loader's records of a shard
+        """
+        return (filepath,)
 
     def load_spectra_json(self, filepath):
-        return pickle.load(open(filepath, 'rb'))
+        return read_shard(*self.get_shard_task(filepath))
 
     def load_spectra(self, datafiles=[], del_old=False):
-        if self.spectra_json is None:
-            self.spectra_json = self.load_spectra_json_files(datafiles)
-
+        self.fully_loaded = False
         if self.spectra is not None:
             del self.spectra
             self.spectra = None
 
-        self.spectra = [Spectrum(**spectrum_json) for spectrum_json in self.spectra_json]
+        with memory_stage(SHARD_LOAD):
+            if self.spectra_json is None:
+                self.columns = self.load_columns(datafiles)
+                self.loaded_files = list(datafiles)
+            else:
+                self.columns = records_to_columns(self.spectra_json)
+
+        # Spectrum objects are only created for the records that are accessed
+        with memory_stage(SPECTRUM_CONSTRUCTION):
+            self.spectra = LazySpectra(self.columns)
         self.spectra_json = None
         return self.spectra
 
@@ -90,24 +181,109 @@ class SpectraLoader:
             spectra_dir = os.path.join(save_dir, f'spectra_{num_img}.png')
             self.spectra[i].plot_save_channels(spectra_dir, size)
 
+    def __len__(self):
+        if self.dataset_name is None or self.fully_loaded:
+            return len(self.spectra)
+        return len(self.get_record_positions())
+
+    def __getitem__(self, key):
+        """
+        Random access to the records of the loader's subset, by index, slice or array of indices.
+
+        Spectra already loaded with the whole subset (or from json) are returned directly. Otherwise the records are
+        located with the dataset's label index and read from their shards, keeping the last `shard_cache_size` decoded
+        shards in memory, so a few records can be fetched without loading the whole subset.
+
+        :param key: int, slice or array of int
+        :return: Spectrum, or list of Spectrum for slices and arrays
+        """
+        if self.dataset_name is None or self.fully_loaded:
+            if isinstance(key, (int, np.integer, slice)):
+                return self.spectra[key]
+            return [self.spectra[i] for i in key]
+
+        num_records = len(self)
+        if isinstance(key, (int, np.integer)):
+            if not -num_records <= key < num_records:
+                raise IndexError(f"Record {key} out of range for {num_records} records")
+            return self.get_records([key % num_records])[0]
+        if isinstance(key, slice):
+            return self.get_records(range(num_records)[key])
+        return self.get_records(key)
+
+    def get_records(self, indices):
+        """
+        :param indices: iterable of int record indices within the loader's subset
+        :return: list of Spectrum, in the order of `indices`
+        """
+        label_index = self.get_label_index()
+        shard_ids, offsets = label_index.locate(self.get_record_positions()[np.asarray(list(indices), dtype=np.int64)])
+        with memory_stage(SPECTRUM_CONSTRUCTION):
+            return [Spectrum(**self.get_shard(shard_id)[offset]) for shard_id, offset in zip(shard_ids, offsets)]
+
+    def get_label_index(self):
+        if self.label_index is None:
+            self.label_index = LabelIndex.load(self.dataset_name)
+        return self.label_index
+
+    def get_record_positions(self):
+        """
+        :return: np.array global index (in the label index) of every record of the loader's subset
+        """
+        if self.record_positions is None:
+            self.record_positions = self.get_label_index().get_subset_indices(self.subset_prefix)
+        return self.record_positions
+
+    def get_shard(self, shard_id):
+        """
+        Decoded records of a shard, through a least recently used cache of `shard_cache_size` shards.
+
+        :param shard_id: int shard index in the label index
+        :return: list of record dicts
+        """
+        shard_id = int(shard_id)
+        if shard_id in self.shard_cache:
+            self.shard_cache.move_to_end(shard_id)
+            return self.shard_cache[shard_id]
+
+        shard = self.load_spectra_json(self.get_label_index().get_file(shard_id))
+        self.shard_cache[shard_id] = shard
+        while len(self.shard_cache) > max(self.shard_cache_size, 1):
+            self.shard_cache.popitem(last=False)
+        return shard
+
+    def get_cache_token(self):
+        """
+        :return: str identifying what the loader selects from its files, used in keys of cached transforms
+        """
+        return f"{self.dataset_name}/{self.subset_prefix}"
+
     def get_num_instances(self):
         return len(self.spectra)
 
     def get_dm(self):
-        return [spectrum.dm for spectrum in self.spectra]
+        return self.columns.get('dm', [])
 
     def get_n(self):
-        return [spectrum.n for spectrum in self.spectra]
+        return self.columns.get('n', [])
 
     def get_peak_locations(self):
-        return [spectrum.peak_locations for spectrum in self.spectra]
+        return self.columns.get('peak_locations', [])
 
     def spectra_train_test_splitter(self, test_size=0.15, random_seed=42):
-        spectra = np.array(self.spectra)
+        train_idx, test_idx = self.get_train_test_indices(test_size=test_size, random_seed=random_seed)
+        return [self.spectra[i] for i in train_idx], [self.spectra[i] for i in test_idx]
+
+    def get_train_test_indices(self, test_size=0.15, random_seed=42):
+        """
+        Stratified split of the loaded spectra, as indices so the spectra themselves are not copied.
+
+        :return: train indices, test indices
+        """
         n_peaks = np.array(self.get_n())
-        spectra_train, spectra_test, _, _ = train_test_split(spectra, n_peaks, stratify=n_peaks,
-                                                             test_size=test_size, random_state=random_seed)
-        return spectra_train, spectra_test
+        train_idx, test_idx = train_test_split(np.arange(len(n_peaks)), stratify=n_peaks, test_size=test_size,
+                                               random_state=random_seed)
+        return train_idx, test_idx
 
     @staticmethod
     def read_dataset_config(dataset_name):
@@ -115,12 +291,8 @@ class SpectraLoader:
 
     @staticmethod
     def collect_sharded_files(dataset_name, subset):
-        dataset_path = SpectraLoader.get_dataset_path(dataset_name)
-        files = os.listdir(dataset_path)
-        files_filtered = sorted([os.path.join(dataset_path, file)
-                                 for file in files if re.match(f"{subset}_.+.{DATASET_FILE_TYPE}", file)])
-        return files_filtered
+        return collect_sharded_files(dataset_name, subset)
 
     @staticmethod
     def get_dataset_path(dataset_name):
-        return os.path.join(DATA_DIR, dataset_name)
+        return get_dataset_path(dataset_name)
@@ -2,6 +2,7 @@ import matplotlib.pyplot as plt
 import seaborn as sns
 import numpy as np
 import math
+from collections.abc import Sequence
 
 
 class Spectrum:
@@ -104,3 +105,56 @@ class Spectrum:
         """
         plt = self.plot_channels(size)
         plt.savefig(save_dir)
+
+
+class SpectrumProxy:
+    """
+    A spectrum of a loader, read from the loader's columns. Fields are looked up in the columns on access, and a
+    `Spectrum` is only created when one of its methods is used.
+    """
+    __slots__ = ('columns', 'index', 'spectrum')
+
+    def __init__(self, columns, index):
+        """
+        :param columns: dict {field: values of every record}, see `SpectraLoader.columns`
+        :param index: int Position of the record in the columns.
+        """
+        self.columns = columns
+        self.index = index
+        self.spectrum = None
+
+    def __getattr__(self, name):
+        if name in self.columns:
+            return self.columns[name][self.index]
+        return getattr(self.get_spectrum(), name)
+
+    def get_spectrum(self):
+        """
+        :return: Spectrum of the record
+        """
+        if self.spectrum is None:
+            self.spectrum = Spectrum(**{key: values[self.index] for key, values in self.columns.items()})
+        return self.spectrum
+
+
+class LazySpectra(Sequence):
+    """
+    Sequence of the spectra of a loader. Items are `SpectrumProxy` objects created when they are accessed.
+    """
+
+    def __init__(self, columns):
+        """
+        :param columns: dict {field: values of every record}
+        """
+        self.columns = columns
+        self.num_spectra = len(columns['n']) if columns else 0
+
+    def __len__(self):
+        return self.num_spectra
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return [SpectrumProxy(self.columns, i) for i in range(self.num_spectra)[key]]
+        if not -self.num_spectra <= key < self.num_spectra:
+            raise IndexError(f"Spectrum {key} out of range for {self.num_spectra} spectra")
+        return SpectrumProxy(self.columns, int(key) % self.num_spectra)
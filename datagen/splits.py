@@ -0,0 +1,75 @@
+from utils import *
+from datagen.dataset_view import DatasetView, get_label_index
+from sklearn.model_selection import StratifiedKFold, StratifiedShuffleSplit
+import numpy as np
+
+
+"""
+Train/test splits of a dataset expressed as dataset views over its records, instead of copies of the data.
+The records of all subsets of the dataset are pooled, and every fold of a split becomes a view whose training and test
+subsets select records from that single record store.
+"""
+
+
+SPLIT_METHODS = ('kfold', 'holdout')
+
+
+def stratified_kfold(labels, n_splits=5, seed=42):
+    """
+    :param labels: np.array label of every record
+    :param n_splits: int number of folds
+    :param seed: int
+    :return: list of (train positions, test positions), every record is in exactly one test set
+    """
+    splitter = StratifiedKFold(n_splits=n_splits, shuffle=True, random_state=seed)
+    return list(splitter.split(np.zeros(len(labels)), labels))
+
+
+def repeated_holdout(labels, test_size=0.15, n_splits=5, seed=42):
+    """
+    :param labels: np.array label of every record
+    :param test_size: float fraction of the records in every test set
+    :param n_splits: int number of repetitions
+    :param seed: int
+    :return: list of (train positions, test positions)
+    """
+    splitter = StratifiedShuffleSplit(n_splits=n_splits, test_size=test_size, random_state=seed)
+    return list(splitter.split(np.zeros(len(labels)), labels))
+
+
+def get_split_name(dataset_name, method, n_splits, fold):
+    return f"{dataset_name}-{method}{n_splits}-f{fold + 1}"
+
+
+def create_split_views(dataset_name, method='kfold', n_splits=5, test_size=0.15, seed=42):
+    """
+    Split the records of a dataset (or view) and save every fold as a view named `<dataset>-<method><n>-f<fold>`.
+    Existing views of the same split are overwritten; the split only depends on the label index and the seed.
+
+    :param dataset_name: str
+    :param method: str 'kfold' (stratified k-fold) or 'holdout' (repeated stratified holdout)
+    :param n_splits: int number of folds or repetitions
+    :param test_size: float fraction of test records of the 'holdout' method
+    :param seed: int
+    :return: list of view names, one per fold
+    """
+    if method not in SPLIT_METHODS:
+        raise ValueError(f"Unknown split method '{method}', expected one of {SPLIT_METHODS}")
+
+    labels = get_label_index(dataset_name).labels
+    if method == 'kfold':
+        folds = stratified_kfold(labels, n_splits=n_splits, seed=seed)
+    else:
+        folds = repeated_holdout(labels, test_size=test_size, n_splits=n_splits, seed=seed)
+
+    view_names = []
+    for fold, (train_positions, test_positions) in enumerate(folds):
+        view_name = get_split_name(dataset_name, method, n_splits, fold)
+        split = {'method': method, 'n_splits': n_splits, 'fold': fold, 'seed': seed,
+                 'test_size': test_size if method == 'holdout' else None}
+        DatasetView(view_name, dataset_name, {TRAIN_DATASET_PREFIX: train_positions, TEST_DATASET_PREFIX: test_positions},
+                    split=split).save()
+        view_names.append(view_name)
+        print(f"Saved split view {view_name}: {len(train_positions)} train, {len(test_positions)} test")
+
+    return view_names
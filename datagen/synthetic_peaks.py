@@ -0,0 +1,102 @@
+from utils import *
+import click
+import json
+import math
+import pickle
+import numpy as np
+
+
+"""
+Synthetic datasets of Lorentzian peaks, generated without MATLAB. Every spectrum holds 1 to `--n-max` peaks at
+positions drawn uniformly in [0.1, 0.9] of the window, seen by every channel with its own width, amplitudes and a small
+per-channel shift, plus uniform noise. The records have the fields of the MATLAB-generated ones (the generation
+parameters are those of `spectra_generator_v2.m` defaults), so every command of `models/run_train.py` reads them.
+The spectra are drawn in order from `--seed`, training shards first, so a dataset is reproduced by its command line.
+The architecture comparison of models/README.md uses the defaults:
+   > 'python -m datagen.synthetic_peaks --name synthetic_peaks'
+"""
+
+
+# Generation parameters recorded with every spectrum, as the MATLAB scripts do
+SPECTRUM_INFO = {'dg': 0.5, 'dgs': 0.5, 'scale': 1.0, 'omega_shift': 10.0, 'n_max_s': 5.0, 'gamma_amp_factor': 4.0,
+                 'amp_factor': 5.0, 'epsilon2': 0.0, 'n_shell': 2, 'gamma_amp': 0.2}
+
+
+def get_spectrum(random_state, timesteps, num_channels, n_max, noise):
+    """
+    :param random_state: np.random.RandomState the spectrum is drawn from
+    :param timesteps: np.array positions of the timesteps in [0, 1]
+    :param num_channels: int
+    :param n_max: int maximum number of peaks
+    :param noise: float amplitude of the uniform noise
+    :return: dict spectrum record, with the fields of the MATLAB-generated records
+    """
+    n = random_state.randint(1, n_max + 1)
+    peak_locations = np.sort(random_state.uniform(0.1, 0.9, n))
+    dm = []
+    for channel in range(num_channels):
+        width = random_state.uniform(0.01, 0.04)
+        amplitudes = random_state.uniform(0.5, 1.0, n)
+        shift = (channel - (num_channels - 1) / 2) * 0.005
+        spectrum = sum(amplitude * width ** 2 / ((timesteps - location - shift) ** 2 + width ** 2)
+                       for amplitude, location in zip(amplitudes, peak_locations))
+        dm.append(list(spectrum + noise * random_state.rand(len(timesteps))))
+    # Like the MATLAB records, a single peak location is not nested in a list
+    return dict(n=n, dm=dm, peak_locations=[list(peak_locations)] if n > 1 else [peak_locations[0]],
+                n_max=float(n_max), num_channels=float(num_channels), **SPECTRUM_INFO)
+
+
+def write_dataset(directory, name, num_instances, test_size, shard_size, num_channels, num_timesteps, n_max, noise,
+                  seed):
+    """
+    Write the training shards, the test shards and the gen_info.json of a synthetic dataset.
+
+    :param directory: str directory of the dataset
+    :param name: str name of the dataset, in the shard file names
+    :param num_instances: int number of spectra, training and test
+    :param test_size: int number of test spectra
+    :param shard_size: int number of spectra per shard
+    :return: dict dataset config written to gen_info.json
+    """
+    random_state = np.random.RandomState(seed)
+    timesteps = np.linspace(0, 1, num_timesteps)
+    for prefix, size in ((TRAIN_DATASET_PREFIX, num_instances - test_size), (TEST_DATASET_PREFIX, test_size)):
+        for shard_i in range(int(math.ceil(size / shard_size))):
+            shard = [get_spectrum(random_state, timesteps, num_channels, n_max, noise)
+                     for _ in range(min(shard_size, size - shard_i * shard_size))]
+            with open(os.path.join(directory, f"{prefix}_{name}-p{shard_i + 1}.{DATASET_FILE_TYPE}"), "wb") as f:
+                pickle.dump(shard, f)
+    dataset_config = {'n_max': float(n_max), 'n_max_s': SPECTRUM_INFO['n_max_s'], 'num_channels': float(num_channels),
+                      'scale': SPECTRUM_INFO['scale'], 'omega_shift': SPECTRUM_INFO['omega_shift'],
+                      'dg': SPECTRUM_INFO['dg'], 'dgs': SPECTRUM_INFO['dgs'], 'num_timesteps': num_timesteps,
+                      'num_instances': num_instances, 'matlab_script': "synthetic",
+                      'gamma_amp_factor': SPECTRUM_INFO['gamma_amp_factor'],
+                      'amp_factor': SPECTRUM_INFO['amp_factor'], 'epsilon2': SPECTRUM_INFO['epsilon2']}
+    with open(os.path.join(directory, DATAGEN_CONFIG), "w") as f:
+        json.dump(dataset_config, f)
+    return dataset_config
+
+
+@click.command()
+@click.option('--name', required=True, help=f'dataset directory under {to_local_path(DATA_DIR)}/')
+@click.option('--num-instances', type=click.IntRange(min=2), default=2000, help='number of spectra, training and test')
+@click.option('--test-size', type=click.IntRange(min=1), default=400, help='number of test spectra')
+@click.option('--shard-size', type=click.IntRange(min=1), default=400, help='number of spectra per shard')
+@click.option('--num-channels', type=click.IntRange(min=1), default=10)
+@click.option('--num-timesteps', type=click.IntRange(min=2), default=301)
+@click.option('--n-max', type=click.IntRange(min=1), default=4, help='maximum number of peaks')
+@click.option('--noise', type=click.FloatRange(min=0), default=0.15, help='amplitude of the uniform noise')
+@click.option('--seed', type=int, default=0)
+def main(name, num_instances, test_size, shard_size, num_channels, num_timesteps, n_max, noise, seed):
+    if test_size >= num_instances:
+        raise click.BadParameter('must be lower than --num-instances', param_hint='--test-size')
+    directory = os.path.join(DATA_DIR, name)
+    try_create_directory(directory)
+    check_clear_directory(directory)
+    write_dataset(directory, name, num_instances, test_size, shard_size, num_channels, num_timesteps, n_max, noise,
+                  seed)
+    print(f"Saved {num_instances - test_size} training and {test_size} test spectra to {to_local_path(directory)}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+from utils import *
+import contextlib
+import resource
+import threading
+import time
+import tracemalloc
+
+
+"""
+Peak memory of the stages of the data pipeline (shard loading, Spectrum construction, array assembly, to_categorical,
+prediction), to size nodes and check memory savings. Disabled by default: stages cost nothing until `enable` is called.
+
+Every stage records the peak resident memory (RSS) of the process and the peak of the Python allocations traced by
+tracemalloc (numpy arrays included) while it runs. Peaks are process-wide high-water marks, reset when a stage starts or
+ends (Linux resets the RSS peak through /proc/self/clear_refs); before every reset, the peaks so far are added to all
+open stages, so nested stages and stages running in other threads (e.g. the training generator) keep theirs.
+"""
+
+
+SHARD_LOAD = "shard_load"
+SPECTRUM_CONSTRUCTION = "spectrum_construction"
+ARRAY_ASSEMBLY = "array_assembly"
+TO_CATEGORICAL = "to_categorical"
+PREDICT = "predict"
+
+MIB = 2 ** 20
+
+
+def read_rss():
+    """
+    :return: (int, int) current and peak resident memory of the process in bytes, peak only (twice) without /proc
+    """
+    try:
+        with open("/proc/self/status", "r") as f:
+            status = dict(line.split(":", 1) for line in f if ":" in line)
+        return int(status["VmRSS"].split()[0]) * 1024, int(status["VmHWM"].split()[0]) * 1024
+    except (OSError, KeyError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+        return peak, peak
+
+
+def reset_peak_rss():
+    """
+    :return: bool True if the peak resident memory of the process was reset
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def get_children_peak_rss():
+    """
+    :return: int peak resident memory in bytes of the largest terminated child process, e.g. shard decoding workers
+    """
+    return resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+
+
+class MemoryAccounting:
+    """Peak memory of named stages, aggregated over the calls of every stage."""
+
+    def __init__(self):
+        self.enabled = False
+        self.started_tracing = False
+        self.stages = {}  # {name: aggregated measures}
+        self.open_stages = []  # measures of the stages currently running, in all threads
+        self.lock = threading.Lock()
+
+    def enable(self):
+        if self.enabled:
+            return
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.started_tracing = True
+        self.enabled = True
+
+    def disable(self):
+        if self.started_tracing:
+            tracemalloc.stop()
+            self.started_tracing = False
+        self.enabled = False
+
+    def _fold_peaks(self):
+        """Add the peaks since the last reset to every open stage, then reset them. Called with the lock held."""
+        rss, rss_peak = read_rss()
+        python_peak = tracemalloc.get_traced_memory()[1]
+        for measures in self.open_stages:
+            measures['rss_peak'] = max(measures['rss_peak'], rss_peak)
+            measures['python_peak'] = max(measures['python_peak'], python_peak)
+        reset_peak_rss()
+        tracemalloc.reset_peak()
+        return rss
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        Context manager measuring a stage, nothing if accounting is disabled.
+
+        :param name: str
+        """
+        if not self.enabled:
+            yield
+            return
+
+        with self.lock:
+            rss = self._fold_peaks()
+            python = tracemalloc.get_traced_memory()[0]
+            measures = {'rss': rss, 'rss_peak': rss, 'python': python, 'python_peak': python,
+                        'children_peak': get_children_peak_rss(), 'start': time.perf_counter()}
+            self.open_stages.append(measures)
+        try:
+            yield
+        finally:
+            with self.lock:
+                rss_end = self._fold_peaks()
+                self.open_stages.remove(measures)
+                self._record(name, measures, rss_end, tracemalloc.get_traced_memory()[0])
+
+    def _record(self, name, measures, rss_end, python_end):
+        stage = self.stages.setdefault(name, {'calls': 0, 'seconds': 0.0, 'peak_rss_mib': 0.0,
+                                              'rss_increase_mib': 0.0, 'python_peak_mib': 0.0,
+                                              'python_retained_mib': 0.0, 'children_peak_rss_mib': None})
+        stage['calls'] += 1
+        stage['seconds'] = round(stage['seconds'] + time.perf_counter() - measures['start'], 3)
+        stage['peak_rss_mib'] = round(max(stage['peak_rss_mib'], measures['rss_peak'] / MIB), 1)
+        stage['rss_increase_mib'] = round(max(stage['rss_increase_mib'],
+                                              (measures['rss_peak'] - measures['rss']) / MIB), 1)
+        stage['python_peak_mib'] = round(max(stage['python_peak_mib'],
+                                             (measures['python_peak'] - measures['python']) / MIB), 1)
+        stage['python_retained_mib'] = round(stage['python_retained_mib'] +
+                                             (python_end - measures['python']) / MIB, 1)
+        children_peak = get_children_peak_rss()
+        if children_peak > measures['children_peak']:
+            stage['children_peak_rss_mib'] = round(children_peak / MIB, 1)
+
+    def get_report(self):
+        """
+        :return: dict {stage: {'calls', 'seconds', 'peak_rss_mib' (of the process), 'rss_increase_mib' (peak above the
+                 RSS at the start of the stage), 'python_peak_mib' (peak of the Python allocations above those at the
+                 start), 'python_retained_mib' (still allocated at the end, summed over calls), 'children_peak_rss_mib'
+                 (largest child process that ended during the stage, e.g. decoding workers, or None)}}, with the peak
+                 RSS of the whole process under 'process'
+        """
+        report = {name: dict(stage) for name, stage in self.stages.items()}
+        # ru_maxrss is not reset with the peak of /proc and may be counted slightly differently
+        process_peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+        report['process'] = {'peak_rss_mib': round(max([process_peak / MIB] +
+                                                       [stage['peak_rss_mib'] for stage in self.stages.values()]), 1)}
+        return report
+
+    def print_report(self):
+        print("------- Memory per stage (MiB) ------- ")
+        print(f"{'stage':24s}{'calls':>7s}{'seconds':>10s}{'peak RSS':>10s}{'RSS +':>9s}{'Python +':>10s}"
+              f"{'retained':>10s}{'workers':>9s}")
+        for name, stage in self.stages.items():
+            workers = "" if stage['children_peak_rss_mib'] is None else f"{stage['children_peak_rss_mib']:.0f}"
+            print(f"{name:24s}{stage['calls']:7d}{stage['seconds']:10.2f}{stage['peak_rss_mib']:10.0f}"
+                  f"{stage['rss_increase_mib']:9.0f}{stage['python_peak_mib']:10.0f}"
+                  f"{stage['python_retained_mib']:10.0f}{workers:>9s}")
+        print(f"Process peak RSS: {self.get_report()['process']['peak_rss_mib']:.0f} MiB")
+
+
+ACCOUNTING = MemoryAccounting()
+
+
+def enable_memory_accounting():
+    ACCOUNTING.enable()
+
+
+def memory_stage(name):
+    """
+    :param name: str stage name, e.g. SHARD_LOAD
+    :return: context manager measuring the stage if memory accounting is enabled
+    """
+    return ACCOUNTING.stage(name)
+
+
+def get_memory_report():
+    """
+    :return: dict `MemoryAccounting.get_report`, None if memory accounting is disabled
+    """
+    return ACCOUNTING.get_report() if ACCOUNTING.enabled else None
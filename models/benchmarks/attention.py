@@ -0,0 +1,80 @@
+from models.benchmarks.timing import time_function, format_row, format_header
+from models.networks.abstract_models.attention import Attention
+from tensorflow.keras.layers import Layer
+from tensorflow.keras import backend as K
+import click
+import numpy as np
+import tensorflow as tf
+
+
+"""
+Micro-benchmark of the Attention layer against the previous implementation (reshape, K.dot and a hand-normalized exp),
+timing a training step (forward and gradients) at the sequence lengths of our models.
+Use:
+   > 'python -m models.benchmarks.attention --help'
+"""
+
+
+class DotAttention(Layer):
+    """Previous Attention implementation, kept as the benchmark reference."""
+
+    def __init__(self, step_dim, **kwargs):
+        self.step_dim = step_dim
+        self.features_dim = 0
+        super(DotAttention, self).__init__(**kwargs)
+
+    def build(self, input_shape):
+        self.W = self.add_weight(shape=(input_shape[-1],), initializer='glorot_uniform', name=f'{self.name}_W')
+        self.features_dim = input_shape[-1]
+        self.b = self.add_weight(shape=(input_shape[1],), initializer='zero', name=f'{self.name}_b')
+        self.built = True
+
+    def call(self, x, mask=None):
+        features_dim = self.features_dim
+        step_dim = self.step_dim
+        eij = K.reshape(K.dot(K.reshape(x, (-1, features_dim)),
+                        K.reshape(self.W, (features_dim, 1))), (-1, step_dim))
+        eij += self.b
+        eij = K.tanh(eij)
+        a = K.exp(eij)
+        if mask is not None:
+            a *= K.cast(mask, K.floatx())
+        a /= K.cast(K.sum(a, axis=1, keepdims=True) + K.epsilon(), K.floatx())
+        a = K.expand_dims(a)
+        weighted_input = x * a
+        return K.sum(weighted_input, axis=1)
+
+
+def get_train_step(layer):
+    def train_step(x):
+        with tf.GradientTape() as tape:
+            tape.watch(x)
+            loss = tf.reduce_sum(layer(x))
+        return tape.gradient(loss, [x] + layer.trainable_weights)
+    return train_step
+
+
+@click.command()
+@click.option('--num-timesteps', '-t', type=int, multiple=True, default=(76, 151, 293, 301),
+              help='sequence lengths (repeatable), e.g. GoogleModel attends over num_timesteps - 8')
+@click.option('--num-features', type=int, default=256, help='features per timestep (2 x LSTM size)')
+@click.option('--batch-size', type=int, default=32)
+@click.option('--num-runs', type=int, default=100)
+def main(num_timesteps, num_features, batch_size, num_runs):
+    print(f"Attention training step on ({batch_size}, t, {num_features}), {num_runs} runs")
+    print(format_header())
+    for t in num_timesteps:
+        x = tf.constant(np.random.rand(batch_size, t, num_features).astype('float32'))
+        reference = DotAttention(t)
+        attention = Attention()
+        reference.build(x.shape)
+        attention.build(x.shape)
+        attention.set_weights(reference.get_weights())
+        assert np.allclose(reference(x).numpy(), attention(x).numpy(), atol=1e-4), "Attention layers disagree"
+
+        print(format_row(f"t={t} dot", time_function(get_train_step(reference), (x,), num_runs=num_runs)))
+        print(format_row(f"t={t} attention", time_function(get_train_step(attention), (x,), num_runs=num_runs)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+from models.benchmarks.timing import time_function, format_row, format_header
+from models.networks.abstract_models.channel_padder import ChannelPadder
+from tensorflow.keras.layers import Layer
+import click
+import numpy as np
+import tensorflow as tf
+
+
+"""
+Micro-benchmark of ChannelPadder against the previous implementation, which padded with a loop of tf.pad calls.
+Inputs with at least --output-dim channels go through both layers unchanged.
+Use:
+   > 'python -m models.benchmarks.channel_padder --help'
+"""
+
+
+class LoopChannelPadder(Layer):
+    """Previous ChannelPadder implementation, kept as the benchmark reference."""
+
+    def __init__(self, output_dim, **kwargs):
+        self.output_dim = output_dim
+        super(LoopChannelPadder, self).__init__(**kwargs)
+
+    def transform_dimensions(self, dm, output_dim):
+        result = dm
+        nc = dm.shape[2]
+        if nc is not None:
+            if nc < output_dim:
+                for i in range(0, output_dim - 2 * nc - 2, nc):
+                    paddings = [[0, 0], [0, 0], [0, nc]]
+                    result = tf.pad(result, paddings, 'SYMMETRIC')
+                paddings = [[0, 0], [0, 0], [0, output_dim - result.shape[2]]]
+                result = tf.pad(result, paddings, 'SYMMETRIC')
+        return result
+
+    def call(self, X, **kwargs):
+        return self.transform_dimensions(X, self.output_dim)
+
+
+@click.command()
+@click.option('--output-dim', type=int, default=50, help='number of channels models are padded to')
+@click.option('--num-channels', '-nc', type=int, multiple=True, default=(3, 5, 10, 20, 50, 60),
+              help='channel counts of the input (repeatable)')
+@click.option('--num-timesteps', type=int, default=301)
+@click.option('--batch-size', type=int, default=32)
+@click.option('--num-runs', type=int, default=200)
+def main(output_dim, num_channels, num_timesteps, batch_size, num_runs):
+    print(f"Padding ({batch_size}, {num_timesteps}, nc) to {output_dim} channels, {num_runs} runs")
+    print(format_header())
+    for nc in num_channels:
+        X = tf.constant(np.random.rand(batch_size, num_timesteps, nc).astype('float32'))
+        loop_padder = LoopChannelPadder(output_dim)
+        gather_padder = ChannelPadder(output_dim)
+
+        try:
+            expected = loop_padder(X).numpy()
+        except (tf.errors.InvalidArgumentError, ValueError):
+            expected = None
+            print(format_row(f"nc={nc} loop", {'mean_ms': np.nan, 'median_ms': np.nan, 'p90_ms': np.nan}),
+                  "(fails for this channel count)")
+        else:
+            assert np.array_equal(expected, gather_padder(X).numpy()), "Padders disagree"
+            print(format_row(f"nc={nc} loop", time_function(loop_padder, (X,), num_runs=num_runs)))
+        print(format_row(f"nc={nc} gather", time_function(gather_padder, (X,), num_runs=num_runs)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+from utils import *
+from models.benchmarks.timing import time_function, format_row, format_header
+from models.benchmarks.model_latency import get_model_classes
+from models.networks.abstract_models.base_model import PRECISIONS, cpu_supports_bfloat16
+import click
+import numpy as np
+import tensorflow as tf
+
+
+"""
+Train and predict step time of models built with every compile mode of BaseModel: with and without XLA compilation
+(jit_compile) and in every precision. Models are built with their default parameters.
+Use:
+   > 'python -m models.benchmarks.compile_modes --help'
+"""
+
+
+COMPILE_DICT = {'optimizer': 'adam', 'loss': 'categorical_crossentropy', 'metrics': ['accuracy']}
+
+
+@click.command()
+@click.option('--model-name', '-m', multiple=True, default=('GoogleModel', 'TCNModel', 'CNNEnsemble1'),
+              help='architecture class (repeatable)')
+@click.option('--num-channels', '-nc', type=int, default=10)
+@click.option('--num-timesteps', '-t', type=int, default=301)
+@click.option('--num-classes', type=int, default=5)
+@click.option('--batch-size', '-bs', type=int, default=32)
+@click.option('--num-runs', type=int, default=20)
+def main(model_name, num_channels, num_timesteps, num_classes, batch_size, num_runs):
+    model_classes = get_model_classes()
+    X = np.random.rand(batch_size, num_timesteps, num_channels).astype('float32')
+    y = np.eye(num_classes)[np.random.randint(0, num_classes, batch_size)]
+
+    print(f"Batch of {batch_size}, {num_runs} runs, native bfloat16: {cpu_supports_bfloat16()}")
+    print(format_header())
+    for name in model_name:
+        for jit_compile in (False, True):
+            for precision in PRECISIONS:
+                model = model_classes[name](num_channels, num_timesteps, num_classes)
+                model._fit_preinit(dict(COMPILE_DICT, jit_compile=jit_compile, precision=precision))
+                mode = f"{name} {'xla' if jit_compile else 'no-xla'} {model.compile_dict['precision']}"
+                print(format_row(f"{mode} train", time_function(model.keras_model.train_on_batch, (X, y),
+                                                                num_runs=num_runs, wrap=False)))
+                print(format_row(f"{mode} predict", time_function(model.keras_model.predict_on_batch, (X,),
+                                                                  num_runs=num_runs, wrap=False)))
+                tf.keras.backend.clear_session()
+
+
+if __name__ == '__main__':
+    main()
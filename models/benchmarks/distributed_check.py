@@ -0,0 +1,98 @@
+from utils import *
+from datagen.synthetic_peaks import write_dataset
+from models.benchmarks.model_latency import get_model_classes, load_run
+from models.distributed import launch_local_workers, uses_keras_3
+from models.run_train import load_data
+import click
+import json
+import shutil
+import sys
+import tempfile
+import numpy as np
+
+
+"""
+Check of multi-worker training on this host. `run_train.py new --distribute multi_worker` is run in `--num-workers`
+local processes through `launch_local_workers` on a small synthetic dataset, then the run saved by the chief is
+persisted as `continue` and `evaluate` would load it. The check fails (exit code 1) if a worker fails, if the workers
+do not save exactly one run, if its info.json does not record the epochs and the data-parallel setup of the run, or if
+the persisted model does not reproduce the test metrics the chief saved. The dataset and the run are deleted
+afterwards. Workers need tf.keras 2 (`TF_USE_LEGACY_KERAS=1`, as in the Docker image).
+Use:
+   > 'python -m models.benchmarks.distributed_check --help'
+   > 'python -m models.benchmarks.distributed_check -m TCNModel --num-workers 2'
+"""
+
+
+def get_run_names(model_name, dataset_name):
+    prefix = f"{model_name}{RESULT_DIR_DELIM}{dataset_name}."
+    return sorted(name for name in os.listdir(MODEL_RES_DIR) if name.startswith(prefix))
+
+
+@click.command()
+@click.option('--model-name', '-m', default='TCNModel', help='architecture class')
+@click.option('--num-workers', type=click.IntRange(min=2), default=2, help='number of local worker processes')
+@click.option('--epochs', '-n', type=click.IntRange(min=1), default=2)
+@click.option('--batch-size', '-bs', type=click.IntRange(min=1), default=16, help='batch size of every worker')
+@click.option('--num-instances', '-ns', type=click.IntRange(min=2), default=400, help='training and test spectra')
+@click.option('--num-channels', '-nc', type=click.IntRange(min=1), default=4)
+@click.option('--num-timesteps', '-t', type=click.IntRange(min=2), default=101)
+@click.option('--timeout', type=float, default=900, help='seconds after which the workers are killed')
+@click.option('--tolerance', type=float, default=1e-4, help='largest difference allowed between the test metrics')
+@click.option('--seed', type=int, default=42)
+def main(model_name, num_workers, epochs, batch_size, num_instances, num_channels, num_timesteps, timeout, tolerance,
+         seed):
+    if uses_keras_3():
+        raise click.ClickException("Multi-worker training needs tf.keras 2: install tf-keras (see requirements.txt) "
+                                   "and set TF_USE_LEGACY_KERAS=1")
+    failures = []
+
+    def check(condition, message):
+        print(f"{'ok' if condition else 'FAILED'}: {message}")
+        if not condition:
+            failures.append(message)
+
+    dataset_dir = tempfile.mkdtemp(prefix="distributed_check-", dir=DATA_DIR)
+    dataset_name = os.path.basename(dataset_dir)
+    try:
+        test_size = num_instances // 5
+        dataset_config = write_dataset(dataset_dir, dataset_name, num_instances, test_size, shard_size=num_instances,
+                                       num_channels=num_channels, num_timesteps=num_timesteps, n_max=4, noise=0.15,
+                                       seed=seed)
+        command = [sys.executable, '-m', 'models.run_train', 'new', '-m', model_name, '-d', dataset_name,
+                   '-nc', str(num_channels), '-ns', str(num_instances), '-bs', str(batch_size), '-n', str(epochs),
+                   '--no-comet', '-cn', dataset_name, '--distribute', 'multi_worker']
+        print(f"Training {model_name} on {num_workers} workers: {' '.join(command)}")
+        return_codes = launch_local_workers(command, num_workers, timeout=timeout)
+        check(not any(return_codes), f"the workers exited with codes {return_codes}")
+
+        run_names = get_run_names(model_name, dataset_name)
+        check(len(run_names) == 1, f"the workers saved one run, found {run_names}")
+        if len(run_names) == 1:
+            with open(os.path.join(MODEL_RES_DIR, run_names[0], TRAIN_INFO_FILENAME), 'r') as f:
+                info = json.load(f)
+            distribute = info.get('distribute') or {}
+            check(info['epochs'] == epochs, f"the run trained {info['epochs']} of {epochs} epochs")
+            check(distribute.get('num_replicas') == num_workers and
+                  distribute.get('global_batch_size') == batch_size * num_workers,
+                  f"the run records its {num_workers} replicas and global batch size: {distribute}")
+
+            model, info = load_run(get_model_classes(), run_names[0], num_channels, int(dataset_config['n_max']))
+            X_test, y_test = load_data(model, dataset_name, num_channels, num_instances,
+                                       load_train=False).transform_test()
+            test_results = model.evaluate(X_test=X_test, y_test=y_test)
+            saved, persisted = info['test_results']['metrics'], test_results['metrics']
+            check(len(saved) == len(persisted) and np.allclose(saved, persisted, rtol=tolerance, atol=tolerance),
+                  f"the persisted run reproduces the saved test metrics: {saved} saved, {persisted} persisted")
+    finally:
+        for run_name in get_run_names(model_name, dataset_name):
+            shutil.rmtree(os.path.join(MODEL_RES_DIR, run_name), ignore_errors=True)
+        shutil.rmtree(dataset_dir, ignore_errors=True)
+
+    if failures:
+        raise click.ClickException(f"{len(failures)} distributed check(s) failed")
+    print("The distributed run was saved by its chief and persists as expected")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+from utils import *
+from models.benchmarks.model_latency import get_model_classes
+from models.networks.abstract_models.base_model import clear_custom_gradients
+import click
+import gc
+import numpy as np
+import tensorflow as tf
+
+
+"""
+Memory regression check of a process building and training many models one after the other, as optimizer loops do.
+Small models are built and trained `--num-models` times, and the check fails (exit code 1) if the resident memory of
+the process grew by more than `--max-growth` MiB after the warmup models. It also fails when the private gradient
+registry `BaseModel.dispose` clears is missing from the installed TensorFlow, as dispose can then no longer release
+the gradient functions of the train steps. Linux only (reads /proc).
+Use:
+   > 'python -m models.benchmarks.memory_regression --help'
+   > 'python -m models.benchmarks.memory_regression -n 100'
+   > 'python -m models.benchmarks.memory_regression -n 100 --no-dispose'   (growth without BaseModel.dispose)
+"""
+
+
+COMPILE_DICT = {'optimizer': 'adam', 'loss': 'categorical_crossentropy', 'metrics': ['accuracy']}
+
+
+def get_rss_mib():
+    """
+    :return: float resident memory of this process in MiB
+    """
+    with open('/proc/self/statm', 'r') as f:
+        resident_pages = int(f.read().split()[1])
+    return resident_pages * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+
+
+@click.command()
+@click.option('--model-name', '-m', multiple=True, default=('TCNModel', 'CNNEnsemble1'),
+              help='architecture class (repeatable), models are built in turn')
+@click.option('--num-models', '-n', type=click.IntRange(min=2), default=100)
+@click.option('--num-warmup', type=click.IntRange(min=1), default=10,
+              help='models built before the reference memory is measured (allocator and library caches)')
+@click.option('--max-growth', type=float, default=100.0, help='MiB the memory may grow by after the warmup')
+@click.option('--dispose/--no-dispose', default=True, help='dispose of every model after training it')
+@click.option('--num-channels', '-nc', type=int, default=4)
+@click.option('--num-timesteps', '-t', type=int, default=64)
+@click.option('--num-classes', type=int, default=5)
+@click.option('--num-spectra', type=int, default=64, help='training (and test) spectra of every model')
+def main(model_name, num_models, num_warmup, max_growth, dispose, num_channels, num_timesteps, num_classes,
+         num_spectra):
+    if num_warmup >= num_models:
+        raise click.BadParameter('must be lower than --num-models', param_hint='--num-warmup')
+    if dispose and not clear_custom_gradients():
+        raise click.ClickException(f"The gradient registry of TensorFlow {tf.__version__} was not found, dispose does "
+                                   f"not unregister custom gradients: update clear_custom_gradients in base_model.py")
+
+    model_classes = get_model_classes()
+    X = np.random.rand(num_spectra, num_timesteps, num_channels).astype('float32')
+    y = np.eye(num_classes)[np.random.randint(0, num_classes, num_spectra)]
+
+    rss = []
+    for i in range(num_models):
+        name = model_name[i % len(model_name)]
+        model = model_classes[name](num_channels, num_timesteps, num_classes)
+        model.fit(X, y, X, y, batch_size=32, epochs=1, compile_dict=COMPILE_DICT)
+        if dispose:
+            model.dispose()
+        del model
+        gc.collect()
+        rss.append(get_rss_mib())
+        if (i + 1) % 10 == 0 or i + 1 == num_warmup:
+            print(f"{i + 1} models: {rss[-1]:.0f} MiB")
+
+    growth = rss[-1] - rss[num_warmup - 1]
+    per_model = np.polyfit(np.arange(num_warmup, num_models), rss[num_warmup:], 1)[0]
+    print(f"Growth after {num_warmup} warmup models: {growth:.1f} MiB over {num_models - num_warmup} models "
+          f"({per_model:.2f} MiB per model, {'with' if dispose else 'without'} dispose)")
+    if growth > max_growth:
+        raise click.ClickException(f"Memory grew by {growth:.1f} MiB, more than {max_growth} MiB")
+
+
+if __name__ == '__main__':
+    main()
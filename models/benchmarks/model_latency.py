@@ -0,0 +1,93 @@
+from utils import *
+from models.benchmarks.timing import time_function, format_row, format_header
+import click
+import json
+import numpy as np
+import tensorflow as tf
+
+
+"""
+Inference latency of model architectures on the local device (run it on a serving node for CPU numbers).
+Models are built with their default parameters. With `--result-name`, a trained run is rebuilt as it was trained (its
+parameters, channels, timesteps, classes and compile options, with its weights) and timed with the test metrics stored in
+its info.json, so accuracy and latency are compared on the dataset the run was evaluated on. Runs that did not record
+their architecture are built with `--num-channels`, `--num-classes` and the default parameters.
+Use:
+   > 'python -m models.benchmarks.model_latency --help'
+   > 'python -m models.benchmarks.model_latency -m LSTMModel -m TCNModel -bs 1 -bs 32'
+"""
+
+
+DEFAULT_MODELS = ('LSTMModel', 'GoogleModel', 'TCNModel', 'SeparableTCNModel')
+
+
+def get_model_classes():
+    return {name: getattr(module, name) for module, package_name in get_modules(NETWORKS_DIR)
+            for name in get_classes(module, package_name)}
+
+
+def get_run_info(result_name):
+    with open(os.path.join(MODEL_RES_DIR, result_name, TRAIN_INFO_FILENAME), 'r') as f:
+        return json.load(f)
+
+
+def load_run(model_classes, result_name, num_channels, num_classes):
+    """
+    :param model_classes: dict {class name: architecture class}
+    :param result_name: str trained run in the results directory
+    :param num_channels: int channels of runs that did not record them
+    :param num_classes: int classes of runs that did not record them
+    :return: model object instance of the run, with its weights, and its info.json
+    """
+    info = get_run_info(result_name)
+    model = model_classes[info['class_name']](info.get('num_channels', num_channels), info['num_timesteps'],
+                                              info.get('output_shape', num_classes))
+    model.persist(result_name)
+    return model, info
+
+
+def format_metrics(test_results):
+    if not test_results:
+        return ''
+    return ', '.join(f"{name} {value:.4f}" for name, value in zip(test_results['metrics_names'], test_results['metrics']))
+
+
+@click.command()
+@click.option('--model-name', '-m', multiple=True,
+              help='architecture class (repeatable), by default LSTMModel, GoogleModel, TCNModel and SeparableTCNModel '
+                   'unless runs are given')
+@click.option('--result-name', '-r', multiple=True, help='trained run in the results directory (repeatable)')
+@click.option('--num-channels', '-nc', type=int, default=10, help='channels of the --model-name architectures')
+@click.option('--num-timesteps', '-t', type=int, default=301, help='timesteps of the --model-name architectures')
+@click.option('--num-classes', type=int, default=5, help='output classes of the --model-name architectures')
+@click.option('--batch-size', '-bs', type=int, multiple=True, default=(1, 32), help='batch size (repeatable)')
+@click.option('--num-runs', type=int, default=50)
+@click.option('--num-threads', type=int, default=None, help='intra-op threads, e.g. the cores of a serving node')
+def main(model_name, result_name, num_channels, num_timesteps, num_classes, batch_size, num_runs, num_threads):
+    if num_threads is not None:
+        tf.config.threading.set_intra_op_parallelism_threads(num_threads)
+
+    model_classes = get_model_classes()
+    if not model_name and not result_name:
+        model_name = DEFAULT_MODELS
+    benchmarks = []
+    for name in model_name:
+        model = model_classes[name](num_channels, num_timesteps, num_classes)
+        benchmarks.append((name, model.build_model(num_channels, num_timesteps, num_classes,
+                                                   model.get_default_params()), num_channels, num_timesteps, None))
+    for name in result_name:
+        model, info = load_run(model_classes, name, num_channels, num_classes)
+        benchmarks.append((name, model.keras_model, model.num_channels, model.num_timesteps, info['test_results']))
+
+    print(f"Inference, {num_runs} runs, {tf.config.threading.get_intra_op_parallelism_threads() or 'all'} threads")
+    print(f"{format_header()}  test metrics")
+    for name, keras_model, channels, timesteps, test_results in benchmarks:
+        print(f"{name}: {keras_model.count_params()} parameters, {channels} channels, {timesteps} timesteps")
+        for size in batch_size:
+            X = tf.constant(np.random.rand(size, timesteps, channels).astype('float32'))
+            timing = time_function(lambda x: keras_model(x, training=False), (X,), num_runs=num_runs)
+            print(f"{format_row(f'  batch {size}', timing)}  {format_metrics(test_results)}".rstrip())
+
+
+if __name__ == '__main__':
+    main()
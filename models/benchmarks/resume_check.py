@@ -0,0 +1,233 @@
+from utils import *
+from models.benchmarks.model_latency import get_model_classes
+from models import checkpoints
+from models.checkpoints import CHECKPOINT_FILES, Checkpoint, EarlyStopping, get_optimizer_variables, get_staged_path, \
+    load_early_stopping, read_checkpoint
+import click
+import shutil
+import tempfile
+import numpy as np
+import tensorflow as tf
+
+
+"""
+Check that a checkpointed run resumed from its checkpoint trains as the uninterrupted run would have. A model is
+trained `--epochs` epochs in one go, and a second one (same seed) `--resume-at` epochs with a Checkpoint, then rebuilt
+from the checkpoint as `run_train.py resume` does and trained to `--epochs`. The check fails (exit code 1) if the two
+runs differ in:
+ - their epoch counters, history and the epochs keras trained the resumed run at (initial_epoch)
+ - their optimizer state (iteration count, moments)
+ - the state of their early stopping
+ - their final weights
+Dropout is disabled and batches are drawn per epoch (as `SpectraPreprocessor.flow` does), so both runs see the same
+batches and only the checkpoint can make them differ.
+With `--interrupt`, the checkpointed run is preempted while saving the checkpoint of the epoch after `--resume-at`:
+ - staging: after its weights, info.json and optimizer state are staged, the run resumes from `--resume-at`
+ - commit: after its weights are moved in place, the run resumes from the interrupted checkpoint
+Use:
+   > 'python -m models.benchmarks.resume_check --help'
+   > 'python -m models.benchmarks.resume_check -m TCNModel --epochs 4 --resume-at 2'
+   > 'python -m models.benchmarks.resume_check --interrupt commit'
+"""
+
+
+COMPILE_DICT = {'optimizer': 'adam', 'loss': 'categorical_crossentropy', 'metrics': ['accuracy']}
+DATASET_NAME = "resume_check"
+RUN_DIRNAME = "run"
+INTERRUPTIONS = ('none', 'staging', 'commit')
+
+
+class Preempted(Exception):
+    pass
+
+
+def interrupt_staging(result_dir, checkpoint):
+    raise Preempted()
+
+
+def interrupt_commit(result_dir):
+    first_path = os.path.join(result_dir, CHECKPOINT_FILES[0])
+    os.replace(get_staged_path(first_path), first_path)
+    raise Preempted()
+
+
+class EpochFlow:
+    """
+    The part of SpectraPreprocessor `BaseModel.fit` uses to draw batches: the records of every epoch are shuffled with
+    the epoch as seed, so a run started at `initial_epoch` trains on the batches the uninterrupted run did.
+    """
+
+    def uses_flow(self):
+        return True
+
+    def flow(self, X, y, batch_size, initial_epoch=0):
+        epoch = initial_epoch
+        while True:
+            order = np.random.RandomState(epoch).permutation(len(X))
+            for start in range(0, len(order) - batch_size + 1, batch_size):
+                yield X[order[start:start + batch_size]], y[order[start:start + batch_size]]
+            epoch += 1
+
+    def get_train_steps(self, batch_size, num_instances=None, y=None):
+        return len(y) // batch_size
+
+
+def get_data(num_spectra, num_timesteps, num_channels, num_classes, seed):
+    """
+    :return: X, y spectra whose mean depends on their class, so the runs learn and early stopping sees improvements
+    """
+    random_state = np.random.RandomState(seed)
+    labels = random_state.randint(0, num_classes, num_spectra)
+    X = random_state.rand(num_spectra, num_timesteps, num_channels) + labels[:, None, None] / num_classes
+    return X.astype('float32'), np.eye(num_classes)[labels]
+
+
+def build_model(model_class, num_channels, num_timesteps, num_classes, seed):
+    tf.keras.utils.set_random_seed(seed)
+    model = model_class(num_channels, num_timesteps, num_classes)
+    model.params = {name: 0.0 if 'drop' in name else value for name, value in model.get_default_params().items()}
+    return model
+
+
+def get_state(model, early_stopping):
+    """
+    :return: dict of what a resumed run must share with the uninterrupted one
+    """
+    return {'epochs': model.epochs,
+            'history': model.history,
+            'optimizer': [variable.numpy() for variable in get_optimizer_variables(model.keras_model)],
+            'early_stopping': early_stopping.serialize(),
+            'weights': model.keras_model.get_weights()}
+
+
+def compare_states(uninterrupted, resumed, tolerance):
+    """
+    :return: list of str differences between the two states
+    """
+    differences = []
+    if uninterrupted['epochs'] != resumed['epochs']:
+        differences.append(f"epochs: {uninterrupted['epochs']} != {resumed['epochs']}")
+    if uninterrupted['history'].keys() != resumed['history'].keys():
+        differences.append(f"history metrics: {sorted(uninterrupted['history'])} != {sorted(resumed['history'])}")
+    for key in uninterrupted['history'].keys() & resumed['history'].keys():
+        expected, actual = uninterrupted['history'][key], resumed['history'][key]
+        if len(expected) != len(actual) or not np.allclose(expected, actual, rtol=tolerance, atol=tolerance):
+            differences.append(f"history {key}: {expected} != {actual}")
+    for name in ('optimizer', 'weights'):
+        expected, actual = uninterrupted[name], resumed[name]
+        if len(expected) != len(actual):
+            differences.append(f"{name}: {len(expected)} != {len(actual)} variables")
+            continue
+        max_error = max(float(np.max(np.abs(e - a), initial=0)) for e, a in zip(expected, actual))
+        if max_error > tolerance:
+            differences.append(f"{name}: maximum difference {max_error:.3g}")
+    expected, actual = uninterrupted['early_stopping'], resumed['early_stopping']
+    for key in expected:
+        if isinstance(expected[key], float) and isinstance(actual[key], float):
+            if not np.isclose(expected[key], actual[key], rtol=tolerance, atol=tolerance):
+                differences.append(f"early stopping {key}: {expected[key]} != {actual[key]}")
+        elif expected[key] != actual[key]:
+            differences.append(f"early stopping {key}: {expected[key]} != {actual[key]}")
+    return differences
+
+
+@click.command()
+@click.option('--model-name', '-m', default='TCNModel', help='architecture class')
+@click.option('--epochs', type=click.IntRange(min=2), default=4, help='epochs of the whole run')
+@click.option('--resume-at', type=click.IntRange(min=1), default=2, help='epoch the run is checkpointed and resumed at')
+@click.option('--patience', type=click.IntRange(min=1), default=3, help='patience of early stopping on val_loss')
+@click.option('--tolerance', type=float, default=1e-4, help='largest difference allowed between the runs')
+@click.option('--interrupt', type=click.Choice(INTERRUPTIONS), default='none',
+              help='preempt the checkpointed run while it saves the checkpoint after --resume-at')
+@click.option('--num-channels', '-nc', type=int, default=4)
+@click.option('--num-timesteps', '-t', type=int, default=64)
+@click.option('--num-classes', type=int, default=4)
+@click.option('--num-spectra', type=int, default=160, help='training (and test) spectra')
+@click.option('--batch-size', '-bs', type=int, default=16)
+@click.option('--seed', type=int, default=42)
+def main(model_name, epochs, resume_at, patience, tolerance, interrupt, num_channels, num_timesteps, num_classes, num_spectra,
+         batch_size, seed):
+    if resume_at >= epochs - (interrupt != 'none'):
+        raise click.BadParameter('must be lower than --epochs (minus 1 with --interrupt)', param_hint='--resume-at')
+
+    tf.config.experimental.enable_op_determinism()
+    model_class = get_model_classes()[model_name]
+    X, y = get_data(num_spectra, num_timesteps, num_channels, num_classes, seed)
+
+    def fit(model, num_epochs, callbacks, initial_epoch=0):
+        model.fit(X, y, X, y, batch_size=batch_size, epochs=num_epochs, compile_dict=model.compile_dict or COMPILE_DICT,
+                  preprocessor=EpochFlow(), callbacks=callbacks, initial_epoch=initial_epoch)
+
+    print(f"Training {model_name} {epochs} epochs without interruption")
+    model = build_model(model_class, num_channels, num_timesteps, num_classes, seed)
+    early_stopping = EarlyStopping(patience=patience)
+    fit(model, epochs, [early_stopping])
+    uninterrupted = get_state(model, early_stopping)
+    model.dispose()
+
+    result_dir = tempfile.mkdtemp()
+    try:
+        model = build_model(model_class, num_channels, num_timesteps, num_classes, seed)
+        early_stopping = EarlyStopping(patience=patience)
+        checkpoint = Checkpoint(model, os.path.join(result_dir, RUN_DIRNAME), model_name, DATASET_NAME,
+                                every=resume_at, settings={'batch_size': batch_size}, early_stopping=early_stopping)
+        if interrupt == 'none':
+            print(f"Training {model_name} {resume_at} epochs with a checkpoint")
+            fit(model, resume_at, [early_stopping, checkpoint])
+        else:
+            print(f"Training {model_name} {resume_at + 1} epochs with checkpoints, preempted during the last save")
+            checkpoint.every = 1
+            save_checkpoint = checkpoint.save
+            staging, commit = checkpoints.stage_checkpoint, checkpoints.commit_checkpoint
+            interrupters = (interrupt_staging, commit) if interrupt == 'staging' else (staging, interrupt_commit)
+
+            def preempted_save():
+                if checkpoint.run_epoch == resume_at + 1:
+                    checkpoints.stage_checkpoint, checkpoints.commit_checkpoint = interrupters
+                save_checkpoint()
+
+            checkpoint.save = preempted_save
+            try:
+                fit(model, resume_at + 1, [early_stopping, checkpoint])
+                raise click.ClickException(f"Early stopping stopped the run before the save of epoch {resume_at + 1}")
+            except Preempted:
+                pass
+            finally:
+                checkpoints.stage_checkpoint, checkpoints.commit_checkpoint = staging, commit
+        model.dispose()
+
+        checkpoint_config = read_checkpoint(os.path.join(result_dir, RUN_DIRNAME))
+        run_epoch = resume_at + (interrupt == 'commit')
+        if checkpoint_config is None or checkpoint_config['run_epoch'] != run_epoch:
+            raise click.ClickException(f"The checkpoint is of epoch "
+                                       f"{None if checkpoint_config is None else checkpoint_config['run_epoch']}, "
+                                       f"expected {run_epoch}")
+        staged = [name for name in os.listdir(os.path.join(result_dir, RUN_DIRNAME)) if checkpoints.STAGED_SUFFIX in name]
+        if staged:
+            raise click.ClickException(f"Staged files left after reading the checkpoint: {staged}")
+        print(f"Resuming {model_name} at epoch {checkpoint_config['run_epoch']} up to {epochs}")
+        model = build_model(model_class, num_channels, num_timesteps, num_classes, seed + 1)
+        model.persist(RUN_DIRNAME, result_dir=result_dir)
+        early_stopping = load_early_stopping(os.path.join(result_dir, RUN_DIRNAME), checkpoint_config)
+        resumed_epochs = []
+        record_epochs = tf.keras.callbacks.LambdaCallback(on_epoch_end=lambda epoch, logs: resumed_epochs.append(epoch))
+        fit(model, epochs, [early_stopping, record_epochs], initial_epoch=checkpoint_config['run_epoch'])
+        resumed = get_state(model, early_stopping)
+        model.dispose()
+    finally:
+        shutil.rmtree(result_dir, ignore_errors=True)
+
+    differences = compare_states(uninterrupted, resumed, tolerance)
+    expected_epochs = list(range(run_epoch, epochs))[:len(resumed_epochs)]
+    if resumed_epochs != expected_epochs:
+        differences.append(f"resumed epochs: {resumed_epochs} != {expected_epochs}")
+    print(f"Epochs: {uninterrupted['epochs']} uninterrupted, {resumed['epochs']} resumed (trained at {resumed_epochs})")
+    print(f"val_loss: {uninterrupted['history']['val_loss']} uninterrupted, {resumed['history']['val_loss']} resumed")
+    print(f"Early stopping: {uninterrupted['early_stopping']} uninterrupted, {resumed['early_stopping']} resumed")
+    if differences:
+        raise click.ClickException("The resumed run differs from the uninterrupted run:\n" + "\n".join(differences))
+    print("The resumed run matches the uninterrupted run")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+from utils import *
+from models.serving import DEFAULT_PORT, InferenceClient, get_percentiles
+from concurrent.futures import ThreadPoolExecutor
+import click
+import json
+import time
+import numpy as np
+
+
+"""
+Load test of a running inference server (`run_train.py serve`): concurrent clients send random spectra of the shape
+the served run takes, and the client-side latency and throughput are printed with the server's metrics (batch sizes,
+queueing and inference times). Compare `--concurrency 1` with higher values to see the effect of batching.
+Use:
+   > 'python -m models.benchmarks.serving_load --help'
+   > 'python -m models.benchmarks.serving_load --concurrency 16 --num-requests 2000'
+"""
+
+
+@click.command()
+@click.option('--url', default=f"http://127.0.0.1:{DEFAULT_PORT}", help='address of the server')
+@click.option('--model', default=None, help='served run, required if the server serves several')
+@click.option('--concurrency', '-c', type=click.IntRange(min=1), default=8, help='number of concurrent clients')
+@click.option('--num-requests', '-n', type=click.IntRange(min=1), default=1000)
+@click.option('--spectra-per-request', type=click.IntRange(min=1), default=1)
+def main(url, model, concurrency, num_requests, spectra_per_request):
+    client = InferenceClient(url)
+    if not client.is_healthy():
+        raise click.ClickException(f"No inference server at {url}")
+    models = client.get_models()
+    info = models[model] if model is not None else next(iter(models.values()))
+    shape = (spectra_per_request, info['num_channels'], info['source_num_timesteps'])
+    spectra = np.random.rand(*shape).astype('float32')
+    metrics_before = client.get_metrics()['models']
+
+    def send(_):
+        start = time.perf_counter()
+        client.predict(spectra, model=model)
+        return 1000 * (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        latencies = list(executor.map(send, range(num_requests)))
+    seconds = time.perf_counter() - start
+
+    print(f"{num_requests} requests of {spectra_per_request} spectra from {concurrency} clients in {seconds:.2f} s: "
+          f"{num_requests / seconds:.0f} requests/s, {num_requests * spectra_per_request / seconds:.0f} spectra/s")
+    print(f"Client latency (ms): {get_percentiles(latencies)}")
+    for name, metrics in client.get_metrics()['models'].items():
+        batches = metrics['batches'] - metrics_before[name]['batches']
+        if batches:
+            print(f"{name}: {json.dumps(metrics, indent=4)}")
+
+
+if __name__ == '__main__':
+    main()
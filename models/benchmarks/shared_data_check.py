@@ -0,0 +1,114 @@
+from utils import *
+from models.shared_data import SHARED_DATA_DIR, SharedDataRegistry
+import click
+import multiprocessing
+import shutil
+import tempfile
+import numpy as np
+
+
+"""
+Check of the lifetime of the arrays of SharedDataRegistry across processes. Two processes attach to the same key, the
+first one loading the arrays and the second one mapping them, then the first one releases the key and the second one
+exits without releasing it (as a killed process would). The check fails (exit code 1) if the arrays are loaded twice,
+removed while a running process refers to them, or left behind by `prune` once no running process does. The registry
+lives in a temporary directory next to SHARED_DATA_DIR, so it runs in shared memory without touching the arrays of
+other runs.
+Use:
+   > 'python -m models.benchmarks.shared_data_check --help'
+   > 'python -m models.benchmarks.shared_data_check --num-mib 64'
+"""
+
+
+KEY = "shared_data_check"
+TIMEOUT_SECONDS = 60
+
+
+def get_arrays(num_mib, seed):
+    return {'X': np.random.RandomState(seed).rand(num_mib * 2 ** 17), 'y': np.arange(100)}
+
+
+def attach_process(root, num_mib, seed, load, attached, done, release):
+    """
+    Attach to KEY, report the pid and a checksum of the arrays, wait for `done`, then release KEY or exit without
+    releasing it.
+    """
+    def load_func():
+        if not load:
+            raise RuntimeError("Loaded the arrays again instead of mapping those of the other process")
+        return get_arrays(num_mib, seed)
+
+    registry = SharedDataRegistry(root)
+    try:
+        arrays = registry.attach(KEY, load_func)
+        attached.put((os.getpid(), float(arrays['X'].sum()), None))
+    except Exception as e:
+        attached.put((os.getpid(), None, str(e)))
+        return
+    done.wait(TIMEOUT_SECONDS)
+    if release:
+        registry.release(KEY)
+    else:
+        os._exit(0)
+
+
+@click.command()
+@click.option('--num-mib', type=click.IntRange(min=1), default=16, help='size of the shared array')
+@click.option('--seed', type=int, default=42)
+def main(num_mib, seed):
+    root = tempfile.mkdtemp(prefix="shared_data_check-", dir=os.path.dirname(SHARED_DATA_DIR))
+    registry = SharedDataRegistry(root)
+    entry_dir = registry.get_entry_dir(KEY)
+    failures = []
+
+    def check(condition, message):
+        print(f"{'ok' if condition else 'FAILED'}: {message}")
+        if not condition:
+            failures.append(message)
+
+    context = multiprocessing.get_context('spawn')
+    attached = context.Queue()
+    first_done, second_done = context.Event(), context.Event()
+    first = context.Process(target=attach_process, args=(root, num_mib, seed, True, attached, first_done, True))
+    second = context.Process(target=attach_process, args=(root, num_mib, seed, False, attached, second_done, False))
+    try:
+        # The second process attaches once the arrays of the first one are published, so it must map them
+        first.start()
+        reports = [attached.get(timeout=TIMEOUT_SECONDS)]
+        second.start()
+        reports.append(attached.get(timeout=TIMEOUT_SECONDS))
+        errors = [error for _, _, error in reports if error is not None]
+        check(not errors, "both processes attached" + "".join(f": {error}" for error in errors))
+        expected = float(get_arrays(num_mib, seed)['X'].sum())
+        check(all(checksum == expected for _, checksum, _ in reports), "both processes see the arrays")
+        check(sorted(registry.get_references(KEY)) == sorted([first.pid, second.pid]),
+              "both processes hold a reference")
+
+        first_done.set()
+        first.join(TIMEOUT_SECONDS)
+        check(first.exitcode == 0 and os.path.isdir(entry_dir),
+              "the arrays are kept when the first process releases them, the second one refers to them")
+        registry.prune()
+        check(os.path.isdir(entry_dir), "prune keeps the arrays while the second process runs")
+
+        second_done.set()
+        second.join(TIMEOUT_SECONDS)
+        check(second.exitcode == 0 and os.path.isdir(entry_dir),
+              "the arrays are left behind when the second process exits without releasing them")
+        registry.prune()
+        check(not os.path.exists(entry_dir), "prune removes the arrays no running process refers to")
+    finally:
+        first_done.set()
+        second_done.set()
+        for process in (first, second):
+            if process.is_alive():
+                process.terminate()
+        shutil.rmtree(root, ignore_errors=True)
+
+    if failures:
+        raise click.ClickException(f"{len(failures)} shared data check(s) failed")
+    print("The shared arrays are released as expected")
+
+
+if __name__ == '__main__':
+    main()
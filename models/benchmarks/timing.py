@@ -0,0 +1,50 @@
+import time
+import numpy as np
+import tensorflow as tf
+
+
+"""
+Helpers shared by the benchmark scripts of this directory.
+"""
+
+
+def time_function(func, inputs, num_warmup=5, num_runs=50, wrap=True):
+    """
+    Time a compiled function on fixed inputs.
+
+    :param func: callable, wrapped in a tf.function
+    :param inputs: tuple of arguments
+    :param num_warmup: int number of calls before timing (tracing and first run)
+    :param num_runs: int number of timed calls
+    :param wrap: bool wrap `func` in a tf.function; False for functions that compile themselves (e.g. keras'
+                 train_on_batch)
+    :return: dict mean, median and p90 time per call in milliseconds
+    """
+    compiled = tf.function(func) if wrap else func
+    for _ in range(num_warmup):
+        _sync(compiled(*inputs))
+
+    times = []
+    for _ in range(num_runs):
+        start = time.perf_counter()
+        _sync(compiled(*inputs))
+        times.append((time.perf_counter() - start) * 1000)
+
+    times = np.array(times)
+    return {'mean_ms': float(times.mean()), 'median_ms': float(np.median(times)),
+            'p90_ms': float(np.quantile(times, 0.9))}
+
+
+def _sync(outputs):
+    """Wait for the outputs to be computed."""
+    for output in tf.nest.flatten(outputs):
+        if tf.is_tensor(output):
+            output.numpy()
+
+
+def format_row(name, timing):
+    return f"{name:48} {timing['mean_ms']:10.3f} {timing['median_ms']:10.3f} {timing['p90_ms']:10.3f}"
+
+
+def format_header():
+    return f"{'':48} {'mean ms':>10} {'median ms':>10} {'p90 ms':>10}"
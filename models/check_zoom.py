@@ -0,0 +1,65 @@
+from utils import *
+from datagen.spectra_loader import SpectraLoader
+from datagen.dataset_view import get_spectra_loader
+from models.spectra_transforms import ZoomTransform, get_peak_width_profile
+import click
+import json
+import numpy as np
+
+
+"""
+Compare a dataset zoomed with ZoomTransform against a dataset generated directly with the target gamma_amp_factor.
+Use:
+   > 'python -m models.check_zoom --help'
+"""
+
+
+def summarize(dm, n):
+    """
+    Statistics used to compare two datasets.
+
+    :param dm: np.array of shape (num_instances, num_channels, num_timesteps)
+    :param n: np.array number of peaks per spectrum
+    :return: dict
+    """
+    widths = get_peak_width_profile(dm)
+    labels, counts = np.unique(n, return_counts=True)
+    return {'num_instances': int(len(dm)),
+            'num_timesteps': int(dm.shape[2]),
+            'label_distribution': {str(int(label)): float(count / len(n)) for label, count in zip(labels, counts)},
+            'width_mean': float(widths.mean()),
+            'width_quantiles': [float(q) for q in np.quantile(widths, [0.1, 0.5, 0.9])]}
+
+
+@click.command()
+@click.option('--dataset-name', prompt='Name of dataset to zoom')
+@click.option('--reference-name', prompt='Name of dataset generated with the target gamma amp factor')
+@click.option('--gamma-amp-factor', type=float, default=None,
+              help='target gamma amp factor, defaults to the one of the reference dataset')
+@click.option('--outside', type=click.Choice(ZoomTransform.OUTSIDE_POLICIES), default='relabel')
+@click.option('--subset', default=TEST_DATASET_PREFIX, help='subset of both datasets to compare')
+def main(dataset_name, reference_name, gamma_amp_factor, outside, subset):
+    reference_config = SpectraLoader.read_dataset_config(reference_name)
+    if gamma_amp_factor is None:
+        gamma_amp_factor = reference_config['gamma_amp_factor']
+
+    zoom = ZoomTransform.from_dataset_config(SpectraLoader.read_dataset_config(dataset_name), gamma_amp_factor,
+                                             outside=outside)
+    print(f"Zooming {dataset_name} with {zoom}")
+
+    loader = get_spectra_loader(dataset_name=dataset_name, subset_prefix=subset)
+    dm_zoomed, n_zoomed, _, _ = zoom.transform(np.array(loader.get_dm()), loader.get_peak_locations(),
+                                               np.array(loader.get_n()))
+
+    reference_loader = get_spectra_loader(dataset_name=reference_name, subset_prefix=subset)
+    report = {'zoom': zoom.serialize(),
+              'zoomed': summarize(dm_zoomed, n_zoomed),
+              'reference': summarize(np.array(reference_loader.get_dm()), np.array(reference_loader.get_n()))}
+
+    print(json.dumps(report, indent=4))
+    if report['zoomed']['num_timesteps'] != report['reference']['num_timesteps']:
+        print("Warning: zoomed and reference datasets have a different number of timesteps.")
+
+
+if __name__ == '__main__':
+    main()
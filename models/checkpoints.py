@@ -0,0 +1,313 @@
+from utils import *
+from models.hpo import get_score
+from tensorflow.keras.callbacks import Callback
+import json
+import numpy as np
+
+
+"""
+Epoch-level checkpoints of a training run, to resume runs that were interrupted (e.g. on preemptible nodes).
+
+A checkpoint is written to the run's results directory with the layout of `BaseModel.save`, weights.h5 and info.json
+(history and epochs so far), so it can be continued or evaluated like a finished run. Next to them:
+ - optimizer.npz: the variables of the optimizer (iteration count, moments), restored with the weights
+ - checkpoint.json: the epoch of the run, the settings needed to resume it and the state of early stopping
+ - best_weights.npz: the best weights seen by early stopping, when it restores them
+Every file of a checkpoint is first written under a staged name (`weights.tmp.h5`...), checkpoint.json last, then they
+are moved in place, checkpoint.json last. A save interrupted while staging leaves the previous checkpoint, one
+interrupted while moving the files is completed by `read_checkpoint`, so the files of a run always belong to the epoch
+of its checkpoint.json.
+"""
+
+
+CHECKPOINT_FILENAME = "checkpoint.json"
+OPTIMIZER_FILENAME = "optimizer.npz"
+BEST_WEIGHTS_FILENAME = "best_weights.npz"
+STAGED_SUFFIX = ".tmp"
+# Moved in place in this order when a checkpoint is committed, checkpoint.json last
+CHECKPOINT_FILES = (WEIGHTS_FILENAME, TRAIN_INFO_FILENAME, OPTIMIZER_FILENAME, BEST_WEIGHTS_FILENAME,
+                    CHECKPOINT_FILENAME)
+
+
+def get_staged_path(path):
+    """
+    :param path: str path of a checkpoint file
+    :return: str path it is written to before it replaces `path`, with the same extension, which keras and numpy read
+             the format from
+    """
+    root, extension = os.path.splitext(path)
+    return root + STAGED_SUFFIX + extension
+
+
+def get_optimizer_variables(keras_model):
+    """
+    :param keras_model: compiled keras model
+    :return: list of the optimizer's variables, created if the model was not trained yet
+    """
+    optimizer = keras_model.optimizer
+    optimizer.build(keras_model.trainable_variables)
+    variables = optimizer.variables
+    # `variables` is a method of tf.keras 2 optimizers and a property of Keras 3 optimizers
+    return list(variables() if callable(variables) else variables)
+
+
+def save_arrays(arrays, path):
+    np.savez(path, *arrays)
+
+
+def load_arrays(path):
+    with np.load(path) as stored:
+        return [stored[f"arr_{i}"] for i in range(len(stored.files))]
+
+
+def save_optimizer_state(keras_model, path):
+    save_arrays([variable.numpy() for variable in get_optimizer_variables(keras_model)], path)
+
+
+def load_optimizer_state(keras_model, path):
+    """
+    Restore the optimizer variables saved by `save_optimizer_state`, e.g. after the weights were loaded.
+
+    :param keras_model: compiled keras model of the same architecture and optimizer
+    :param path: str path of the saved state
+    :return: None
+    """
+    variables = get_optimizer_variables(keras_model)
+    values = load_arrays(path)
+    if len(values) != len(variables):
+        raise ValueError(f"The optimizer state in {path} has {len(values)} variables, the optimizer has "
+                         f"{len(variables)}. Was the run trained with another optimizer?")
+    for variable, value in zip(variables, values):
+        variable.assign(value)
+
+
+def read_checkpoint(result_dir):
+    """
+    :param result_dir: str results directory of a run
+    :return: dict content of checkpoint.json, None if the run has no checkpoint
+    """
+    recover_checkpoint(result_dir)
+    path = os.path.join(result_dir, CHECKPOINT_FILENAME)
+    if not os.path.exists(path):
+        return None
+    return json.load(open(path, "r"))
+
+
+def stage_checkpoint(result_dir, checkpoint):
+    """
+    Stage checkpoint.json, once the other files of the checkpoint are staged. Its staged file appears at once, so its
+    presence means the whole checkpoint is staged.
+
+    :param result_dir: str results directory of the run
+    :param checkpoint: dict content of checkpoint.json
+    :return: None
+    """
+    staged_path = get_staged_path(os.path.join(result_dir, CHECKPOINT_FILENAME))
+    json.dump(checkpoint, open(staged_path + ".part", "w"), indent=4)
+    os.replace(staged_path + ".part", staged_path)
+
+
+def commit_checkpoint(result_dir):
+    """
+    Move the staged files of a checkpoint in place, checkpoint.json last.
+
+    :param result_dir: str results directory of the run
+    :return: None
+    """
+    for filename in CHECKPOINT_FILES:
+        staged_path = get_staged_path(os.path.join(result_dir, filename))
+        if os.path.exists(staged_path):
+            os.replace(staged_path, os.path.join(result_dir, filename))
+
+
+def recover_checkpoint(result_dir):
+    """
+    Finish or undo a checkpoint save that was interrupted: a fully staged checkpoint is committed, the files of one
+    that was being staged are deleted.
+
+    :param result_dir: str results directory of the run
+    :return: None
+    """
+    if os.path.exists(get_staged_path(os.path.join(result_dir, CHECKPOINT_FILENAME))):
+        commit_checkpoint(result_dir)
+        return
+    for filename in CHECKPOINT_FILES:
+        staged_path = get_staged_path(os.path.join(result_dir, filename))
+        for path in (staged_path, staged_path + ".part"):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def load_early_stopping(result_dir, checkpoint):
+    """
+    :param result_dir: str results directory of a checkpointed run
+    :param checkpoint: dict content of its checkpoint.json
+    :return: EarlyStopping of the run in the state of the checkpoint, or None if the run does not stop early
+    """
+    best_weights_path = os.path.join(result_dir, BEST_WEIGHTS_FILENAME)
+    best_weights = load_arrays(best_weights_path) if os.path.exists(best_weights_path) else None
+    return EarlyStopping.from_config(checkpoint.get('early_stopping'), best_weights=best_weights)
+
+
+class EarlyStopping(Callback):
+    """
+    Stops training when the monitored metric has not improved for `patience` epochs and, with `restore_best_weights`,
+    sets the best weights back at the end of training (whether it stopped early or not). Its state is serialized with
+    the checkpoints, so a resumed run stops as the uninterrupted run would have.
+    """
+
+    def __init__(self, monitor='val_loss', mode='min', patience=5, min_delta=0.0, restore_best_weights=True,
+                 best=float('inf'), best_epoch=None, wait=0, stopped_epoch=None, best_weights=None):
+        """
+        :param monitor: str name of the metric in the epoch logs
+        :param mode: str 'min' or 'max'
+        :param patience: int number of epochs without improvement before stopping
+        :param min_delta: float minimum improvement
+        :param restore_best_weights: bool
+        :param best: float best score so far (lower is better), when resuming
+        :param best_epoch: int epoch of the best score, when resuming
+        :param wait: int number of epochs without improvement, when resuming
+        :param stopped_epoch: int epoch training was stopped at
+        :param best_weights: optional list of np.array weights of the best epoch, when resuming
+        """
+        super(EarlyStopping, self).__init__()
+        self.monitor = monitor
+        self.mode = mode
+        self.patience = int(patience)
+        self.min_delta = float(min_delta)
+        self.restore_best_weights = restore_best_weights
+        self.best = float(best)
+        self.best_epoch = best_epoch
+        self.wait = int(wait)
+        self.stopped_epoch = stopped_epoch
+        self.best_weights = best_weights
+        self.last_epoch = None
+
+    def on_epoch_end(self, epoch, logs=None):
+        self.last_epoch = epoch + 1
+        logs = logs or {}
+        if self.monitor not in logs:
+            raise ValueError(f"Early stopping monitors {self.monitor}, which is not in the epoch logs (available: "
+                             f"{', '.join(sorted(logs))})")
+        score = get_score(logs[self.monitor], self.mode)
+        if score < self.best - self.min_delta:
+            self.best = score
+            self.best_epoch = epoch + 1
+            self.wait = 0
+            if self.restore_best_weights:
+                self.best_weights = self.model.get_weights()
+        else:
+            self.wait += 1
+            if self.wait >= self.patience:
+                self.stopped_epoch = epoch + 1
+                self.model.stop_training = True
+                print(f"Early stopping at epoch {epoch + 1}: {self.monitor} did not improve for {self.patience} epochs")
+
+    def on_train_end(self, logs=None):
+        if self.restore_best_weights and self.best_weights is not None and self.best_epoch != self.last_epoch:
+            print(f"Restoring the weights of epoch {self.best_epoch}")
+            self.model.set_weights(self.best_weights)
+
+    def serialize(self):
+        """
+        :return: dict that can be passed to `EarlyStopping.from_config`, with the best weights.
+        """
+        return {'monitor': self.monitor, 'mode': self.mode, 'patience': self.patience, 'min_delta': self.min_delta,
+                'restore_best_weights': self.restore_best_weights, 'best': self.best, 'best_epoch': self.best_epoch,
+                'wait': self.wait, 'stopped_epoch': self.stopped_epoch}
+
+    @staticmethod
+    def from_config(config, best_weights=None):
+        """
+        :param config: dict produced by `serialize`, or None.
+        :param best_weights: optional list of np.array weights of the best epoch
+        :return: EarlyStopping or None
+        """
+        if not config:
+            return None
+        return EarlyStopping(**config, best_weights=best_weights)
+
+
+class Checkpoint(Callback):
+    """
+    Saves the run every `every` epochs: weights.h5 and info.json of `BaseModel.save`, the optimizer state and
+    checkpoint.json. Call `complete` once the finished run is saved.
+    """
+
+    def __init__(self, model, save_dir, class_name, dataset_name, every=1, settings=None, early_stopping=None):
+        """
+        :param model: BaseModel being trained
+        :param save_dir: str results directory of the run
+        :param class_name: str name of the model class
+        :param dataset_name: str
+        :param every: int number of epochs between checkpoints
+        :param settings: dict settings needed to resume the run (see `run_train.py resume`), saved in checkpoint.json
+        :param early_stopping: optional EarlyStopping of the run, listed before this callback
+        """
+        super(Checkpoint, self).__init__()
+        self.base_model = model
+        self.save_dir = save_dir
+        self.class_name = class_name
+        self.dataset_name = dataset_name
+        self.every = every
+        self.settings = settings or {}
+        self.early_stopping = early_stopping
+        self.history = {}
+        self.run_epoch = None
+
+    def on_train_begin(self, logs=None):
+        self.history = {}
+
+    def on_epoch_end(self, epoch, logs=None):
+        self.run_epoch = epoch + 1
+        for key, value in (logs or {}).items():
+            self.history.setdefault(key, []).append(float(round(value, 5)))
+        # The run is saved when training ends, so the epoch early stopping stopped at is not checkpointed
+        stopping = self.early_stopping is not None and self.early_stopping.stopped_epoch == epoch + 1
+        if (epoch + 1) % self.every == 0 and not stopping:
+            self.save()
+
+    def save(self):
+        """
+        Checkpoint the epochs trained so far.
+
+        :return: None
+        """
+        base_model = self.base_model
+        num_epochs = len(next(iter(self.history.values()), []))
+        base_model.save(self.class_name, self.dataset_name, save_dir=self.save_dir, staged=True,
+                        info={'batch_size': self.settings.get('batch_size', base_model.batch_size),
+                              'epochs': base_model.epochs + num_epochs,
+                              'history': base_model._merge_histories(base_model.history, self.history)})
+        self.write(complete=False)
+        print(f"Saved checkpoint of epoch {self.run_epoch} to {to_local_path(self.save_dir)}")
+
+    def complete(self):
+        """
+        Save the finished run to `save_dir` (with `BaseModel.save`) and mark it complete. The optimizer state is saved
+        with it, so `continue` carries on with it.
+
+        :return: str directory of the saved run
+        """
+        self.base_model.save(self.class_name, self.dataset_name, save_dir=self.save_dir, staged=True)
+        self.write(complete=True)
+        return self.save_dir
+
+    def write(self, complete):
+        """
+        Stage the optimizer state, the early stopping state and checkpoint.json next to the staged weights and info.json
+        of the run, and commit them together.
+
+        :param complete: bool the run is finished
+        :return: None
+        """
+        save_optimizer_state(self.base_model.keras_model,
+                             get_staged_path(os.path.join(self.save_dir, OPTIMIZER_FILENAME)))
+        checkpoint = dict(self.settings, run_epoch=self.run_epoch, complete=complete)
+        if self.early_stopping is not None:
+            checkpoint['early_stopping'] = self.early_stopping.serialize()
+            if self.early_stopping.best_weights is not None:
+                save_arrays(self.early_stopping.best_weights,
+                            get_staged_path(os.path.join(self.save_dir, BEST_WEIGHTS_FILENAME)))
+        stage_checkpoint(self.save_dir, checkpoint)
+        commit_checkpoint(self.save_dir)
@@ -0,0 +1,195 @@
+from utils import *
+import contextlib
+from importlib import metadata
+import itertools
+import json
+import socket
+import subprocess
+import sys
+import time
+import click
+import tensorflow as tf
+
+
+"""
+Data-parallel training with tf.distribute. Every worker process holds a replica of the model and reads its own share of
+the training data in batches of `batch_size`, gradients are all-reduced after every batch, so a global batch is
+`batch_size * num_workers` spectra.
+
+Workers find each other through the TF_CONFIG environment variable. To train on several nodes, set it on every node
+(https://www.tensorflow.org/guide/distributed_training#TF_CONFIG) and run the same command with
+`--distribute multi_worker`. To train with several processes on this host, use the launcher:
+   > 'python -m models.distributed --num-workers 4 -- python3 run_train.py new --distribute multi_worker ...'
+"""
+
+
+STRATEGIES = ('none', 'multi_worker')
+
+
+def uses_keras_3():
+    """
+    :return: bool True if tf.keras is Keras 3, the default from TensorFlow 2.16 unless TF_USE_LEGACY_KERAS=1
+    """
+    if os.environ.get('TF_USE_LEGACY_KERAS') in ('true', 'True', '1'):
+        return False
+    # Otherwise tf.keras is the installed keras package: Keras 3 from TensorFlow 2.16, the Keras 2 of TensorFlow before
+    try:
+        return metadata.version('keras').startswith('3')
+    except metadata.PackageNotFoundError:
+        return False
+
+
+def get_strategy(name):
+    """
+    Create the distribution strategy. It must be created before any other TensorFlow operation of the process.
+
+    :param name: str one of STRATEGIES
+    :return: tf.distribute.Strategy, or None for 'none'
+    """
+    if name == 'none':
+        return None
+    if name == 'multi_worker':
+        if uses_keras_3():
+            # Keras 3 models do not support the strategy in `fit`, they fail after the workers have connected
+            raise click.ClickException("Multi-worker training needs tf.keras 2, but tf.keras is Keras 3: install "
+                                       "tf-keras (see requirements.txt) and set TF_USE_LEGACY_KERAS=1 on every "
+                                       "worker")
+        return tf.distribute.MultiWorkerMirroredStrategy()
+    raise ValueError(f"Unknown distribution strategy '{name}', expected one of {STRATEGIES}")
+
+
+def get_scope(strategy):
+    """
+    :param strategy: tf.distribute.Strategy or None
+    :return: context manager in which models are built and compiled
+    """
+    return contextlib.nullcontext() if strategy is None else strategy.scope()
+
+
+def get_worker_shard():
+    """
+    :return: (index of this worker, number of workers) from TF_CONFIG, (0, 1) outside of a cluster
+    """
+    tf_config = json.loads(os.environ.get('TF_CONFIG', '{}'))
+    workers = tf_config.get('cluster', {}).get('worker', [])
+    if not workers:
+        return 0, 1
+    return int(tf_config['task']['index']), len(workers)
+
+
+def is_chief():
+    """The first worker saves the results of a distributed run."""
+    return get_worker_shard()[0] == 0
+
+
+def distribute_generator(strategy, generator):
+    """
+    :param strategy: tf.distribute.Strategy
+    :param generator: endless generator of (X_batch, y_batch) that only yields the batches of this worker
+    :return: distributed dataset of the batches, every batch goes to the replica of this worker as it is
+    """
+    first = next(generator)
+    signature = tuple(tf.TensorSpec((None,) + array.shape[1:], tf.as_dtype(array.dtype)) for array in first)
+
+    def dataset_fn(input_context):
+        return tf.data.Dataset.from_generator(lambda: itertools.chain([first], generator), output_signature=signature)
+    return strategy.distribute_datasets_from_function(dataset_fn)
+
+
+def distribute_arrays(strategy, X, y, batch_size, seed=42):
+    """
+    :param strategy: tf.distribute.Strategy
+    :param X: np.array training spectra
+    :param y: np.array one-hot labels
+    :param batch_size: int batch size of every replica
+    :param seed: int seed of the shuffling
+    :return: endless distributed dataset of shuffled batches, every worker trains on every `num_workers`-th record
+    """
+    def dataset_fn(input_context):
+        index, count = input_context.input_pipeline_id, input_context.num_input_pipelines
+        dataset = tf.data.Dataset.from_tensor_slices((X[index::count], y[index::count]))
+        return dataset.shuffle(len(X[index::count]), seed=seed).batch(batch_size, drop_remainder=True).repeat()
+    return strategy.distribute_datasets_from_function(dataset_fn)
+
+
+def sync_replica_variables(strategy, model):
+    """
+    Replicas keep their own copy of ON_READ variables (the moving statistics of BatchNormalization) and evaluate with
+    it, while saving writes their mean: every replica takes the mean so that the model evaluated is the one saved.
+    All workers must call it.
+
+    :param strategy: tf.distribute.Strategy the model was built in
+    :param model: tf.keras.Model
+    :return: None
+    """
+    with strategy.scope():
+        for variable in model.variables:
+            if variable.synchronization == tf.VariableSynchronization.ON_READ:
+                variable.assign(variable.read_value())
+
+
+def get_free_ports(num_ports):
+    """
+    :param num_ports: int
+    :return: list of int ports that were free on localhost
+    """
+    sockets = [socket.socket() for _ in range(num_ports)]
+    for s in sockets:
+        s.bind(('localhost', 0))
+    ports = [s.getsockname()[1] for s in sockets]
+    for s in sockets:
+        s.close()
+    return ports
+
+
+def make_tf_config(worker_addresses, index):
+    """
+    :param worker_addresses: list of str 'host:port' of all workers
+    :param index: int index of the worker in `worker_addresses`
+    :return: str TF_CONFIG of the worker
+    """
+    return json.dumps({'cluster': {'worker': list(worker_addresses)}, 'task': {'type': 'worker', 'index': index}})
+
+
+def launch_local_workers(command, num_workers, ports=None, timeout=None):
+    """
+    Run a command in `num_workers` local processes forming a tf.distribute cluster, and wait for all of them.
+
+    :param command: list of str command and arguments
+    :param num_workers: int
+    :param ports: optional list of int ports of the workers, free ports by default
+    :param timeout: optional float seconds after which the workers still running are killed, e.g. when a worker failed
+                    and the others wait for it
+    :return: list of int return codes, worker 0 first (negative for killed workers)
+    """
+    ports = get_free_ports(num_workers) if ports is None else ports
+    addresses = [f"localhost:{port}" for port in ports]
+    processes = [subprocess.Popen(command, stdin=subprocess.DEVNULL,
+                                  env=dict(os.environ, TF_CONFIG=make_tf_config(addresses, i)))
+                 for i in range(num_workers)]
+    deadline = None if timeout is None else time.monotonic() + timeout
+    try:
+        for process in processes:
+            process.wait(None if deadline is None else max(0.0, deadline - time.monotonic()))
+    except subprocess.TimeoutExpired:
+        for process in processes:
+            process.kill()
+    return [process.wait() for process in processes]
+
+
+@click.command(context_settings={'ignore_unknown_options': True})
+@click.option('--num-workers', '-n', type=click.IntRange(min=1), default=2, help='number of local worker processes')
+@click.option('--port', type=int, default=None, help='port of the first worker (consecutive ports), free ports by default')
+@click.argument('command', nargs=-1, type=click.UNPROCESSED, required=True)
+def main(num_workers, port, command):
+    """Run COMMAND in several local worker processes, e.g. `python3 run_train.py new --distribute multi_worker ...`.
+    All options of the command must be given, workers cannot prompt for them."""
+    ports = None if port is None else list(range(port, port + num_workers))
+    return_codes = launch_local_workers(list(command), num_workers, ports=ports)
+    for i, code in enumerate(return_codes):
+        print(f"Worker {i} exited with code {code}")
+    sys.exit(int(any(return_codes)))
+
+
+if __name__ == '__main__':
+    main()
@@ -4,7 +4,10 @@ import matplotlib.pyplot as plt
 import seaborn as sns
 from sklearn.metrics import classification_report
 import numpy as np
+import json
 from utils import *
+from models.profiling import profile_stage
+from memory_accounting import get_memory_report
 
 
 def format_classification_report(classification_report, peak_labels):
@@ -19,22 +22,54 @@ def get_classification_report(test_formatted, preds_formatted, peak_labels):
 
 
 class EvaluationReport:
-    def __init__(self, model, spectra_preprocessor, labels=None):
+    def __init__(self, model, spectra_preprocessor, labels=None, profiler=None):
+        """
+        :param model: trained model object instance
+        :param spectra_preprocessor: SpectraPreprocessor of the test set
+        :param labels: optional list of class names
+        :param profiler: optional SamplingProfiler sampling the loading of the test set and the predictions
+        """
         self.model = model
-        self.X_test, self.y_test = spectra_preprocessor.transform_test()
-        self.test_spectra_loader = spectra_preprocessor.test_spectra_loader
-        self.peak_locs = self.test_spectra_loader.get_peak_locations()
+        with profile_stage(profiler, "load_test_set"):
+            self.X_test, self.y_test = spectra_preprocessor.transform_test()
+            self.source_indices = spectra_preprocessor.test_source_indices
+            self.test_spectra_loader = spectra_preprocessor.test_spectra_loader
+            self.peak_locs = self.test_spectra_loader.get_peak_locations()
         self.labels = labels
         if self.labels is None:
             self.labels = [i + 1 for i in range(self.y_test.shape[1])]
         self.numeric_labels = [i + 1 for i in range(self.y_test.shape[1])]
-        self.probs = self.model.keras_model.predict_proba(self.X_test)
+        with profile_stage(profiler, "predict"):
+            self.probs = self.model.get_preds(self.X_test)
         self.preds = self.probs.argmax(axis=1) + 1
         self.y_true_num = self.y_test.argmax(axis=1) + 1
+        self.timestep_transform = spectra_preprocessor.timestep_transform
+        self.zoom_transform = spectra_preprocessor.zoom_transform
 
     def get_eval_classification_report(self):
         return get_classification_report(self.y_true_num, self.preds, self.labels)
 
+    def save_classification_report(self, directory, file_extension=None):
+        """
+        Save the classification report together with the resolution and zoom the model was evaluated at, so the
+        accuracy of runs trained on transformed spectra can be compared with full resolution runs, and the peak memory
+        of the pipeline stages when memory accounting is enabled.
+
+        :param directory: directory to save the report in
+        :param file_extension: suffix added to the file name
+        :return: path of the saved report
+        """
+        report = {'num_timesteps': self.X_test.shape[1],
+                  'timestep_transform': None if self.timestep_transform is None else self.timestep_transform.serialize(),
+                  'zoom_transform': None if self.zoom_transform is None else self.zoom_transform.serialize(),
+                  'classification_report': self.get_eval_classification_report()}
+        memory_stages = get_memory_report()
+        if memory_stages is not None:
+            report['memory_stages'] = memory_stages
+        report_path = os.path.join(directory, f'classification_report-{file_extension}.json')
+        json.dump(report, open(report_path, 'w'), indent=4)
+        return report_path
+
     def plot_roc_curves(self, figsize=(9, 7)):
         plt.figure(figsize=figsize)
         lw = 2.5
@@ -95,7 +130,7 @@ class EvaluationReport:
             self.plot_pred_prob(sample_probs, num_peaks, ax=axes[i][0], title_extension=title_extension)
 
             for l in range(num_channels):
-                self.test_spectra_loader.spectra[sample_idx].plot_channel(l, ax=axes[i][l + 1])
+                self.test_spectra_loader[int(self.source_indices[sample_idx])].plot_channel(l, ax=axes[i][l + 1])
 
         plt.subplots_adjust(hspace=0.4)
         return plt
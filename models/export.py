@@ -0,0 +1,344 @@
+from utils import *
+from models.benchmarks.timing import time_function
+from models.spectra_transforms import TimestepTransform, ZoomTransform, dm_to_model_input
+import json
+import time
+import numpy as np
+import tensorflow as tf
+
+
+"""
+Self-contained inference artifacts of trained runs, for CPU inference nodes that should not rebuild the model classes.
+`export_run` writes to `<run>/export/`:
+ - saved_model/: a TensorFlow SavedModel with a `serving_default` signature taking float32 spectra
+   (batch, timesteps, channels) and returning the class probabilities
+ - model_<quantization>.tflite: TFLite models, `float32` (no quantization), `dynamic` (post-training dynamic-range
+   quantization: int8 weights, float activations) and `int8` (int8 weights and activations, calibrated on a sample of
+   training spectra; float32 input and output, ops without an int8 kernel stay in float)
+ - export.json: what is needed to feed the models (shape, timestep and zoom transforms, labels) and the report comparing
+   the accuracy, latency and size of every artifact with the float Keras model
+"""
+
+
+EXPORT_DIRNAME = "export"
+SAVED_MODEL_DIRNAME = "saved_model"
+EXPORT_INFO_FILENAME = "export.json"
+SIGNATURE_KEY = "serving_default"
+INPUT_NAME = "spectra"
+QUANTIZATIONS = ('float32', 'dynamic', 'int8')
+SAVED_MODEL = "saved_model"
+
+
+def use_cpu_only(num_threads=None):
+    """
+    Hide the GPUs from TensorFlow, so latencies are those of CPU inference nodes. Call before running any op.
+
+    :param num_threads: int intra-op threads of TensorFlow, None for all cores
+    :return: None
+    """
+    tf.config.set_visible_devices([], 'GPU')
+    if num_threads is not None:
+        tf.config.threading.set_intra_op_parallelism_threads(num_threads)
+
+
+def get_tflite_filename(quantization):
+    return f"model_{quantization}.tflite"
+
+
+def export_saved_model(keras_model, path, num_timesteps, num_channels):
+    """
+    Save the inference function of a keras model, without its training configuration.
+
+    :param keras_model: trained keras model
+    :param path: str directory of the SavedModel
+    :param num_timesteps: int
+    :param num_channels: int
+    :return: str path
+    """
+    serve = tf.function(lambda spectra: {'probabilities': keras_model(spectra, training=False)},
+                        input_signature=[tf.TensorSpec([None, num_timesteps, num_channels], tf.float32,
+                                                       name=INPUT_NAME)])
+    module = tf.Module()
+    module.model = keras_model
+    module.serve = serve
+    tf.saved_model.save(module, path, signatures={SIGNATURE_KEY: serve.get_concrete_function()})
+    return path
+
+
+def convert_tflite(saved_model_path, path, quantization='float32', calibration_X=None, batch_size=32):
+    """
+    Convert a SavedModel to TFLite.
+
+    :param saved_model_path: str directory written by `export_saved_model`
+    :param path: str path of the .tflite file
+    :param quantization: str one of QUANTIZATIONS
+    :param calibration_X: np.array spectra the int8 activation ranges are calibrated on, required for 'int8'
+    :param batch_size: int batch size of the calibration
+    :return: str path
+    """
+    converter = tf.lite.TFLiteConverter.from_saved_model(saved_model_path, signature_keys=[SIGNATURE_KEY])
+    if quantization != 'float32':
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if quantization == 'int8':
+        if calibration_X is None or len(calibration_X) == 0:
+            raise ValueError("int8 quantization needs calibration spectra")
+
+        def representative_dataset():
+            for start in range(0, len(calibration_X), batch_size):
+                yield [calibration_X[start:start + batch_size].astype(np.float32)]
+
+        converter.representative_dataset = representative_dataset
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8, tf.lite.OpsSet.TFLITE_BUILTINS]
+    with open(path, "wb") as f:
+        f.write(converter.convert())
+    return path
+
+
+def get_keras_predictor(keras_model):
+    """
+    :param keras_model: trained keras model
+    :return: callable mapping float32 model inputs to class probabilities, compiled once per input shape
+    """
+    predict = tf.function(lambda X: keras_model(X, training=False), reduce_retracing=True)
+    return lambda X: predict(X).numpy()
+
+
+class TFLitePredictor:
+    """Runs a TFLite model on batches of any size, resizing its input when the batch size changes."""
+
+    def __init__(self, path, num_threads=None):
+        """
+        :param path: str path of a .tflite model
+        :param num_threads: int threads of the interpreter, None for its default
+        """
+        self.interpreter = tf.lite.Interpreter(model_path=path, num_threads=num_threads)
+        self.input_index = self.interpreter.get_input_details()[0]['index']
+        self.output_index = self.interpreter.get_output_details()[0]['index']
+        self.batch_size = None
+
+    def __call__(self, X):
+        """
+        :param X: np.array float32 spectra (batch, timesteps, channels)
+        :return: np.array class probabilities
+        """
+        if len(X) != self.batch_size:
+            self.interpreter.resize_tensor_input(self.input_index, X.shape)
+            self.interpreter.allocate_tensors()
+            self.batch_size = len(X)
+        self.interpreter.set_tensor(self.input_index, np.ascontiguousarray(X, dtype=np.float32))
+        self.interpreter.invoke()
+        return self.interpreter.get_tensor(self.output_index)
+
+
+class SavedModelPredictor:
+    """Runs the serving signature of an exported SavedModel."""
+
+    def __init__(self, path):
+        """
+        :param path: str directory written by `export_saved_model`
+        """
+        self.saved_model = tf.saved_model.load(path)
+        self.signature = self.saved_model.signatures[SIGNATURE_KEY]
+
+    def __call__(self, X):
+        """
+        :param X: np.array float32 spectra (batch, timesteps, channels)
+        :return: np.array class probabilities
+        """
+        return self.signature(**{INPUT_NAME: tf.constant(X, dtype=tf.float32)})['probabilities'].numpy()
+
+
+def load_predictor(export_dir, model_format='int8', num_threads=None):
+    """
+    :param export_dir: str export directory of a run
+    :param model_format: str SAVED_MODEL or one of QUANTIZATIONS (a TFLite model)
+    :param num_threads: int threads of TFLite interpreters
+    :return: callable mapping float32 spectra (batch, timesteps, channels) to class probabilities
+    """
+    if model_format == SAVED_MODEL:
+        return SavedModelPredictor(os.path.join(export_dir, SAVED_MODEL_DIRNAME))
+    path = os.path.join(export_dir, get_tflite_filename(model_format))
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"{to_local_path(path)} was not exported, export it with --quantization {model_format}")
+    return TFLitePredictor(path, num_threads=num_threads)
+
+
+def read_export_info(export_dir):
+    """
+    :param export_dir: str export directory of a run
+    :return: dict content of export.json
+    """
+    with open(os.path.join(export_dir, EXPORT_INFO_FILENAME), "r") as f:
+        return json.load(f)
+
+
+def prepare_spectra(dm, num_channels, zoom_transform=None, timestep_transform=None):
+    """
+    Lay out spectra as the model of a run takes them. Unlike training, zooming keeps every spectrum, their peaks are
+    not known.
+
+    :param dm: array-like spectra (num_instances, num_channels, num_timesteps), with at least `num_channels` channels
+    :param num_channels: int number of channels the run was trained on
+    :param zoom_transform: optional ZoomTransform of the run
+    :param timestep_transform: optional TimestepTransform of the run
+    :return: np.array float32 model inputs (num_instances, timesteps, channels)
+    """
+    dm = np.asarray(dm, dtype=np.float32)
+    if dm.ndim != 3 or dm.shape[1] < num_channels:
+        raise ValueError(f"expected spectra of shape (num_spectra, >= {num_channels} channels, timesteps), "
+                         f"got {dm.shape}")
+    dm = dm[:, :num_channels, :]
+    if zoom_transform is not None:
+        dm = zoom_transform.resample(dm)
+    if timestep_transform is not None:
+        dm = timestep_transform.transform(dm)
+    return dm_to_model_input(np.ascontiguousarray(dm, dtype=np.float32))
+
+
+class ExportedModel:
+    """
+    An exported run, predicting from spectra laid out as in the datasets, (num_instances, num_channels,
+    num_timesteps): the channels the run was trained on are selected and the zoom and timestep transforms of the run
+    are applied before the model.
+    """
+
+    def __init__(self, export_dir, model_format='int8', num_threads=None):
+        """
+        :param export_dir: str export directory of a run
+        :param model_format: str SAVED_MODEL or one of QUANTIZATIONS
+        :param num_threads: int threads of TFLite interpreters
+        """
+        self.export_dir = export_dir
+        self.model_format = model_format
+        self.num_threads = num_threads
+        self.info = read_export_info(export_dir)
+        self.num_channels = self.info['num_channels']
+        self.input_shape = tuple(self.info['input_shape'][1:])
+        self.zoom_transform = ZoomTransform.from_config(self.info.get('zoom'))
+        self.timestep_transform = TimestepTransform.from_config(self.info.get('timestep_transform'))
+        self.predictor = self.new_predictor()
+
+    def new_predictor(self):
+        """
+        :return: callable mapping model inputs to class probabilities. TFLite predictors are not thread-safe, every
+                 thread predicting at once needs its own.
+        """
+        return load_predictor(self.export_dir, model_format=self.model_format, num_threads=self.num_threads)
+
+    def preprocess(self, dm):
+        """
+        :param dm: array-like spectra (num_instances, num_channels, num_timesteps), with at least the channels the
+                   run was trained on
+        :return: np.array float32 model inputs (num_instances, timesteps, channels)
+        """
+        X = prepare_spectra(dm, self.num_channels, self.zoom_transform, self.timestep_transform)
+        if X.shape[1:] != self.input_shape:
+            raise ValueError(f"spectra of {X.shape[1]} timesteps after the transforms of the run, the model takes "
+                             f"{self.input_shape[0]}")
+        return X
+
+    def predict(self, dm):
+        """
+        :param dm: spectra, see `preprocess`
+        :return: np.array class probabilities
+        """
+        return self.predictor(self.preprocess(dm))
+
+
+def predict_batches(predictor, X, batch_size=256):
+    return np.concatenate([predictor(X[start:start + batch_size]) for start in range(0, len(X), batch_size)])
+
+
+def get_size_mib(path):
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(root, name))
+                   for root, _, names in os.walk(path) for name in names) / 2 ** 20
+    return os.path.getsize(path) / 2 ** 20
+
+
+def compare_predictor(predictor, X_test, y_true, reference_preds=None, batch_size=32, num_runs=50):
+    """
+    :param predictor: callable mapping spectra to class probabilities
+    :param X_test: np.array test spectra
+    :param y_true: np.array true class indices of the test spectra
+    :param reference_preds: np.array class indices predicted by the float model, None for the float model itself
+    :param batch_size: int size of the batched latency measure
+    :param num_runs: int number of timed calls per latency measure
+    :return: dict accuracy, agreement with the float model and single-sample and batched latencies, and np.array
+             predicted class indices
+    """
+    start = time.perf_counter()
+    preds = predict_batches(predictor, X_test).argmax(axis=1)
+    report = {'accuracy': round(float(np.mean(preds == y_true)), 4),
+              'agreement': None if reference_preds is None else round(float(np.mean(preds == reference_preds)), 4),
+              'test_seconds': round(time.perf_counter() - start, 3)}
+    for name, size in (('single', 1), ('batch', batch_size)):
+        timing = time_function(predictor, (X_test[:size],), num_runs=num_runs, wrap=False)
+        report[f'{name}_ms'] = round(timing['mean_ms'], 3)
+        report[f'{name}_p90_ms'] = round(timing['p90_ms'], 3)
+    report['batch_spectra_per_second'] = round(batch_size / max(report['batch_ms'], 1e-9) * 1000, 1)
+    return report, preds
+
+
+def export_run(model, export_dir, X_test, y_test, calibration_X=None, quantizations=QUANTIZATIONS, info=None,
+               batch_size=32, num_runs=50, num_threads=None):
+    """
+    Export a trained model and compare the exported models with it on a test set.
+
+    :param model: BaseModel with its trained weights
+    :param export_dir: str directory of the artifacts
+    :param X_test: np.array test spectra, transformed as for training
+    :param y_test: np.array one-hot labels of the test spectra
+    :param calibration_X: np.array training spectra calibrating int8 quantization
+    :param quantizations: iterable of QUANTIZATIONS, the TFLite models to write
+    :param info: dict written to export.json with the report, e.g. the transforms of the run
+    :param batch_size: int size of the batched latency measure
+    :param num_runs: int number of timed calls per latency measure
+    :param num_threads: int threads of the TFLite interpreters
+    :return: dict report {artifact: {'accuracy', 'agreement' (fraction of the test spectra predicted as the float
+             model does), 'single_ms', 'batch_ms', p90s, 'batch_spectra_per_second', 'size_mib'}}
+    """
+    try_create_directory(export_dir, silent=True)
+    num_timesteps, num_channels = X_test.shape[1:]
+    X_test = X_test.astype(np.float32)
+    y_true = np.asarray(y_test).argmax(axis=1)
+    keras_model = model.keras_model
+
+    saved_model_path = export_saved_model(keras_model, os.path.join(export_dir, SAVED_MODEL_DIRNAME), num_timesteps,
+                                          num_channels)
+    artifacts = [(SAVED_MODEL, saved_model_path, lambda: SavedModelPredictor(saved_model_path))]
+    for quantization in quantizations:
+        path = convert_tflite(saved_model_path, os.path.join(export_dir, get_tflite_filename(quantization)),
+                              quantization=quantization, calibration_X=calibration_X)
+        artifacts.append((quantization, path, lambda path=path: TFLitePredictor(path, num_threads=num_threads)))
+        print(f"Exported {to_local_path(path)}")
+
+    report = {}
+    report['keras'], reference_preds = compare_predictor(get_keras_predictor(keras_model), X_test, y_true,
+                                                         batch_size=batch_size, num_runs=num_runs)
+    weights_path = model.weights_path
+    report['keras']['size_mib'] = None if not weights_path or not os.path.exists(weights_path) else \
+        round(get_size_mib(weights_path), 3)
+    for name, path, get_predictor in artifacts:
+        report[name], _ = compare_predictor(get_predictor(), X_test, y_true, reference_preds=reference_preds,
+                                            batch_size=batch_size, num_runs=num_runs)
+        report[name]['size_mib'] = round(get_size_mib(path), 3)
+
+    export_info = dict(info or {}, input_name=INPUT_NAME, input_shape=[None, int(num_timesteps), int(num_channels)],
+                       signature=SIGNATURE_KEY, saved_model=SAVED_MODEL_DIRNAME,
+                       tflite={quantization: get_tflite_filename(quantization) for quantization in quantizations},
+                       num_test=len(X_test), num_calibration=0 if calibration_X is None else len(calibration_X),
+                       batch_size=batch_size, num_threads=num_threads, report=report)
+    with open(os.path.join(export_dir, EXPORT_INFO_FILENAME), "w") as f:
+        json.dump(export_info, f, indent=4)
+    return report
+
+
+def print_report(report, batch_size):
+    print(f"{'':12}{'accuracy':>10}{'agreement':>11}{'1 ms':>9}{f'{batch_size} ms':>10}{'spectra/s':>11}"
+          f"{'MiB':>9}")
+    for name, row in report.items():
+        agreement = "" if row['agreement'] is None else f"{row['agreement']:.4f}"
+        size = "" if row['size_mib'] is None else f"{row['size_mib']:.2f}"
+        print(f"{name:12}{row['accuracy']:10.4f}{agreement:>11}{row['single_ms']:9.2f}{row['batch_ms']:10.2f}"
+              f"{row['batch_spectra_per_second']:11.0f}{size:>9}")
@@ -0,0 +1,279 @@
+from utils import *
+from sklearn.gaussian_process import GaussianProcessRegressor
+from sklearn.gaussian_process.kernels import Matern
+from scipy.stats import norm
+from tensorflow.keras.callbacks import Callback
+import multiprocessing
+import queue
+import numpy as np
+
+
+"""
+Local hyperparameter search over the `set_params_range` of a model. Trials run in a pool of processes, each limited to
+its own CPUs, and are suggested asynchronously as earlier trials complete: randomly, or by Bayesian optimization of
+the completed trials. A scheduler can stop trials early from their epoch-level validation metrics.
+"""
+
+
+class ParamSpace:
+    """Sampling and normalization of the parameter ranges of `BaseModel.set_params_range`."""
+
+    def __init__(self, params_range):
+        """
+        :param params_range: dict {name: {'type': 'integer' or 'float', 'min': number, 'max': number, ...}}
+        """
+        self.params_range = params_range
+        self.names = sorted(params_range)
+
+    def sample(self, rng):
+        """
+        :param rng: np.random.RandomState
+        :return: dict {name: value}, integer parameters are ints
+        """
+        params = {}
+        for name in self.names:
+            spec = self.params_range[name]
+            if spec['type'] == 'integer':
+                params[name] = int(rng.randint(spec['min'], spec['max'] + 1))
+            else:
+                params[name] = float(rng.uniform(spec['min'], spec['max']))
+        return params
+
+    def to_unit(self, params):
+        """
+        :param params: dict {name: value}
+        :return: np.array of the values scaled to [0, 1], in the order of `names`
+        """
+        return np.array([(params[name] - self.params_range[name]['min']) /
+                         max(self.params_range[name]['max'] - self.params_range[name]['min'], 1e-12)
+                         for name in self.names])
+
+
+class RandomSearch:
+    """Parameters drawn uniformly from their ranges."""
+
+    def __init__(self, params_range, seed=42):
+        self.space = ParamSpace(params_range)
+        self.rng = np.random.RandomState(seed)
+
+    def suggest(self):
+        return self.space.sample(self.rng)
+
+    def observe(self, params, score):
+        """
+        :param params: dict parameters of a completed trial
+        :param score: float score of the trial, lower is better
+        """
+        pass
+
+
+class BayesianSearch(RandomSearch):
+    """
+    Gaussian process regression of the scores of completed trials, suggesting the random candidate with the highest
+    expected improvement. The first `num_initial` suggestions are random.
+    """
+
+    def __init__(self, params_range, seed=42, num_initial=5, num_candidates=1000):
+        super(BayesianSearch, self).__init__(params_range, seed=seed)
+        self.num_initial = num_initial
+        self.num_candidates = num_candidates
+        self.observed_x = []
+        self.observed_y = []
+
+    def suggest(self):
+        if len(self.observed_y) < self.num_initial:
+            return self.space.sample(self.rng)
+
+        kernel = Matern(length_scale=np.ones(len(self.space.names)), length_scale_bounds=(1e-2, 1e2), nu=2.5)
+        gp = GaussianProcessRegressor(kernel=kernel, normalize_y=True, alpha=1e-6,
+                                      random_state=self.rng.randint(2 ** 31))
+        gp.fit(np.array(self.observed_x), np.array(self.observed_y))
+
+        candidates = [self.space.sample(self.rng) for _ in range(self.num_candidates)]
+        mean, std = gp.predict(np.array([self.space.to_unit(c) for c in candidates]), return_std=True)
+        std = np.maximum(std, 1e-12)
+        improvement = min(self.observed_y) - mean
+        expected_improvement = improvement * norm.cdf(improvement / std) + std * norm.pdf(improvement / std)
+        return candidates[int(np.argmax(expected_improvement))]
+
+    def observe(self, params, score):
+        if np.isfinite(score):
+            self.observed_x.append(self.space.to_unit(params))
+            self.observed_y.append(float(score))
+
+
+SEARCH_ALGORITHMS = {'random': RandomSearch, 'bayes': BayesianSearch}
+
+
+class FIFOScheduler:
+    """Runs every trial for all of its epochs."""
+
+    def on_epoch_end(self, trial_id, epoch, score):
+        """
+        :param trial_id: int
+        :param epoch: int number of epochs the trial has completed
+        :param score: float epoch-level score of the trial, lower is better
+        :return: bool True to stop the trial
+        """
+        return False
+
+
+class ASHAScheduler(FIFOScheduler):
+    """
+    Asynchronous successive halving (https://arxiv.org/abs/1810.05934). Rungs are placed at
+    `min_epochs * reduction_factor^k` epochs; a trial reaching a rung is stopped unless its score is in the best
+    `1 / reduction_factor` of the scores recorded at that rung so far. With several brackets (asynchronous Hyperband),
+    trial `i` uses bracket `i % brackets`, whose first rung is `reduction_factor^bracket` times further.
+
+    The recorded scores live in a manager, shared with the trial processes.
+    """
+
+    def __init__(self, manager, max_epochs, min_epochs=1, reduction_factor=3, brackets=1):
+        """
+        :param manager: multiprocessing.managers.SyncManager
+        :param max_epochs: int epochs of trials that are never stopped
+        :param min_epochs: int epoch of the first rung
+        :param reduction_factor: int fraction of the trials kept at every rung is 1 / reduction_factor
+        :param brackets: int number of brackets
+        """
+        self.rung_scores = manager.dict()
+        self.lock = manager.Lock()
+        self.max_epochs = max_epochs
+        self.min_epochs = min_epochs
+        self.reduction_factor = reduction_factor
+        self.brackets = brackets
+
+    def get_rungs(self, trial_id):
+        """
+        :param trial_id: int
+        :return: list of int epochs of the rungs of the trial's bracket
+        """
+        rungs = []
+        epoch = self.min_epochs * self.reduction_factor ** (trial_id % self.brackets)
+        while epoch < self.max_epochs:
+            rungs.append(epoch)
+            epoch *= self.reduction_factor
+        return rungs
+
+    def on_epoch_end(self, trial_id, epoch, score):
+        if not np.isfinite(score):
+            return True
+        if epoch not in self.get_rungs(trial_id):
+            return False
+
+        key = (trial_id % self.brackets, epoch)
+        with self.lock:
+            scores = self.rung_scores.get(key, []) + [float(score)]
+            self.rung_scores[key] = scores
+        cutoff = np.percentile(scores, 100 / self.reduction_factor)
+        return bool(score > cutoff)
+
+
+SCHEDULERS = ('fifo', 'asha')
+
+
+class SchedulerCallback(Callback):
+    """Reports the monitored metric of every epoch of a trial to the scheduler and stops the trial when told so."""
+
+    def __init__(self, scheduler, trial_id, metric, mode):
+        """
+        :param scheduler: FIFOScheduler or ASHAScheduler
+        :param trial_id: int
+        :param metric: str name of the monitored metric in the epoch logs, e.g. 'val_loss'
+        :param mode: str 'min' or 'max'
+        """
+        super(SchedulerCallback, self).__init__()
+        self.scheduler = scheduler
+        self.trial_id = trial_id
+        self.metric = metric
+        self.mode = mode
+        self.stopped_epoch = None
+
+    def on_epoch_end(self, epoch, logs=None):
+        score = get_score((logs or {}).get(self.metric, np.nan), self.mode)
+        if self.scheduler.on_epoch_end(self.trial_id, epoch + 1, score):
+            self.stopped_epoch = epoch + 1
+            self.model.stop_training = True
+
+
+def get_score(value, mode):
+    """Lower is better: scores of maximized metrics are negated."""
+    value = float(value)
+    return -value if mode == 'max' else value
+
+
+def get_cpu_sets(num_workers, cpus_per_trial):
+    """
+    :param num_workers: int number of trials running at once
+    :param cpus_per_trial: int
+    :return: list of lists of CPU ids, one per worker, or None if CPU affinity is not supported
+    """
+    if not hasattr(os, 'sched_getaffinity'):
+        return None
+    cpus = sorted(os.sched_getaffinity(0))
+    return [[cpus[(i * cpus_per_trial + j) % len(cpus)] for j in range(cpus_per_trial)] for i in range(num_workers)]
+
+
+def limit_cpus(cpus_per_trial, cpu_set=None):
+    """
+    Restrict the calling (trial) process to `cpus_per_trial` threads, on `cpu_set` if given. Must be called before
+    TensorFlow runs any operation.
+    """
+    import tensorflow as tf
+    os.environ['OMP_NUM_THREADS'] = str(cpus_per_trial)
+    tf.config.threading.set_intra_op_parallelism_threads(cpus_per_trial)
+    tf.config.threading.set_inter_op_parallelism_threads(min(2, cpus_per_trial))
+    if cpu_set is not None:
+        os.sched_setaffinity(0, cpu_set)
+
+
+def run_search(trial_func, trial_args, searcher, num_trials, num_workers, cpus_per_trial, on_trial_end=None):
+    """
+    Run trials in a pool of processes, suggesting the parameters of every new trial from the trials completed so far.
+
+    :param trial_func: picklable function(dict) -> dict with a 'score' (lower is better), run in a fresh process
+    :param trial_args: dict arguments shared by all trials, completed with 'trial_id', 'params', 'cpus_per_trial' and
+                       'cpu_set' for every trial
+    :param searcher: RandomSearch or BayesianSearch
+    :param num_trials: int
+    :param num_workers: int number of trials running at once
+    :param cpus_per_trial: int
+    :param on_trial_end: optional function(list of trial results) called after every trial
+    :return: list of dict trial results, in completion order. Failed trials have an 'error' and an infinite score.
+    """
+    results = []
+    done = queue.Queue()
+    cpu_sets = get_cpu_sets(num_workers, cpus_per_trial)
+    free_slots = list(range(num_workers))
+
+    # Every trial runs in a fresh process, so trials do not share (or leak) TensorFlow state
+    with multiprocessing.get_context('spawn').Pool(processes=num_workers, maxtasksperchild=1) as pool:
+        def submit(trial_id):
+            slot = free_slots.pop()
+            args = dict(trial_args, trial_id=trial_id, params=searcher.suggest(), cpus_per_trial=cpus_per_trial,
+                        cpu_set=None if cpu_sets is None else cpu_sets[slot])
+            pool.apply_async(trial_func, (args,), callback=lambda result: done.put((slot, args, result)),
+                             error_callback=lambda error: done.put((slot, args, error)))
+
+        num_submitted = 0
+        while num_submitted < min(num_workers, num_trials):
+            submit(num_submitted)
+            num_submitted += 1
+
+        while len(results) < num_submitted:
+            slot, args, result = done.get()
+            free_slots.append(slot)
+            if isinstance(result, BaseException):
+                result = {'trial_id': args['trial_id'], 'params': args['params'], 'score': float('inf'),
+                          'error': repr(result)}
+                print(f"Trial {args['trial_id']} failed: {result['error']}")
+            searcher.observe(result['params'], result['score'])
+            results.append(result)
+            if on_trial_end is not None:
+                on_trial_end(results)
+
+            if num_submitted < num_trials:
+                submit(num_submitted)
+                num_submitted += 1
+
+    return results
@@ -1,6 +1,8 @@
 """
-This code was not produced by our team. It was found on Kaggle. For more information about this class, see:
+Attention pooling over timesteps. The scoring (tanh of a per-timestep projection plus a per-timestep bias) follows the
+layer found on Kaggle, see:
 https://www.kaggle.com/qqgeogor/keras-lstm-attention-glove840b-lb-0-043
+Its weights have the same shapes and names, so weights saved with the original layer can still be loaded.
 """
 
 from tensorflow.keras.layers import Layer
@@ -8,14 +10,24 @@ from tensorflow.keras import backend as K
 from tensorflow.keras import initializers
 from tensorflow.keras import regularizers
 from tensorflow.keras import constraints
+import tensorflow as tf
 
 
 class Attention(Layer):
+    """
+    Pools (batch, timesteps, features) inputs into (batch, features) with a softmax over the timesteps.
+    Masked timesteps get no weight, and `return_attention=True` also returns the (batch, timesteps) weights.
+    """
 
-    def __init__(self, step_dim,
+    def __init__(self, step_dim=None,
                  W_regularizer=None, b_regularizer=None,
                  W_constraint=None, b_constraint=None,
-                 bias=True, **kwargs):
+                 bias=True, return_attention=False, **kwargs):
+        """
+        :param step_dim: int (optional) Expected number of timesteps, inferred from the input shape by default.
+        :param bias: bool Add a learned bias per timestep to the scores.
+        :param return_attention: bool Return the attention weights along with the pooled output.
+        """
         self.supports_masking = True
         self.init = initializers.get('glorot_uniform')
         self.W_regularizer = regularizers.get(W_regularizer)
@@ -25,10 +37,17 @@ class Attention(Layer):
         self.bias = bias
         self.step_dim = step_dim
         self.features_dim = 0
+        self.return_attention = return_attention
         super(Attention, self).__init__(**kwargs)
 
     def build(self, input_shape):
         assert len(input_shape) == 3
+        if self.bias and input_shape[1] is None:
+            raise ValueError("Attention with a bias needs a fixed number of timesteps.")
+        if self.step_dim is not None and input_shape[1] is not None and self.step_dim != input_shape[1]:
+            raise ValueError(f"Attention expected {self.step_dim} timesteps, got {input_shape[1]}.")
+        self.step_dim = input_shape[1]
+
         self.W = self.add_weight(shape=(input_shape[-1],),
                                  initializer=self.init,
                                  name=f'{self.name}_W',
@@ -46,23 +65,42 @@ class Attention(Layer):
         self.built = True
 
     def compute_mask(self, input, input_mask=None):
+        if self.return_attention:
+            return [None, None]
         return None
 
     def call(self, x, mask=None):
-        features_dim = self.features_dim
-        step_dim = self.step_dim
-        eij = K.reshape(K.dot(K.reshape(x, (-1, features_dim)),
-                        K.reshape(self.W, (features_dim, 1))), (-1, step_dim))
+        # Plain 2D matmuls: the einsums of the scores and the pooling lower to batched matmuls whose gradients are
+        # slower than the whole reshape/K.dot step of the original layer
+        scores = tf.reshape(K.dot(tf.reshape(x, (-1, self.features_dim)), tf.expand_dims(self.W, -1)), tf.shape(x)[:2])
         if self.bias:
-            eij += self.b
-        eij = K.tanh(eij)
-        a = K.exp(eij)
+            scores += self.b
+        scores = K.tanh(scores)
+
+        if mask is not None:
+            mask = tf.cast(mask, tf.bool)
+            scores = tf.where(mask, scores, tf.fill(tf.shape(scores), scores.dtype.min))
+        # tf.nn.softmax subtracts the maximum score, so it does not overflow
+        a = tf.nn.softmax(scores, axis=1)
         if mask is not None:
-            a *= K.cast(mask, K.floatx())
-        a /= K.cast(K.sum(a, axis=1, keepdims=True) + K.epsilon(), K.floatx())
-        a = K.expand_dims(a)
-        weighted_input = x * a
-        return K.sum(weighted_input, axis=1)
+            # Fully masked sequences get no weight instead of uniform weights
+            a *= tf.cast(mask, a.dtype)
+
+        output = tf.reduce_sum(x * a[..., None], axis=1)
+        if self.return_attention:
+            return [output, a]
+        return output
 
     def compute_output_shape(self, input_shape):
-        return input_shape[0],  self.features_dim
+        if self.return_attention:
+            return [(input_shape[0], input_shape[-1]), (input_shape[0], input_shape[1])]
+        return input_shape[0], input_shape[-1]
+
+    def get_config(self):
+        config = super(Attention, self).get_config()
+        config.update({'step_dim': self.step_dim, 'bias': self.bias, 'return_attention': self.return_attention,
+                       'W_regularizer': regularizers.serialize(self.W_regularizer),
+                       'b_regularizer': regularizers.serialize(self.b_regularizer),
+                       'W_constraint': constraints.serialize(self.W_constraint),
+                       'b_constraint': constraints.serialize(self.b_constraint)})
+        return config
@@ -1,12 +1,59 @@
 from utils import *
 from comet_ml import Experiment, ExistingExperiment
+from models.distributed import get_scope, distribute_generator, distribute_arrays, sync_replica_variables
+from models.checkpoints import OPTIMIZER_FILENAME, get_staged_path, load_optimizer_state
+from memory_accounting import memory_stage, PREDICT
 from abc import ABC
 from abc import abstractmethod
+import gc
 import json
 from datetime import datetime
+import tensorflow as tf
+from tensorflow.python.framework import ops
+from tensorflow.keras import activations, mixed_precision
+from tensorflow.keras.layers import Activation
+from tensorflow.keras.models import Model
 import numpy as np
 
 
+PRECISIONS = ('float32', 'mixed_bfloat16')
+
+
+def cpu_supports_bfloat16():
+    """
+    Whether the CPU has native bfloat16 arithmetic (AVX512-BF16 or AMX), read from /proc/cpuinfo.
+    Without it, bfloat16 is emulated and slower than float32.
+
+    :return: bool, False when unknown
+    """
+    try:
+        with open('/proc/cpuinfo', 'r') as f:
+            flags = set(f.read().split())
+    except OSError:
+        return False
+    return bool(flags & {'avx512_bf16', 'amx_bf16'})
+
+
+def clear_custom_gradients():
+    """
+    Unregisters the gradient functions of `tf.custom_gradient` calls traced in graph mode. Every trace of a train step
+    registers one (for the all-reduce of the gradients), and the global registry keeps it, with the whole gradient
+    graph it refers to, for the life of the process; `clear_session` does not remove them. Gradients of graphs that
+    were already traced are not recomputed, so this is safe once the train steps of the process are traced.
+    The registry is private to TensorFlow: if a version does not have it, nothing is cleared, and
+    `models.benchmarks.memory_regression` reports it.
+
+    :return: bool False if the registry was not found
+    """
+    try:
+        registry = ops._gradient_registry._registry
+    except AttributeError:
+        return False
+    for name in [name for name in registry if name.startswith('CustomGradient-')]:
+        registry.pop(name, None)
+    return True
+
+
 class BaseModel(ABC):
     """ Abstract class for our networks to extend. Provides methods that are universal to all models."""
 
@@ -48,6 +95,15 @@ class BaseModel(ABC):
         self.history = None
         self.preds = None
         self.weights_path = None
+        self.optimizer_state_path = None
+        self.timestep_transform = None
+        self.augmentation = None
+        self.zoom = None
+        self.sampling = None
+        self.strategy = None
+        self.distribute = None
+        self.step_timing = None
+        self.memory_stages = None
 
     def get_default_params(self):
         """
@@ -59,7 +115,7 @@ class BaseModel(ABC):
 
     def _fit_preinit(self, compile_dict):
         """
-        Compiles the keras model and optionally loads pre-existing weights.
+        Compiles the keras model and optionally loads pre-existing weights and optimizer state.
         :param compile_dict - Dictionary of compilation parameters.
 
         :return None
@@ -68,18 +124,33 @@ class BaseModel(ABC):
             self.params = self.get_default_params()
             print(f"Using default parameters: {self.params}")
 
-        self.keras_model = self.build_model(self.num_channels, self.num_timesteps, self.output_shape, self.params)
-
         if compile_dict is not None:
-            self.compile(compile_dict)
             self.compile_dict = compile_dict
-        elif self.compile_dict is not None:
-            self.compile(self.compile_dict)
-
-        if self.weights_path is not None:
-            self.keras_model.load_weights(self.weights_path)
-
-    def fit(self, X_train, y_train, X_test, y_test, batch_size, epochs, compile_dict=None, validation_size=0.20):
+        precision = self.get_precision(self.compile_dict)
+
+        # Variables of distributed models are created in the strategy's scope, mirrored on every worker
+        with get_scope(self.strategy):
+            # Layers take their dtype policy from the global policy when they are created
+            mixed_precision.set_global_policy(precision)
+            try:
+                self.keras_model = self.build_model(self.num_channels, self.num_timesteps, self.output_shape,
+                                                    self.params)
+            finally:
+                mixed_precision.set_global_policy('float32')
+            if precision != 'float32':
+                self.keras_model = BaseModel._with_float32_output(self.keras_model)
+
+            if self.compile_dict is not None:
+                self.compile_dict = dict(self.compile_dict, precision=precision)
+                self.compile(self.compile_dict)
+
+            if self.weights_path is not None:
+                self.keras_model.load_weights(self.weights_path)
+            if self.optimizer_state_path is not None and self.compile_dict is not None:
+                load_optimizer_state(self.keras_model, self.optimizer_state_path)
+
+    def fit(self, X_train, y_train, X_test, y_test, batch_size, epochs, compile_dict=None, validation_size=0.20,
+            preprocessor=None, callbacks=None, initial_epoch=0):
         """
         Fits the model to a set of data.
 
@@ -91,18 +162,35 @@ class BaseModel(ABC):
         :param epochs: The number of epochs.
         :param compile_dict: Dictionary of compilation parameters.
         :param validation_size: Size of the validation set used during training.
+        :param preprocessor: Optional SpectraPreprocessor. If it samples or augments training data, batches are drawn
+                             through its `flow`. The validation set is neither resampled nor augmented.
+        :param callbacks: Optional list of keras callbacks.
+        :param initial_epoch: Epoch to start at when resuming a run, training stops at `epochs`.
 
         :return: None.
         """
         self._fit_preinit(compile_dict)
 
-        self.keras_model.fit(X_train, y_train, validation_split=validation_size, epochs=epochs, batch_size=batch_size)
-        self._fit_complete(X_test, y_test, batch_size, epochs, validation_size)
+        if self.strategy is not None:
+            self._fit_distributed(X_train, y_train, batch_size, epochs, validation_size, preprocessor, callbacks,
+                                  initial_epoch)
+        elif preprocessor is None or not preprocessor.uses_flow():
+            self.keras_model.fit(X_train, y_train, validation_split=validation_size, epochs=epochs,
+                                 batch_size=batch_size, callbacks=callbacks, initial_epoch=initial_epoch)
+        else:
+            # Same split as keras' validation_split: the last fraction of the data is held out.
+            num_fit = len(X_train) - int(len(X_train) * validation_size)
+            self.keras_model.fit(preprocessor.flow(X_train[:num_fit], y_train[:num_fit], batch_size, initial_epoch),
+                                 steps_per_epoch=preprocessor.get_train_steps(batch_size, y=y_train[:num_fit]),
+                                 validation_data=(X_train[num_fit:], y_train[num_fit:]), epochs=epochs,
+                                 callbacks=callbacks, initial_epoch=initial_epoch)
+        self._fit_complete(X_test, y_test, batch_size=batch_size, epochs=epochs, validation_size=validation_size)
 
     def fit_generator(self, preprocessor, train_size, batch_size, epochs, compile_dict=None,
-                      validation_size=0.20, encoded=False):
+                      validation_size=0.20, encoded=False, callbacks=None, initial_epoch=0):
         """
-        Method for fitting the model with a generator.
+        Method for fitting the model with a generator. The model is validated on the test set, so its validation
+        metrics must not be used to select the model (e.g. early stopping).
         :param preprocessor: A SpectraPreprocessor.
         :param train_size: Size of the training set.
         :param batch_size: Size of a batch.
@@ -110,22 +198,67 @@ class BaseModel(ABC):
         :param compile_dict: Dictionary of compilation values.
         :param validation_size: Size of the validation set used in training.
         :param encoded: Boolean for encoded data
+        :param callbacks: Optional list of keras callbacks.
+        :param initial_epoch: Epoch to start at when resuming a run, training stops at `epochs`.
 
         :return: None
         """
         self._fit_preinit(compile_dict)
 
         num_test = preprocessor.get_num_test_instances()
-
-        self.keras_model.fit(preprocessor.train_generator(batch_size=batch_size),
+        train_data = preprocessor.train_generator(batch_size=batch_size)
+        validation_data = preprocessor.test_generator(batch_size=batch_size)
+        if self.strategy is not None:
+            # The generators only yield the batches of this worker
+            train_data = distribute_generator(self.strategy, train_data)
+            validation_data = distribute_generator(self.strategy, validation_data)
+            self._set_distribute(batch_size)
+
+        self.keras_model.fit(train_data,
                                        #steps_per_epoch=train_size//batch_size, validation_data=(X_test, y_test),
-                                       steps_per_epoch=train_size // batch_size,
-                                       validation_data=preprocessor.test_generator(batch_size=batch_size),
-                                       validation_steps=num_test // batch_size,
-                                       epochs=epochs)
+                                       steps_per_epoch=preprocessor.get_train_steps(batch_size, num_instances=train_size),
+                                       validation_data=validation_data,
+                                       validation_steps=num_test // (batch_size * preprocessor.input_shard[1]),
+                                       epochs=epochs, callbacks=callbacks, initial_epoch=initial_epoch)
+        # Recorded as in `_fit_complete`, so continued and resumed runs keep the history of the whole run
+        self.batch_size = batch_size
+        self.epochs += len(self.keras_model.history.epoch)
+        self.validation_size = validation_size
+        self.history = BaseModel._merge_histories(self.history, self.get_model_history())
 
         #self._fit_complete(generator=preprocessor.test_generator(batch_size=batch_size, encoded=encoded), batch_size=batch_size, epochs=epochs, validation_size=validation_size, num_test=num_test)
 
+    def _fit_distributed(self, X_train, y_train, batch_size, epochs, validation_size, preprocessor=None,
+                         callbacks=None, initial_epoch=0):
+        """
+        Data-parallel fit: every worker trains on its share of the training records with batches of `batch_size`, the
+        validation set is held out as in `fit` and evaluated by all workers. The replicas then share the moving statistics
+        they save, so that the test results are those of the saved model.
+
+        :return: None
+        """
+        num_fit = len(X_train) - int(len(X_train) * validation_size)
+        if preprocessor is not None and preprocessor.uses_flow():
+            train_data = distribute_generator(self.strategy, preprocessor.flow(X_train[:num_fit], y_train[:num_fit],
+                                                                               batch_size, initial_epoch))
+            steps_per_epoch = preprocessor.get_train_steps(batch_size, y=y_train[:num_fit])
+        else:
+            train_data = distribute_arrays(self.strategy, X_train[:num_fit], y_train[:num_fit], batch_size)
+            steps_per_epoch = num_fit // (batch_size * self.strategy.num_replicas_in_sync)
+
+        self._set_distribute(batch_size)
+        self.keras_model.fit(train_data, steps_per_epoch=steps_per_epoch,
+                             validation_data=(X_train[num_fit:], y_train[num_fit:]), epochs=epochs,
+                             callbacks=callbacks, initial_epoch=initial_epoch)
+        sync_replica_variables(self.strategy, self.keras_model)
+
+    def _set_distribute(self, batch_size):
+        """Records the data-parallel setup of the run, `batch_size` is the batch size of every worker."""
+        num_replicas = self.strategy.num_replicas_in_sync
+        self.distribute = {'strategy': type(self.strategy).__name__, 'num_replicas': num_replicas,
+                           'global_batch_size': batch_size * num_replicas}
+        print(f"Training on {num_replicas} replicas, global batch size {batch_size * num_replicas}")
+
     def _fit_complete(self, X_test=None, y_test=None, generator=None, batch_size=0, epochs=0, validation_size=0.20, num_test=0):
         """
         After fitting the model this method is called and provides evaluation results.
@@ -140,22 +273,73 @@ class BaseModel(ABC):
         :return: None
         """
         self.batch_size = batch_size
-        self.epochs += epochs
+        self.epochs += len(self.keras_model.history.epoch)  # callbacks may stop training before `epochs`
         self.validation_size = validation_size
-        self.test_results = self.evaluate(X_test=X_test, y_test=y_test, generator=generator, steps=num_test//batch_size)
+        # Read before evaluating: tf.keras resets the history of the model in `evaluate`
         self.history = BaseModel._merge_histories(self.history, self.get_model_history())
+        self.test_results = self.evaluate(X_test=X_test, y_test=y_test, generator=generator, steps=num_test//batch_size)
         self.preds = y_test, self.get_preds(X_test)
 
         #TODO: Fix placement of classification report.
 
+    @staticmethod
+    def get_precision(compile_dict):
+        """
+        Precision policy the model is built with: compile_dict['precision'], 'float32' by default. 'mixed_bfloat16'
+        falls back to 'float32' on CPUs without native bfloat16 arithmetic.
+
+        :param compile_dict: Dictionary of compilation parameters, or None.
+
+        :return: str one of PRECISIONS
+        """
+        precision = (compile_dict or {}).get('precision', 'float32')
+        if precision not in PRECISIONS:
+            raise ValueError(f"Unknown precision '{precision}', expected one of {PRECISIONS}")
+        if precision == 'mixed_bfloat16' and not cpu_supports_bfloat16():
+            print("This CPU has no native bfloat16 arithmetic, using float32 instead of mixed_bfloat16.")
+            return 'float32'
+        return precision
+
+    @staticmethod
+    def _with_float32_output(keras_model):
+        """
+        Moves the activation of the output layer of a mixed precision model into a float32 layer, so the softmax and the
+        loss are computed in float32. The weights are unchanged.
+
+        :param keras_model: built keras model with a single output.
+
+        :return: keras model with a float32 output.
+        """
+        output_layer = keras_model.layers[-1]
+        activation = getattr(output_layer, 'activation', activations.linear)
+        output_layer.activation = activations.linear
+        outputs = Activation(activation, dtype='float32')(keras_model.outputs[0])
+        return Model(inputs=keras_model.inputs, outputs=outputs)
+
     def compile(self, compile_dict):
         """
-        Compiles the underlying keras model with the compilation dictionary.
+        Compiles the underlying keras model with the compilation dictionary. Its 'jit_compile' entry compiles the train
+        and predict steps with XLA; its 'precision' entry is only used when the model is built.
         :param compile_dict: Dictionary containing compilation parameters.
 
         :return: None
         """
-        self.keras_model.compile(**compile_dict)
+        self.keras_model.compile(**{k: v for k, v in compile_dict.items() if k != 'precision'})
+
+    def dispose(self):
+        """
+        Releases the keras model and clears the keras session, so processes building many models (notebooks, scripts)
+        do not keep the graphs, layer names and traced functions of every model. The session is shared by all models
+        of the process: other built models must be rebuilt (`fit` rebuilds them) before they are used again. The
+        results of the run (history, test results, parameters) are kept.
+
+        :return: None
+        """
+        self.keras_model = None
+        self.preds = None
+        tf.keras.backend.clear_session()
+        clear_custom_gradients()
+        gc.collect()
 
     def get_model_config(self):
         """
@@ -169,8 +353,10 @@ class BaseModel(ABC):
         """
         Get the model history.
 
-        :return: Keras model history with values rounded to 5 decimal places.
+        :return: Keras model history with values rounded to 5 decimal places, empty before the model is fit.
         """
+        if getattr(self.keras_model, 'history', None) is None:
+            return {}
         history = self.keras_model.history.history
         for key, value in history.items():
             history[key] = [float(round(v, 5)) for v in value]
@@ -206,7 +392,8 @@ class BaseModel(ABC):
 
         :return: List of predictions for entries in data set.
         """
-        preds = self.keras_model.predict(X_test)
+        with memory_stage(PREDICT):
+            preds = self.keras_model.predict(X_test)
         return preds
 
     def serialize(self):
@@ -216,42 +403,72 @@ class BaseModel(ABC):
         :return: A dictionary of values.
         """
         params = dict()
+        # Architecture, so the model can be rebuilt without the dataset it was trained on
+        params['num_channels'] = self.num_channels
+        params['output_shape'] = self.output_shape
+        params['params'] = self.params
         params['compile_dict'] = self.compile_dict
         params['batch_size'] = self.batch_size
         params['epochs'] = self.epochs
-        params['history'] = BaseModel._merge_histories(self.history, self.get_model_history())
+        # `_fit_complete` already merged the history of the last fit
+        params['history'] = self.history if self.history is not None else self.get_model_history()
         params['test_results'] = self.test_results
+        params['num_timesteps'] = self.num_timesteps
+        params['timestep_transform'] = self.timestep_transform
+        params['augmentation'] = self.augmentation
+        params['zoom'] = self.zoom
+        params['sampling'] = self.sampling
+        params['distribute'] = self.distribute
+        params['step_timing'] = self.step_timing
+        params['memory_stages'] = self.memory_stages
 
         return params
 
-    def save(self, class_name, dataset_name, save_dir=None):
+    def save(self, class_name, dataset_name, save_dir=None, info=None, staged=False):
         """
         Saves the model to a directory on disk.
 
         :param class_name: Name of the concrete model class.
         :param dataset_name: Name given to the dataset.
         :param save_dir: Location on disk to save the model.
+        :param info: Optional dictionary of values replacing those of `serialize`, e.g. the history of a checkpoint.
+        :param staged: Write the files under their staged names, to be committed with a checkpoint (see checkpoints.py).
 
         :return: Path to the saved model.
         """
         if save_dir is None:
-            save_dir = os.path.join(MODEL_RES_DIR, class_name + RESULT_DIR_DELIM + dataset_name + "." + str(datetime.now().strftime("%m%d.%H%M")))
+            save_dir = BaseModel.get_save_dir(class_name, dataset_name)
 
         try_create_directory(save_dir)
         weights_path = os.path.join(save_dir, WEIGHTS_FILENAME)
         info_path = os.path.join(save_dir, TRAIN_INFO_FILENAME)
+        if staged:
+            weights_path, info_path = get_staged_path(weights_path), get_staged_path(info_path)
         self.keras_model.save_weights(weights_path)
 
         info_dict = self.serialize()
+        info_dict.update(info or {})
         info_dict["class_name"] = class_name
         info_dict["dataset_name"] = dataset_name
         json.dump(info_dict, open(info_path, "w"))
 
         return save_dir
 
+    @staticmethod
+    def get_save_dir(class_name, dataset_name):
+        """
+        :param class_name: Name of the concrete model class.
+        :param dataset_name: Name given to the dataset.
+
+        :return: Default directory of a new run, named after the model, the dataset and the time.
+        """
+        return os.path.join(MODEL_RES_DIR, class_name + RESULT_DIR_DELIM + dataset_name + "." + str(datetime.now().strftime("%m%d.%H%M")))
+
     def persist(self, dirname, result_dir=MODEL_RES_DIR):
         """
-        Load a preexisting model to continue training.
+        Load a preexisting model to continue training. The model is rebuilt with the parameters of the run (the default
+        parameters for runs that did not record them), and the optimizer state is restored too if the run was
+        checkpointed.
 
         :param dirname: Specific directory name for the model being loaded.
         :param result_dir: Base directory used for storing results, defaults to a variable set in utils.py
@@ -262,15 +479,24 @@ class BaseModel(ABC):
         model_directory = os.path.join(result_dir, dirname)
 
         self.weights_path = os.path.join(model_directory, WEIGHTS_FILENAME)
+        optimizer_state_path = os.path.join(model_directory, OPTIMIZER_FILENAME)
+        self.optimizer_state_path = optimizer_state_path if os.path.exists(optimizer_state_path) else None
 
         info_path = os.path.join(model_directory, TRAIN_INFO_FILENAME)
         info = json.load(open(info_path, 'r'))
 
+        self.params = info.get('params', self.params)
         self.compile_dict = info['compile_dict']
         self.batch_size = info['batch_size']
         self.epochs = info['epochs']
         self.history = info['history']
         self.test_results = info['test_results']
+        self.timestep_transform = info.get('timestep_transform')
+        self.augmentation = info.get('augmentation')
+        self.zoom = info.get('zoom')
+        self.sampling = info.get('sampling')
+        self.step_timing = info.get('step_timing')
+        self.memory_stages = info.get('memory_stages')
         self._fit_preinit(self.compile_dict)
 
     @staticmethod
@@ -283,11 +509,11 @@ class BaseModel(ABC):
 
         :return: Merged history.
         """
-        if hist1 is None and hist2 is None:
+        if not hist1 and not hist2:
             return {}
-        elif hist1 is None:
+        elif not hist1:
             return hist2
-        elif hist2 is None:
+        elif not hist2:
             return hist1
 
         assert hist1.keys() == hist2.keys(), "incompatible histories to merge"
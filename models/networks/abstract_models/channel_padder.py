@@ -1,23 +1,56 @@
 from tensorflow.keras.layers import Layer
+import numpy as np
 import tensorflow as tf
 
 
+def get_symmetric_channel_indices(num_channels, output_dim):
+    """
+    Channel index map of symmetric padding: channels are repeated forwards then backwards, 0..nc-1, nc-1..0, 0..
+    Inputs with at least `output_dim` channels are left unchanged.
+
+    :param num_channels: int or scalar tensor
+    :param output_dim: int
+    :return: np.array (or tensor, for a tensor `num_channels`) of channel indices
+    """
+    if isinstance(num_channels, (int, np.integer)):
+        period = np.arange(max(output_dim, num_channels)) % (2 * num_channels)
+        return np.where(period < num_channels, period, 2 * num_channels - 1 - period)
+
+    period = tf.range(tf.maximum(output_dim, num_channels)) % (2 * num_channels)
+    return tf.where(period < num_channels, period, 2 * num_channels - 1 - period)
+
+
 class ChannelPadder(Layer):
+    """
+    Pads the channel axis of (batch, timesteps, channels) inputs up to `output_dim` channels by symmetric
+    reflection, with a single gather. The index map is computed once when the channel count is known at build time,
+    and in the graph otherwise. Inputs known to have at least `output_dim` channels are returned as they are.
+    """
+
     def __init__(self, output_dim, **kwargs):
         self.output_dim = output_dim
+        self.channel_indices = None
         super(ChannelPadder, self).__init__(**kwargs)
 
+    def build(self, input_shape):
+        num_channels = input_shape[2]
+        if num_channels is not None and num_channels < self.output_dim:
+            self.channel_indices = tf.constant(get_symmetric_channel_indices(int(num_channels), self.output_dim),
+                                               dtype=tf.int32)
+        super(ChannelPadder, self).build(input_shape)
+
     def transform_dimensions(self, dm, output_dim):
-        result = dm
-        nc = dm.shape[2]
-        if nc is not None:
-            if nc < output_dim:
-                for i in range(0, output_dim - 2 * nc - 2, nc):
-                    paddings = [[0, 0], [0, 0], [0, nc]]
-                    result = tf.pad(result, paddings, 'SYMMETRIC')
-                paddings = [[0, 0], [0, 0], [0, output_dim - result.shape[2]]]
-                result = tf.pad(result, paddings, 'SYMMETRIC')
-        return result
+        if dm.shape[2] is not None and dm.shape[2] >= output_dim:
+            return dm
+        channel_indices = self.channel_indices
+        if channel_indices is None or output_dim != self.output_dim:
+            channel_indices = get_symmetric_channel_indices(tf.shape(dm)[2], output_dim)
+        return tf.gather(dm, channel_indices, axis=2)
 
     def call(self, X, **kwargs):
-        return self.transform_dimensions(X, self.output_dim)
\ No newline at end of file
+        return self.transform_dimensions(X, self.output_dim)
+
+    def get_config(self):
+        config = super(ChannelPadder, self).get_config()
+        config['output_dim'] = self.output_dim
+        return config
@@ -0,0 +1,117 @@
+from tensorflow.keras.layers import Layer
+from tensorflow.keras import activations
+import numpy as np
+import tensorflow as tf
+
+
+"""
+Layers running one tower per channel as a single batched computation, used by folded EnsembleModels.
+
+Shared-weight towers fold the channels into the batch axis, (batch, timesteps, channels) -> (batch * channels,
+timesteps, 1), so any layer can be applied to every channel at once. Towers with per-channel weights keep the channels
+on their own axis, (batch, timesteps, channels, features), and use the channelwise layers below, which hold one
+kernel per channel and apply all of them with a single einsum.
+"""
+
+
+class FoldChannels(Layer):
+    """(batch, timesteps, channels) -> (batch * channels, timesteps, 1)"""
+
+    def call(self, X, **kwargs):
+        X = tf.transpose(X, [0, 2, 1])
+        return tf.reshape(X, [-1, X.shape[2], 1])
+
+
+class UnfoldChannels(Layer):
+    """(batch * channels, ...) -> (batch, channels * features), in the order of concatenated per-channel towers"""
+
+    def __init__(self, num_channels, **kwargs):
+        self.num_channels = num_channels
+        super(UnfoldChannels, self).__init__(**kwargs)
+
+    def call(self, X, **kwargs):
+        return tf.reshape(X, [-1, self.num_channels * int(np.prod(X.shape[1:]))])
+
+    def get_config(self):
+        config = super(UnfoldChannels, self).get_config()
+        config['num_channels'] = self.num_channels
+        return config
+
+
+class ChannelwiseConv1D(Layer):
+    """
+    Conv1D with separate weights for every channel, on inputs of shape (batch, timesteps, channels, features).
+    Only 'valid' padding is supported.
+    """
+
+    def __init__(self, filters, kernel_size, strides=1, activation=None, use_bias=True, **kwargs):
+        self.filters = filters
+        self.kernel_size = kernel_size
+        self.strides = strides
+        self.activation = activations.get(activation)
+        self.use_bias = use_bias
+        super(ChannelwiseConv1D, self).__init__(**kwargs)
+
+    def build(self, input_shape):
+        num_channels, num_features = input_shape[2], input_shape[3]
+        self.kernel = self.add_weight(name='kernel', shape=(num_channels, self.kernel_size, num_features, self.filters),
+                                      initializer='glorot_uniform', trainable=True)
+        if self.use_bias:
+            self.bias = self.add_weight(name='bias', shape=(num_channels, self.filters), initializer='zeros',
+                                        trainable=True)
+        super(ChannelwiseConv1D, self).build(input_shape)
+
+    def call(self, X, **kwargs):
+        # (batch, out timesteps, kernel_size, channels, features)
+        frames = tf.signal.frame(X, self.kernel_size, self.strides, axis=1)
+        output = tf.einsum('btkci,ckio->btco', frames, self.kernel)
+        if self.use_bias:
+            output = output + self.bias
+        return self.activation(output)
+
+    def get_config(self):
+        config = super(ChannelwiseConv1D, self).get_config()
+        config.update({'filters': self.filters, 'kernel_size': self.kernel_size, 'strides': self.strides,
+                       'activation': activations.serialize(self.activation), 'use_bias': self.use_bias})
+        return config
+
+
+class ChannelwiseDense(Layer):
+    """Dense with separate weights for every channel, on inputs of shape (batch, [timesteps,] channels, features)."""
+
+    def __init__(self, units, activation=None, use_bias=True, **kwargs):
+        self.units = units
+        self.activation = activations.get(activation)
+        self.use_bias = use_bias
+        super(ChannelwiseDense, self).__init__(**kwargs)
+
+    def build(self, input_shape):
+        num_channels, num_features = input_shape[-2], input_shape[-1]
+        self.kernel = self.add_weight(name='kernel', shape=(num_channels, num_features, self.units),
+                                      initializer='glorot_uniform', trainable=True)
+        if self.use_bias:
+            self.bias = self.add_weight(name='bias', shape=(num_channels, self.units), initializer='zeros',
+                                        trainable=True)
+        super(ChannelwiseDense, self).build(input_shape)
+
+    def call(self, X, **kwargs):
+        output = tf.einsum('...ci,cio->...co', X, self.kernel)
+        if self.use_bias:
+            output = output + self.bias
+        return self.activation(output)
+
+    def get_config(self):
+        config = super(ChannelwiseDense, self).get_config()
+        config.update({'units': self.units, 'activation': activations.serialize(self.activation),
+                       'use_bias': self.use_bias})
+        return config
+
+
+class ChannelwiseFlatten(Layer):
+    """(batch, timesteps, channels, features) -> (batch, channels, timesteps * features)"""
+
+    def call(self, X, **kwargs):
+        if len(X.shape) == 3:
+            return X
+        X = tf.transpose(X, [0, 2, 1, 3])
+        return tf.reshape(X, [-1, X.shape[1], X.shape[2] * X.shape[3]])
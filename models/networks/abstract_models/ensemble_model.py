@@ -1,9 +1,11 @@
-from keras.models import Model
-from keras.layers import Input
+from tensorflow.keras.models import Model
+from tensorflow.keras.layers import Input, Reshape, Flatten, Conv1D, Dense, Dropout, Activation
 from typing import List
 from abc import abstractmethod
 
 from models.networks.abstract_models.base_model import BaseModel
+from models.networks.abstract_models.channel_towers import FoldChannels, UnfoldChannels, ChannelwiseConv1D, \
+    ChannelwiseDense, ChannelwiseFlatten
 
 
 class EnsembleModel:
@@ -26,15 +28,24 @@ class EnsembleModel:
     homogeneous_models: bool
         If true, then all sub-models will have the same architecture. If false, then model architecture can vary between
         sub-models.
+    fold_channels: bool
+        Only for homogeneous models. If true, the model has a single (timesteps, channels) input and all sub-models run
+        as one batched tower instead of one subgraph per channel, see `channel_towers.py`.
+    tower_weights: str
+        Only for folded models. 'shared' applies the same weights to every channel (as the layers of unfolded
+        homogeneous models do), 'per_channel' gives every channel its own weights.
     """
-    keras_model = None
-    sub_models: List = list()
-    input_layers: List = list()
-    input_channels: int = None
-    homogeneous_models: bool = True
+    TOWER_WEIGHTS = ('shared', 'per_channel')
 
     def __init__(self):
-        pass
+        # Graph state is per instance, models built one after the other must not share layers or tensors
+        self.keras_model = None
+        self.sub_models: List = []
+        self.input_layers: List = []
+        self.input_channels: int = None
+        self.homogeneous_models: bool = True
+        self.fold_channels: bool = False
+        self.tower_weights: str = 'shared'
 
     @staticmethod
     def builder():
@@ -53,7 +64,14 @@ class EnsembleModel:
             an input layer will be created for each sub-model using the Tuple. In models w/ non-homogeneous sub-models,
             an input layer will be created for each tuple in the List.
         """
-        if self.homogeneous_models:
+        if self.fold_channels:
+            num_timesteps = input_shape[0]
+            self.input_layers = [Input(shape=(num_timesteps, self.input_channels))]
+            if self.tower_weights == 'shared':
+                self.sub_models = [FoldChannels()(self.input_layers[0])]
+            else:
+                self.sub_models = [Reshape((num_timesteps, self.input_channels, 1))(self.input_layers[0])]
+        elif self.homogeneous_models:
             self.input_layers = [Input(shape=input_shape) for _ in range(self.input_channels)]
         else:
             if len(input_shape) != self.input_channels:
@@ -81,6 +99,12 @@ class EnsembleModel:
         if self.keras_model is not None:
             self.keras_model = layer(self.keras_model)
 
+        # For adding layers to the batched tower of all sub-models
+        elif self.fold_channels:
+            if self.tower_weights == 'per_channel':
+                layer = EnsembleModel.to_channelwise(layer)
+            self.sub_models = [layer(self.sub_models[0])]
+
         # For adding layers to all sub-models
         elif self.homogeneous_models:
             for idx in range(self.input_channels):
@@ -102,6 +126,30 @@ class EnsembleModel:
         else:
             print(f'Unable to add a layer to a non-homogeneous EnsembleModel without specifying the model index.')
 
+    @staticmethod
+    def to_channelwise(layer):
+        """
+        Translate a layer to its equivalent with per-channel weights, for folded models with per-channel tower weights.
+
+        Parameters
+        ----------
+        layer: Keras Layer
+            A Conv1D ('valid' padding), Dense or Flatten layer, or a layer without weights applied elementwise
+            (Dropout, Activation), which is returned as is.
+        """
+        if isinstance(layer, Conv1D):
+            if layer.padding != 'valid' or layer.dilation_rate != (1,):
+                raise ValueError("Per-channel Conv1D towers only support 'valid' padding without dilation.")
+            return ChannelwiseConv1D(layer.filters, layer.kernel_size[0], strides=layer.strides[0],
+                                     activation=layer.activation, use_bias=layer.use_bias)
+        if isinstance(layer, Dense):
+            return ChannelwiseDense(layer.units, activation=layer.activation, use_bias=layer.use_bias)
+        if isinstance(layer, Flatten):
+            return ChannelwiseFlatten()
+        if isinstance(layer, (Dropout, Activation)):
+            return layer
+        raise ValueError(f"{type(layer).__name__} layers cannot be used in towers with per-channel weights.")
+
     def merge_sub_models(self, func, **kwargs):
         """
         Merges sub models based on a function
@@ -111,7 +159,17 @@ class EnsembleModel:
         func: Callable
             The function that will be invoked to perform the merge across models. This function should have a positional
             argument that takes a list of Tensors. Can optionally pass kwargs to the function.
+            Folded models only support `concatenate`, which unfolds the batched tower in the order of the channels.
         """
+        if self.fold_channels:
+            if getattr(func, '__name__', None) != 'concatenate':
+                raise ValueError("Folded sub-models can only be merged with concatenate.")
+            if self.tower_weights == 'shared':
+                self.keras_model = UnfoldChannels(self.input_channels)(self.sub_models[0])
+            else:
+                self.keras_model = Flatten()(self.sub_models[0])
+            return
+
         # if self.homogeneous_models:
         #     sub_models = [Lambda(lambda x: identity(x))(self.sub_models[0]) for _ in range(self.input_channels)]
         # else:
@@ -141,20 +199,25 @@ class EnsembleModelBuilder:
     model: EnsembleModel
         The model that is being built by the builder.
     """
-    model: EnsembleModel = None
+    def __init__(self):
+        self.model: EnsembleModel = EnsembleModel()
 
     def with_input_channels(self, input_channels: int):
-        if self.model is None:
-            self.model = EnsembleModel()
         self.model.input_channels = input_channels
         return self
 
     def with_homogeneous_models(self, homogeneous_models: bool):
-        if self.model is None:
-            self.model = EnsembleModel()
         self.model.homogeneous_models = homogeneous_models
         return self
 
+    def with_folded_channels(self, tower_weights: str = 'shared'):
+        if tower_weights not in EnsembleModel.TOWER_WEIGHTS:
+            raise ValueError(f"Unknown tower weights '{tower_weights}', expected one of {EnsembleModel.TOWER_WEIGHTS}")
+        self.model.homogeneous_models = True
+        self.model.fold_channels = True
+        self.model.tower_weights = tower_weights
+        return self
+
     def build(self):
         return self.model
 
@@ -1,26 +1,52 @@
 from models.networks.abstract_models.ensemble_model import EnsembleModel
 from models.networks.abstract_models.base_model import BaseModel
 
-from keras.layers import Conv1D, Flatten, Dropout, Dense, concatenate
+from tensorflow.keras.layers import Conv1D, Flatten, Dropout, Dense, concatenate
+
+
+def build_cnn_ensemble(num_channels, num_timesteps, output_shape, params, tower_weights):
+    model = EnsembleModel.builder() \
+        .with_input_channels(num_channels) \
+        .with_folded_channels(tower_weights) \
+        .build()
+
+    model.add_input_layers(input_shape=(num_timesteps, 1))
+    model.add_layer(Conv1D(params['conv_1'], 5, activation='relu'))
+    model.add_layer(Conv1D(params['conv_2'], 5, activation='relu'))
+    model.add_layer(Flatten())
+    model.add_layer(Dropout(rate=params['dropout']))
+    model.add_layer(Dense(params['dense_1']))
+    model.add_layer(Dropout(rate=params['dropout']))
+    model.add_layer(Dense(params['dense_2']))
+    model.merge_sub_models(func=concatenate)
+    model.add_layer(Dense(params['dense_2'] * num_channels))
+    model.add_layer(Dense(output_shape, activation='softmax'))
+    model.compile()
+    return model.keras_model
+
+
+CNN_ENSEMBLE_PARAMS_RANGE = {'conv_1': {'type': 'integer', 'min': 8, 'max': 256, 'default': 128},
+                             'conv_2': {'type': 'integer', 'min': 8, 'max': 256, 'default': 64},
+                             'dropout': {'type': 'float', 'min': 0, 'max': 1, 'default': 0.5},
+                             'dense_1': {'type': 'integer', 'min': 8, 'max': 256, 'default': 64},
+                             'dense_2': {'type': 'integer', 'min': 8, 'max': 128, 'default': 32}}
 
 
 class CNNEnsemble1(BaseModel):
-    def build_model(self, num_channels, num_timesteps, output_shape):
-        model = EnsembleModel.builder() \
-            .with_input_channels(num_channels) \
-            .with_homogeneous_models(True) \
-            .build()
-
-        model.add_input_layers(input_shape=(num_timesteps, 1))
-        model.add_layer(Conv1D(128, 5, activation='relu'))
-        model.add_layer(Conv1D(64, 5, activation='relu'))
-        model.add_layer(Flatten())
-        model.add_layer(Dropout(rate=0.5))
-        model.add_layer(Dense(64))
-        model.add_layer(Dropout(rate=0.5))
-        model.add_layer(Dense(32))
-        model.merge_sub_models(func=concatenate)
-        model.add_layer(Dense(32 * num_channels))
-        model.add_layer(Dense(output_shape))
-        model.compile()
-        return model.keras_model
+    """CNN tower with the same weights for every channel, run on all channels at once."""
+
+    def set_params_range(self):
+        return dict(CNN_ENSEMBLE_PARAMS_RANGE)
+
+    def build_model(self, num_channels, num_timesteps, output_shape, params):
+        return build_cnn_ensemble(num_channels, num_timesteps, output_shape, params, tower_weights='shared')
+
+
+class CNNEnsembleChannelwise(BaseModel):
+    """CNN tower with separate weights for every channel, run on all channels at once."""
+
+    def set_params_range(self):
+        return dict(CNN_ENSEMBLE_PARAMS_RANGE)
+
+    def build_model(self, num_channels, num_timesteps, output_shape, params):
+        return build_cnn_ensemble(num_channels, num_timesteps, output_shape, params, tower_weights='per_channel')
@@ -22,7 +22,7 @@ class LSTMModel(BaseModel):
         model.add(BatchNormalization(momentum=params['momentum'], input_shape=(num_timesteps, num_channels)))
         model.add(Bidirectional(LSTM(params['lstm_size_1'], return_sequences=True)))
         model.add(Bidirectional(LSTM(params['lstm_size_2'], return_sequences=True)))
-        model.add(Attention(num_timesteps))
+        model.add(Attention())
         model.add(Dropout(params['dropout_1']))
         model.add(Dense(params['dense_size'], activation='elu'))
         model.add(Dropout(params['dropout_2']))
@@ -36,10 +36,10 @@ class GoogleModel(BaseModel):
     def set_params_range(self):
         return {'conv_1': {'type': 'integer', 'min': 8, 'max': 64, 'default': 16},
                 'conv_2': {'type': 'integer', 'min': 8, 'max': 64, 'default': 32},
-                'bi_1': {'type': 'float', 'min': 8, 'max': 128, 'default': 128},
+                'bi_1': {'type': 'integer', 'min': 8, 'max': 128, 'default': 128},
                 'bi_2': {'type': 'integer', 'min': 8, 'max': 128, 'default': 128},
                 'drop_1': {'type': 'float', 'min': 0, 'max': 1, 'default': 0.01},
-                'dense_1': {'type': 'float', 'min': 8, 'max': 128, 'default': 64},
+                'dense_1': {'type': 'integer', 'min': 8, 'max': 128, 'default': 64},
                 'drop_2': {'type': 'float', 'min': 0, 'max': 1, 'default': 0.05}
                 }
 
@@ -48,7 +48,6 @@ class GoogleModel(BaseModel):
         From: https://github.com/douglas125/SpeechCmdRecognition/blob/master/SpeechModels.py
 
         """
-        num_attention = num_timesteps - 8
         model = Sequential()
         model.add(Conv1D(params['conv_1'], 5, input_shape=(num_timesteps, num_channels)))
         model.add(BatchNormalization())
@@ -56,7 +55,7 @@ class GoogleModel(BaseModel):
         model.add(BatchNormalization())
         model.add(Bidirectional(LSTM(params['bi_1'], return_sequences=True)))
         model.add(Bidirectional(LSTM(params['bi_2'], return_sequences=True)))
-        model.add(Attention(num_attention))
+        model.add(Attention())
         model.add(Dropout(params['drop_1']))
         model.add(Dense(params['dense_1'], activation='elu'))
         model.add(Dropout(params['drop_2']))
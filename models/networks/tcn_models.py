@@ -0,0 +1,82 @@
+from tensorflow.keras.models import Model
+from tensorflow.keras.layers import Input, Dense, BatchNormalization, Dropout, SpatialDropout1D, Activation, Add, \
+    Conv1D, SeparableConv1D, ZeroPadding1D
+from models.networks.abstract_models.attention import Attention
+from models.networks.abstract_models.base_model import BaseModel
+
+
+"""
+Temporal convolutional networks (TCN): stacks of residual blocks of dilated causal convolutions, with the attention
+pooling head of the LSTM models. Every timestep of a block is computed at once, instead of one after the other as in
+an LSTM, and the dilation doubles with every block so the receptive field grows exponentially with the depth:
+1 + 2 * (kernel_size - 1) * (2^num_blocks - 1) timesteps.
+"""
+
+
+def causal_conv(X, filters, kernel_size, dilation_rate, separable):
+    """
+    Dilated causal convolution: the input is left-padded so the output at t only depends on timesteps <= t and has
+    the same length as the input. Separable convolutions only support 'valid' and 'same' padding, so the padding is
+    explicit for both.
+    """
+    X = ZeroPadding1D(padding=((kernel_size - 1) * dilation_rate, 0))(X)
+    conv = SeparableConv1D if separable else Conv1D
+    return conv(filters, kernel_size, dilation_rate=dilation_rate, padding='valid')(X)
+
+
+def residual_block(X, filters, kernel_size, dilation_rate, dropout, separable):
+    shortcut = X
+    for _ in range(2):
+        X = causal_conv(X, filters, kernel_size, dilation_rate, separable)
+        X = BatchNormalization()(X)
+        X = Activation('relu')(X)
+        X = SpatialDropout1D(dropout)(X)
+
+    if shortcut.shape[-1] != filters:
+        shortcut = Conv1D(filters, 1)(shortcut)
+    return Activation('relu')(Add()([X, shortcut]))
+
+
+def build_tcn(num_channels, num_timesteps, output_shape, params, separable):
+    inputs = Input(shape=(num_timesteps, num_channels))
+    X = BatchNormalization(momentum=params['momentum'])(inputs)
+    for block in range(int(params['num_blocks'])):
+        X = residual_block(X, int(params['filters']), int(params['kernel_size']), 2 ** block, params['spatial_dropout'],
+                           separable)
+    X = Attention()(X)
+    X = Dropout(params['dropout_1'])(X)
+    X = Dense(int(params['dense_size']), activation='elu')(X)
+    X = Dropout(params['dropout_2'])(X)
+    outputs = Dense(output_shape, activation='softmax')(X)
+    return Model(inputs=inputs, outputs=outputs)
+
+
+TCN_PARAMS_RANGE = {'momentum': {'type': 'float', 'min': 0, 'max': 1, 'default': 0.9},
+                    'filters': {'type': 'integer', 'min': 16, 'max': 256, 'default': 64},
+                    'kernel_size': {'type': 'integer', 'min': 2, 'max': 9, 'default': 5},
+                    'num_blocks': {'type': 'integer', 'min': 2, 'max': 8, 'default': 6},
+                    'spatial_dropout': {'type': 'float', 'min': 0, 'max': 0.5, 'default': 0.1},
+                    'dropout_1': {'type': 'float', 'min': 0, 'max': 1, 'default': 0.5},
+                    'dense_size': {'type': 'integer', 'min': 10, 'max': 800, 'default': 500},
+                    'dropout_2': {'type': 'float', 'min': 0, 'max': 1, 'default': 0.5}
+                    }
+
+
+class TCNModel(BaseModel):
+    """TCN of dilated causal Conv1D blocks. The default receptive field, 505 timesteps, covers a whole window."""
+
+    def set_params_range(self):
+        return dict(TCN_PARAMS_RANGE)
+
+    def build_model(self, num_channels, num_timesteps, output_shape, params):
+        return build_tcn(num_channels, num_timesteps, output_shape, params, separable=False)
+
+
+class SeparableTCNModel(BaseModel):
+    """TCNModel with depthwise separable convolutions: fewer weights and operations per block."""
+
+    def set_params_range(self):
+        return dict(TCN_PARAMS_RANGE)
+
+    def build_model(self, num_channels, num_timesteps, output_shape, params):
+        return build_tcn(num_channels, num_timesteps, output_shape, params, separable=True)
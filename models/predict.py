@@ -0,0 +1,282 @@
+from utils import *
+from datagen.dataset_view import get_spectra_loader
+from datagen.loadmatlab import mat_to_spectra
+from datagen.spectra_loader import read_shard, NUM_WORKERS
+from models.export import prepare_spectra
+from models.spectra_transforms import TimestepTransform, ZoomTransform
+import collections
+import csv
+import glob
+import json
+import multiprocessing
+import time
+import numpy as np
+
+
+"""
+Bulk scoring of datasets and collections of .mat spectra, streamed through a model in fixed-size batches with bounded
+memory (`run_train.py predict`).
+
+Worker processes decode the shards (or chunks of .mat files) and apply the channels and transforms of the run, at most
+`prefetch` of them ahead of the model, while the main process predicts: decoding overlaps with inference, and memory
+holds about `prefetch + 1` decoded shards whatever the size of the dataset. Predictions are appended to the output file
+as they are made, one row per record: its ID, the predicted number of peaks, the probability of every class and the
+true number of peaks when the records have one.
+ - .parquet (needs pyarrow): one row group per `ROW_GROUP_SIZE` records
+ - .csv
+Record IDs are `<shard file>:<offset in the shard>` for datasets (the offset in the shard of the base dataset for
+views) and the file name for .mat spectra.
+"""
+
+
+OUTPUT_FORMATS = ('.parquet', '.csv')
+ROW_GROUP_SIZE = 65536
+MAT_FILES_PER_TASK = 256
+RECORD_ID = "record_id"
+NUM_PEAKS = "num_peaks"
+TRUE_NUM_PEAKS = "true_num_peaks"
+
+
+def get_dataset_tasks(dataset_name, subset_prefixes, prep):
+    """
+    :param dataset_name: str dataset or view
+    :param subset_prefixes: list of str subsets to score, e.g. [TRAIN_DATASET_PREFIX, TEST_DATASET_PREFIX]
+    :param prep: dict `prepare_spectra` arguments (serialized transforms)
+    :return: list of decoding tasks, one per shard
+    """
+    tasks = []
+    for subset_prefix in subset_prefixes:
+        loader = get_spectra_loader(dataset_name, subset_prefix, eval_now=False)
+        tasks += [('shard', loader.get_shard_task(filepath), prep) for filepath in loader.get_data_files()]
+    return tasks
+
+
+def get_mat_tasks(path, prep, files_per_task=MAT_FILES_PER_TASK):
+    """
+    :param path: str directory of .mat files or glob pattern
+    :param prep: dict `prepare_spectra` arguments (serialized transforms)
+    :param files_per_task: int number of .mat files decoded by a task
+    :return: list of decoding tasks
+    """
+    files = sorted(glob.glob(os.path.join(path, "*.mat") if os.path.isdir(path) else path))
+    if not files:
+        raise FileNotFoundError(f"No .mat files in {path}")
+    return [('mat', files[start:start + files_per_task], prep) for start in range(0, len(files), files_per_task)]
+
+
+def decode_task(task):
+    """
+    Decode and prepare the spectra of a task. Runs in the worker processes of `iter_decoded`.
+
+    :param task: (kind, payload, prep) from `get_dataset_tasks` or `get_mat_tasks`
+    :return: (list of str record IDs, np.array model inputs, np.array true numbers of peaks, -1 where unknown)
+    """
+    kind, payload, prep = task
+    if kind == 'shard':
+        records = read_shard(*payload)
+        name = os.path.basename(payload[0])
+        offsets = payload[2] if len(payload) > 2 else range(len(records))
+        record_ids = [f"{name}:{offset}" for offset in offsets]
+        dm = [record['dm'] for record in records]
+        labels = [record.get('n') for record in records]
+    else:
+        spectra = [mat_to_spectra(filepath) for filepath in payload]
+        record_ids = [os.path.basename(filepath) for filepath in payload]
+        dm = [spectrum.dm for spectrum in spectra]
+        labels = [spectrum.n for spectrum in spectra]
+    if not record_ids:
+        return [], None, None
+    X = prepare_spectra(np.asarray(dm, dtype=np.float32), prep['num_channels'],
+                        zoom_transform=ZoomTransform.from_config(prep.get('zoom')),
+                        timestep_transform=TimestepTransform.from_config(prep.get('timestep_transform')))
+    labels = np.array([-1 if label is None else int(label) for label in labels], dtype=np.int32)
+    return record_ids, X, labels
+
+
+def iter_decoded(tasks, num_workers=NUM_WORKERS, prefetch=None):
+    """
+    Decode tasks in worker processes, in order, with at most `prefetch` tasks decoded ahead of the consumer.
+
+    :param tasks: list of decoding tasks
+    :param num_workers: int number of worker processes, 0 to decode in this process
+    :param prefetch: int tasks decoded ahead, by default 2 per worker
+    :return: generator of `decode_task` results
+    """
+    if num_workers == 0:
+        for task in tasks:
+            yield decode_task(task)
+        return
+
+    prefetch = max(prefetch or 2 * num_workers, 1)
+    with multiprocessing.Pool(processes=num_workers) as pool:
+        pending = collections.deque()
+        tasks = iter(tasks)
+        for task in tasks:
+            pending.append(pool.apply_async(decode_task, (task,)))
+            if len(pending) >= prefetch:
+                break
+        while pending:
+            decoded = pending.popleft().get()
+            task = next(tasks, None)
+            if task is not None:
+                pending.append(pool.apply_async(decode_task, (task,)))
+            yield decoded
+
+
+def iter_batches(decoded, batch_size):
+    """
+    :param decoded: iterable of (record IDs, model inputs, true numbers of peaks)
+    :param batch_size: int
+    :return: generator of the same, in batches of `batch_size` records (the last one may be smaller)
+    """
+    record_ids, X, labels = [], [], []
+    num_buffered = 0
+    for decoded_ids, decoded_X, decoded_labels in decoded:
+        if not decoded_ids:
+            continue
+        record_ids += decoded_ids
+        X.append(decoded_X)
+        labels.append(decoded_labels)
+        num_buffered += len(decoded_ids)
+        if num_buffered < batch_size:
+            continue
+        X, labels = np.concatenate(X), np.concatenate(labels)
+        start = 0
+        while num_buffered - start >= batch_size:
+            yield record_ids[start:start + batch_size], X[start:start + batch_size], labels[start:start + batch_size]
+            start += batch_size
+        record_ids, X, labels = record_ids[start:], [X[start:]], [labels[start:]]
+        num_buffered -= start
+    if num_buffered > 0:
+        yield record_ids, np.concatenate(X), np.concatenate(labels)
+
+
+class CsvPredictionWriter:
+    def __init__(self, path, class_labels, metadata=None):
+        """
+        :param path: str output file
+        :param class_labels: list of str class names, the number of peaks of every class
+        :param metadata: dict, not written (CSV has no place for it)
+        """
+        self.file = open(path, "w", newline="")
+        self.writer = csv.writer(self.file)
+        self.writer.writerow([RECORD_ID, NUM_PEAKS] + [f"p_{label}" for label in class_labels] + [TRUE_NUM_PEAKS])
+
+    def write(self, record_ids, num_peaks, probs, labels):
+        for row in zip(record_ids, num_peaks.tolist(), probs.tolist(), labels.tolist()):
+            self.writer.writerow([row[0], row[1]] + [f"{p:.6g}" for p in row[2]] + ["" if row[3] < 0 else row[3]])
+
+    def close(self):
+        self.file.close()
+
+
+class ParquetPredictionWriter:
+    def __init__(self, path, class_labels, metadata=None, row_group_size=ROW_GROUP_SIZE):
+        """
+        :param path: str output file
+        :param class_labels: list of str class names, the number of peaks of every class
+        :param metadata: dict stored in the schema metadata of the file, e.g. the run and the source
+        :param row_group_size: int records buffered before a row group is written
+        """
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError("Writing .parquet predictions needs pyarrow ('pip install pyarrow'), or write a .csv")
+        self.pa = pa
+        self.prob_names = [f"p_{label}" for label in class_labels]
+        fields = [pa.field(RECORD_ID, pa.string()), pa.field(NUM_PEAKS, pa.int32())] + \
+            [pa.field(name, pa.float32()) for name in self.prob_names] + [pa.field(TRUE_NUM_PEAKS, pa.int32())]
+        schema_metadata = {key: json.dumps(value) for key, value in (metadata or {}).items()}
+        self.schema = pa.schema(fields, metadata=schema_metadata)
+        self.writer = pq.ParquetWriter(path, self.schema)
+        self.row_group_size = row_group_size
+        self.buffered = []
+        self.num_buffered = 0
+
+    def write(self, record_ids, num_peaks, probs, labels):
+        self.buffered.append((record_ids, num_peaks, probs, labels))
+        self.num_buffered += len(record_ids)
+        if self.num_buffered >= self.row_group_size:
+            self.flush()
+
+    def flush(self):
+        if not self.buffered:
+            return
+        record_ids = [record_id for batch in self.buffered for record_id in batch[0]]
+        num_peaks = np.concatenate([batch[1] for batch in self.buffered]).astype(np.int32)
+        probs = np.concatenate([batch[2] for batch in self.buffered]).astype(np.float32)
+        labels = np.concatenate([batch[3] for batch in self.buffered])
+        columns = [self.pa.array(record_ids, self.pa.string()), self.pa.array(num_peaks)] + \
+            [self.pa.array(probs[:, i]) for i in range(probs.shape[1])] + \
+            [self.pa.array(labels, mask=labels < 0)]
+        self.writer.write_table(self.pa.Table.from_arrays(columns, schema=self.schema))
+        self.buffered = []
+        self.num_buffered = 0
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+
+def open_prediction_writer(path, class_labels, metadata=None):
+    """
+    :param path: str output file, its extension is one of OUTPUT_FORMATS
+    :param class_labels: list of str class names
+    :param metadata: dict describing the predictions, kept by formats that can store it
+    :return: prediction writer, with `write(record_ids, num_peaks, probs, labels)` and `close()`
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.parquet':
+        return ParquetPredictionWriter(path, class_labels, metadata=metadata)
+    if extension == '.csv':
+        return CsvPredictionWriter(path, class_labels, metadata=metadata)
+    raise ValueError(f"Unknown output format {extension}, expected one of {OUTPUT_FORMATS}")
+
+
+def predict_to_file(predictor, tasks, output_path, class_labels, batch_size=256, num_workers=NUM_WORKERS,
+                    prefetch=None, metadata=None):
+    """
+    Stream the records of decoding tasks through a model and write the predictions.
+
+    :param predictor: callable mapping a batch of model inputs to class probabilities
+    :param tasks: list of decoding tasks, from `get_dataset_tasks` or `get_mat_tasks`
+    :param output_path: str output file, see `open_prediction_writer`
+    :param class_labels: list of str class names
+    :param batch_size: int number of spectra per prediction
+    :param num_workers: int number of decoding processes, 0 to decode in this process
+    :param prefetch: int tasks decoded ahead of the model
+    :param metadata: dict describing the predictions
+    :return: dict summary: records, seconds, records per second, time spent waiting for decoded spectra and
+             predicting, and accuracy over the records with a known number of peaks
+    """
+    writer = open_prediction_writer(output_path, class_labels, metadata=metadata)
+    num_records, num_labelled, num_correct = 0, 0, 0
+    wait_seconds, predict_seconds = 0.0, 0.0
+    start = time.perf_counter()
+    try:
+        batches = iter_batches(iter_decoded(tasks, num_workers=num_workers, prefetch=prefetch), batch_size)
+        while True:
+            wait_start = time.perf_counter()
+            batch = next(batches, None)
+            predict_start = time.perf_counter()
+            wait_seconds += predict_start - wait_start
+            if batch is None:
+                break
+            record_ids, X, labels = batch
+            probs = np.asarray(predictor(X))
+            predict_seconds += time.perf_counter() - predict_start
+            num_peaks = probs.argmax(axis=1) + 1
+            writer.write(record_ids, num_peaks, probs, labels)
+            num_records += len(record_ids)
+            num_labelled += int(np.sum(labels >= 0))
+            num_correct += int(np.sum(num_peaks[labels >= 0] == labels[labels >= 0]))
+    finally:
+        writer.close()
+    seconds = time.perf_counter() - start
+    return {'records': num_records,
+            'seconds': round(seconds, 3),
+            'records_per_second': round(num_records / max(seconds, 1e-9), 1),
+            'decode_wait_seconds': round(wait_seconds, 3),
+            'predict_seconds': round(predict_seconds, 3),
+            'accuracy': round(num_correct / num_labelled, 4) if num_labelled else None}
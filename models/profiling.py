@@ -0,0 +1,240 @@
+from utils import *
+from tensorflow.keras.callbacks import Callback
+import collections
+import contextlib
+import sys
+import threading
+import time
+import click
+import tensorflow as tf
+
+
+"""
+Profiles of real training and evaluation runs, saved under their results directory:
+ - a TensorFlow profiler trace (op-level, host and device) of a window of train steps, viewed with the profile plugin
+   of TensorBoard (`tensorboard --logdir <run>/profile/trace`)
+ - Python sampling profiles of the input pipeline (the SpectraPreprocessor training generators) during that window and
+   of the stages of an EvaluationReport, in collapsed stack format (`<name>.collapsed`, one `frame;frame;... count`
+   line per stack, for flamegraph.pl or speedscope) with a summary of the busiest functions (`<name>.txt`)
+"""
+
+
+PROFILE_DIRNAME = "profile"
+TRACE_DIRNAME = "trace"
+SAMPLING_INTERVAL = 0.005  # seconds between Python stack samples
+NUM_TOP_FUNCTIONS = 25
+
+
+def parse_step_window(ctx, param, step_window):
+    """
+    Click callback parsing a window of train steps.
+
+    :param step_window: str 'START:STOP', steps counted from 1 over all epochs, both included, or None
+    :return: (int, int) or None
+    """
+    if step_window is None:
+        return None
+    try:
+        start, stop = (int(step) for step in step_window.split(':'))
+    except ValueError:
+        raise click.BadParameter("expected START:STOP, e.g. '20:40'")
+    if start < 1 or stop < start:
+        raise click.BadParameter("expected 1 <= START <= STOP")
+    return start, stop
+
+
+def get_frame_name(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class SamplingProfiler:
+    """
+    Samples, from a background thread, the Python stacks of the threads running the input pipeline (generators wrapped
+    with `wrap`) and of the thread running the current stage (`stage`). Stacks are recorded from the wrapped generator
+    or from the code that entered the stage, under a root frame naming them.
+    """
+
+    def __init__(self, interval=SAMPLING_INTERVAL):
+        """
+        :param interval: float seconds between samples
+        """
+        self.interval = interval
+        self.counts = collections.Counter()  # {tuple of frame names: number of samples}
+        self.num_samples = 0
+        self.stage_seconds = {}
+        self.input_threads = set()
+        self.current_stage = None  # (name, thread ident, frame the stage was entered from)
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def _run(self):
+        while not self.stop_event.wait(self.interval):
+            self.sample()
+
+    def sample(self):
+        frames = sys._current_frames()
+        for ident in list(self.input_threads):
+            stack = self._get_stack(frames.get(ident), lambda frame: frame.f_code is SamplingProfiler.wrap.__code__)
+            # Threads waiting to be asked for the next batch are not running the input pipeline
+            if stack is not None:
+                self.counts[("input_pipeline",) + stack] += 1
+        current_stage = self.current_stage
+        if current_stage is not None:
+            name, ident, root = current_stage
+            stack = self._get_stack(frames.get(ident), lambda frame: frame is root)
+            if stack is not None:
+                self.counts[(name,) + stack] += 1
+        self.num_samples += 1
+
+    @staticmethod
+    def _get_stack(frame, is_root):
+        """
+        :param frame: innermost frame of a thread, or None
+        :param is_root: function(frame) -> bool, True for the frame the stack is recorded from (excluded)
+        :return: tuple of frame names, outermost first, or None if the thread is not below a root frame
+        """
+        names = []
+        while frame is not None:
+            if is_root(frame):
+                return tuple(reversed(names))
+            names.append(get_frame_name(frame))
+            frame = frame.f_back
+        return None
+
+    def wrap(self, generator):
+        """
+        :param generator: generator of the input pipeline
+        :return: generator of the same items, sampled while they are produced
+        """
+        while True:
+            # tf.data may call the generator from several threads
+            self.input_threads.add(threading.get_ident())
+            try:
+                item = next(generator)
+            except StopIteration:
+                return
+            yield item
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        Context manager sampling the calling thread, under a root frame `name`, and timing the stage.
+
+        :param name: str
+        """
+        root = sys._getframe(2)  # frame of the `with` statement, below this generator and contextlib
+        start = time.perf_counter()
+        self.current_stage = (name, threading.get_ident(), root)
+        try:
+            yield
+        finally:
+            self.current_stage = None
+            self.stage_seconds[name] = self.stage_seconds.get(name, 0.0) + time.perf_counter() - start
+
+    def save(self, directory, name):
+        """
+        Write the samples in collapsed stack format and a summary of the busiest functions.
+
+        :param directory: str
+        :param name: str base name of the files
+        :return: str path of the summary
+        """
+        try_create_directory(directory, silent=True)
+        with open(os.path.join(directory, f"{name}.collapsed"), "w") as f:
+            for stack, count in self.counts.most_common():
+                f.write(f"{';'.join(stack)} {count}\n")
+
+        summary_path = os.path.join(directory, f"{name}.txt")
+        with open(summary_path, "w") as f:
+            f.write("\n".join(self.get_summary()) + "\n")
+        return summary_path
+
+    def get_summary(self):
+        """
+        :return: list of str lines: samples and time of every root, and the functions with the most samples, by own
+                 (self) samples and including the functions they call (total)
+        """
+        roots = collections.Counter()
+        own = collections.Counter()
+        total = collections.Counter()
+        for stack, count in self.counts.items():
+            roots[stack[0]] += count
+            if len(stack) > 1:
+                own[stack[-1]] += count
+            for frame_name in set(stack[1:]):
+                total[frame_name] += count
+
+        lines = [f"{self.num_samples} samples every {1000 * self.interval:g} ms", ""]
+        for root, count in roots.most_common():
+            seconds = self.stage_seconds.get(root)
+            timing = "" if seconds is None else f", stage took {seconds:.2f} s"
+            lines.append(f"{root}: {count} samples (~{count * self.interval:.2f} s){timing}")
+        for title, counter in (("self", own), ("total", total)):
+            lines += ["", f"Top functions ({title} samples):"]
+            lines += [f"{count:8d}  {frame_name}" for frame_name, count in counter.most_common(NUM_TOP_FUNCTIONS)]
+        return lines
+
+
+def profile_stage(profiler, name):
+    """
+    :param profiler: SamplingProfiler or None
+    :param name: str
+    :return: context manager sampling the stage, doing nothing without a profiler
+    """
+    return contextlib.nullcontext() if profiler is None else profiler.stage(name)
+
+
+class StepProfiler(Callback):
+    """
+    Captures a TensorFlow profiler trace of a window of train steps, and a sampling profile of the input pipeline during
+    the same steps, into `directory`.
+    """
+
+    def __init__(self, directory, step_window, sampling_profiler=None):
+        """
+        :param directory: str profile directory of the run
+        :param step_window: (int, int) first and last profiled steps, counted from 1 over all epochs
+        :param sampling_profiler: optional SamplingProfiler wrapping the input pipeline
+        """
+        super(StepProfiler, self).__init__()
+        self.directory = directory
+        self.start_step, self.stop_step = step_window
+        self.sampling_profiler = sampling_profiler
+        self.step = 0
+        self.active = False
+
+    def on_train_batch_begin(self, batch, logs=None):
+        self.step += 1
+        if self.step == self.start_step:
+            tf.profiler.experimental.start(os.path.join(self.directory, TRACE_DIRNAME))
+            if self.sampling_profiler is not None:
+                self.sampling_profiler.start()
+            self.active = True
+
+    def on_train_batch_end(self, batch, logs=None):
+        if self.active and self.step >= self.stop_step:
+            self.stop()
+
+    def on_train_end(self, logs=None):
+        if self.active:
+            self.stop()
+
+    def stop(self):
+        tf.profiler.experimental.stop()
+        self.active = False
+        if self.sampling_profiler is not None:
+            self.sampling_profiler.stop()
+            self.sampling_profiler.save(self.directory, "input_pipeline")
+        print(f"Saved the profile of steps {self.start_step} to {self.step} to {to_local_path(self.directory)}")
@@ -3,11 +3,30 @@ import os
 import json
 from comet_ml import Optimizer
 from models.spectra_preprocessor import SpectraPreprocessor
-from datagen.spectra_loader import SpectraLoader
+from models.spectra_transforms import TimestepTransform, SpectraAugmenter, ZoomTransform, prune_cache
+from models.sampler import LabelSampler
+from datagen.spectra_loader import SpectraLoader, NUM_WORKERS
+from datagen.splits import SPLIT_METHODS, create_split_views
 from datetime import datetime
 import click
+import multiprocessing
+import tempfile
+import numpy as np
 from comet_connection import CometConnection
 from models.evaluator import complete_evaluation, EvaluationReport
+from models.networks.abstract_models.base_model import BaseModel, PRECISIONS
+from models.distributed import STRATEGIES, get_strategy, get_worker_shard, is_chief
+from models.shared_data import SharedDataRegistry
+from models.hpo import SEARCH_ALGORITHMS, SCHEDULERS, FIFOScheduler, ASHAScheduler, SchedulerCallback, get_score, \
+    limit_cpus, run_search
+from models.checkpoints import Checkpoint, EarlyStopping, load_early_stopping, read_checkpoint
+from models.step_timing import StepTimer
+from models.profiling import PROFILE_DIRNAME, SamplingProfiler, StepProfiler, parse_step_window, profile_stage
+from memory_accounting import ACCOUNTING, enable_memory_accounting, get_memory_report
+from models.export import EXPORT_DIRNAME, QUANTIZATIONS, SAVED_MODEL, ExportedModel, export_run, get_keras_predictor, \
+    print_report, use_cpu_only
+from models.predict import OUTPUT_FORMATS, get_dataset_tasks, get_mat_tasks, predict_to_file
+from models.serving import DEFAULT_PORT, create_server
 from sklearn.metrics import confusion_matrix
 
 
@@ -24,6 +43,7 @@ COMPILE_DICT = {'optimizer': 'adam','loss': 'categorical_crossentropy', 'metrics
 OPTIMIZE_PARAMS = {'algorithm': 'bayes', 'spec': {'metric': 'loss', 'objective': 'minimize'}}
 
 GENERATOR_LIMIT = 10000  # The minimum number of data points where fit generator should be used
+SEARCH_FILENAME = "search.json"
 
 
 loaded_models = None  # Static var to save dynamically loaded architecture models
@@ -84,16 +104,30 @@ def load_dataset_info(dataset_name):
     return dataset_config
 
 
-def load_data(dataset_name, dataset_config):
+def load_data(model, dataset_name, num_channels, num_instances, use_generator=False, load_train=True,
+              num_workers=NUM_WORKERS, shared_data=None):
     """
-    Create Spectra Preprocessor given dataset name and config.
+    Create Spectra Preprocessor given dataset name, applying the preprocessing the model is trained with.
 
+    :param model: model object instance, trained models with a distribution strategy only get this worker's share of
+                  the training data
     :param dataset_name: string dataset name
-    :param dataset_config: dict dataset config
+    :param num_channels: int number of channels to use from data
+    :param num_instances: int number of instances of spectra in data
+    :param use_generator: bool load shards lazily through the generator
+    :param load_train: bool load the training set
+    :param num_workers: int number of processes decoding shards
+    :param shared_data: optional SharedDataRegistry the train and test sets are shared through
     :return: SpectraPreprocessor
     """
-    use_generator = dataset_config["num_instances"] > GENERATOR_LIMIT
-    spectra_pp = SpectraPreprocessor(dataset_name=dataset_name, use_generator=use_generator)
+    spectra_pp = SpectraPreprocessor(dataset_name=dataset_name, num_channels=num_channels, num_instances=num_instances,
+                                     use_generator=use_generator, load_train=load_train,
+                                     timestep_transform=TimestepTransform.from_config(model.timestep_transform),
+                                     augmenter=SpectraAugmenter.from_config(model.augmentation),
+                                     zoom_transform=ZoomTransform.from_config(model.zoom),
+                                     sampler=LabelSampler.from_config(model.sampling), num_workers=num_workers,
+                                     input_shard=(0, 1) if model.strategy is None else get_worker_shard(),
+                                     shared_data=shared_data)
     return spectra_pp
 
 
@@ -109,7 +143,159 @@ def get_prior_config(result_dirname):
     return result_info
 
 
-def initialize_model(dataset_name, model_name, model_module_index, num_channels, num_instances):
+def get_timestep_transform(timestep_mode, timestep_factor, crop_outside='relabel'):
+    """
+    Create the timestep transform selected on the command line.
+
+    :param timestep_mode: string one of TimestepTransform.MODES, or 'none'
+    :param timestep_factor: int factor by which to reduce the number of timesteps
+    :param crop_outside: string how to handle peaks in the cropped margins, one of ZoomTransform.OUTSIDE_POLICIES
+    :return: TimestepTransform or None
+    """
+    if timestep_mode is None or timestep_mode == 'none' or timestep_factor == 1:
+        return None
+    return TimestepTransform(mode=timestep_mode, factor=timestep_factor, outside=crop_outside)
+
+
+def get_augmenter(noise_epsilon2, permute_channels, max_shift, augment_seed):
+    """
+    Create the train-time augmenter selected on the command line.
+
+    :param noise_epsilon2: float scales white noise added to training batches, as epsilon2 does in the generator
+    :param permute_channels: bool randomly permute the channels of training spectra
+    :param max_shift: int maximum number of timesteps training spectra are shifted by
+    :param augment_seed: int base seed of the augmentation, combined with the epoch number
+    :return: SpectraAugmenter or None
+    """
+    augmenter = SpectraAugmenter(epsilon2=noise_epsilon2, permute_channels=permute_channels, max_shift=max_shift,
+                                 seed=augment_seed)
+    if augmenter.is_identity():
+        return None
+    return augmenter
+
+
+def get_zoom_transform(dataset_name, gamma_amp_factor, zoom_outside):
+    """
+    Create the zoom transform selected on the command line.
+
+    :param dataset_name: string dataset name
+    :param gamma_amp_factor: float target effective gamma amp factor, or None for no zoom
+    :param zoom_outside: string how to handle peaks outside the zoomed window, one of ZoomTransform.OUTSIDE_POLICIES
+    :return: ZoomTransform or None
+    """
+    if gamma_amp_factor is None:
+        return None
+    return ZoomTransform.from_dataset_config(load_dataset_info(dataset_name), gamma_amp_factor, outside=zoom_outside)
+
+
+def parse_class_weights(ctx, param, class_weights):
+    """
+    Parse class weights given on the command line.
+
+    :param ctx: Click context object
+    :param param: Click arg
+    :param class_weights: string such as '1:1,2:1,3:2,4:2'
+    :return: dict {label: weight} or None
+    """
+    if not class_weights:
+        return None
+    try:
+        return {int(label): float(weight) for label, weight in
+                (pair.split(':') for pair in class_weights.split(','))}
+    except ValueError:
+        raise click.BadParameter("expected comma separated '<num peaks>:<weight>' pairs")
+
+
+def get_sampler(sampling, class_weights, sample_replace, samples_per_epoch, sample_seed):
+    """
+    Create the training sampler selected on the command line.
+
+    :param sampling: string 'none' or one of LabelSampler.STRATEGIES
+    :param class_weights: dict {label: weight} for the 'weighted' strategy
+    :param sample_replace: bool sample with replacement
+    :param samples_per_epoch: int number of spectra drawn per epoch, or None for the sampler's default
+    :param sample_seed: int base seed of the sampler
+    :return: LabelSampler or None
+    """
+    if sampling == 'none':
+        return None
+    return LabelSampler(strategy=sampling, class_weights=class_weights, replace=sample_replace,
+                        num_samples=samples_per_epoch, seed=sample_seed)
+
+# Preprocessing of the training data, shared by the commands that train new models (see `initialize_pipeline_model`)
+PIPELINE_OPTIONS = [
+    click.option("--timestep-mode", type=click.Choice(('none',) + TimestepTransform.MODES), default='none',
+                 help="how to reduce the number of timesteps of each spectrum before training"),
+    click.option("--timestep-factor", type=click.IntRange(min=1), default=1,
+                 help="factor by which the number of timesteps is reduced"),
+    click.option("--crop-outside", type=click.Choice(ZoomTransform.OUTSIDE_POLICIES), default='relabel',
+                 help="relabel spectra with peaks in the margins removed by --timestep-mode crop, or discard them"),
+    click.option("--noise-epsilon2", type=click.FloatRange(min=0), default=0.0,
+                 help="white noise added to training batches: D + epsilon2*max(D)*rand"),
+    click.option("--permute-channels/--no-permute-channels", default=False,
+                 help="randomly permute the channels of training spectra"),
+    click.option("--max-shift", type=click.IntRange(min=0), default=0,
+                 help="maximum number of timesteps training spectra are (circularly) shifted by"),
+    click.option("--augment-seed", type=int, default=42, help="seed of the train-time augmentation"),
+    click.option("--gamma-amp-factor", type=click.FloatRange(min=0), default=None,
+                 help="zoom the spectral window to emulate data generated with this (lower) gamma amp factor"),
+    click.option("--zoom-outside", type=click.Choice(ZoomTransform.OUTSIDE_POLICIES), default='relabel',
+                 help="relabel spectra with peaks outside the zoomed window, or discard them"),
+    click.option("--sampling", type=click.Choice(('none',) + LabelSampler.STRATEGIES), default='none',
+                 help="draw class-balanced or class-weighted training batches"),
+    click.option("--class-weights", callback=parse_class_weights, default=None,
+                 help="weights of the 'weighted' sampling, e.g. '1:1,2:1,3:2,4:2'"),
+    click.option("--sample-replace/--sample-no-replace", default=True,
+                 help="sample training spectra with or without replacement"),
+    click.option("--samples-per-epoch", type=click.IntRange(min=1), default=None,
+                 help="number of training spectra drawn per epoch"),
+    click.option("--sample-seed", type=int, default=42, help="seed of the training sampler"),
+]
+
+
+def pipeline_options(command):
+    """
+    Add PIPELINE_OPTIONS to a command, they are passed to `initialize_pipeline_model`.
+
+    :param command: Click command function
+    :return: decorated command function
+    """
+    for option in reversed(PIPELINE_OPTIONS):
+        command = option(command)
+    return command
+
+
+def get_prior_timestep_transform(result_dirname):
+    """
+    Load the timestep transform a previous run was trained with.
+
+    :param result_dirname: directory name of result
+    :return: TimestepTransform or None
+    """
+    return TimestepTransform.from_config(get_prior_config(result_dirname).get('timestep_transform'))
+
+
+def get_prior_zoom_transform(result_dirname):
+    """
+    Load the zoom transform a previous run was trained with.
+
+    :param result_dirname: directory name of result
+    :return: ZoomTransform or None
+    """
+    return ZoomTransform.from_config(get_prior_config(result_dirname).get('zoom'))
+
+
+def get_compile_dict(jit_compile=False, precision='float32'):
+    """
+    :param jit_compile: bool compile the train and predict steps with XLA
+    :param precision: str one of PRECISIONS
+    :return: dict COMPILE_DICT with the compile options, stored in the run's info.json
+    """
+    return dict(COMPILE_DICT, jit_compile=jit_compile, precision=precision)
+
+
+def initialize_model(dataset_name, model_name, model_module_index, num_channels, num_instances,
+                     timestep_transform=None, zoom_transform=None):
     """
     Initialize model based on dataset information.
 
@@ -118,6 +304,8 @@ def initialize_model(dataset_name, model_name, model_module_index, num_channels,
     :param model_module_index: index of loaded module
     :param num_channels: int number of channels in data to use
     :param num_instances: int number of spectra
+    :param timestep_transform: optional TimestepTransform, the model is built with the transformed number of timesteps
+    :param zoom_transform: optional ZoomTransform, applied before timestep_transform
     :return: dict dataset config and model object instance
     """
     dataset_config = load_dataset_info(dataset_name)
@@ -126,14 +314,81 @@ def initialize_model(dataset_name, model_name, model_module_index, num_channels,
     dataset_config['num_channels'] = num_channels
     dataset_config['num_instances_used'] = num_instances
 
+    num_timesteps = dataset_config['num_timesteps']
+    if zoom_transform is not None:
+        num_timesteps = zoom_transform.get_num_timesteps(num_timesteps)
+        dataset_config['zoom_transform'] = str(zoom_transform)
+    if timestep_transform is not None:
+        num_timesteps = timestep_transform.get_num_timesteps(num_timesteps)
+        dataset_config['timestep_transform'] = str(timestep_transform)
+    dataset_config['num_timesteps_used'] = num_timesteps
+
     module, package_name = get_module(model_module_index)
-    model = load_model(module, model_name, num_channels, dataset_config['n_max'], dataset_config['num_timesteps'])
+    model = load_model(module, model_name, num_channels, dataset_config['n_max'], num_timesteps)
+    if timestep_transform is not None:
+        model.timestep_transform = timestep_transform.serialize()
+    if zoom_transform is not None:
+        model.zoom = zoom_transform.serialize()
 
     return dataset_config, model
 
 
+
+def initialize_pipeline_model(dataset_name, model_name, model_module_index, num_channels, num_instances,
+                              timestep_mode='none', timestep_factor=1, crop_outside='relabel', noise_epsilon2=0.0,
+                              permute_channels=False, max_shift=0, augment_seed=42, gamma_amp_factor=None,
+                              zoom_outside='relabel', sampling='none', class_weights=None, sample_replace=True,
+                              samples_per_epoch=None, sample_seed=42):
+    """
+    Initialize a new model with the preprocessing of PIPELINE_OPTIONS: timestep and zoom transforms, train-time
+    augmentation and sampling. The options are plain values, so they can be passed to worker processes.
+
+    :return: dict dataset config and model object instance
+    """
+    timestep_transform = get_timestep_transform(timestep_mode, timestep_factor, crop_outside)
+    dataset_config, model = initialize_model(dataset_name, model_name, model_module_index, num_channels, num_instances,
+                                             timestep_transform=timestep_transform,
+                                             zoom_transform=get_zoom_transform(dataset_name, gamma_amp_factor,
+                                                                               zoom_outside))
+    augmenter = get_augmenter(noise_epsilon2, permute_channels, max_shift, augment_seed)
+    if augmenter is not None:
+        model.augmentation = augmenter.serialize()
+        dataset_config['augmentation'] = str(augmenter)
+    sampler = get_sampler(sampling, class_weights, sample_replace, samples_per_epoch, sample_seed)
+    if sampler is not None:
+        model.sampling = sampler.serialize()
+        dataset_config['sampling'] = str(sampler)
+    return dataset_config, model
+
+
+def uses_fit_generator(dataset_config):
+    """
+    :param dataset_config: dict dataset config
+    :return: bool True if the dataset is too large to be trained on in memory
+    """
+    return dataset_config["num_instances"] > GENERATOR_LIMIT
+
+
+def check_selection_metric(dataset_name, dataset_config, metric, option):
+    """
+    Refuse to select models (early stopping, search) on validation metrics that are computed on the test set: those of
+    `fit_generator`, which validates on the test generator.
+
+    :param dataset_name: str
+    :param dataset_config: dict dataset config
+    :param metric: str epoch-level metric
+    :param option: str command line option of the metric, for the error message
+    :return: None
+    """
+    if uses_fit_generator(dataset_config) and metric.startswith('val_'):
+        raise click.UsageError(f"{dataset_name} is trained from the generator, whose validation metrics are computed "
+                               f"on the test set: models can only be selected on training metrics (e.g. {option} "
+                               f"loss)")
+
+
 def train_model(model, dataset_name, dataset_config, batch_size, n_epochs,
-                num_channels, num_instances, compile_dict=None):
+                num_channels, num_instances, compile_dict=None, callbacks=None, shared_data=None, initial_epoch=0,
+                step_timer=None, step_profiler=None):
     """
     Start training sequence.
 
@@ -145,28 +400,77 @@ def train_model(model, dataset_name, dataset_config, batch_size, n_epochs,
     :param num_channels: int number of channels to use
     :param num_instances: int number of spectra instances
     :param compile_dict: dict compilation info
+    :param callbacks: optional list of keras callbacks
+    :param shared_data: optional SharedDataRegistry, in-memory train and test sets are shared with the other
+                        processes training on them
+    :param initial_epoch: int epoch a resumed run starts at, it trains up to `n_epochs`
+    :param step_timer: optional StepTimer, times the train steps and the training batches of the preprocessor
+    :param step_profiler: optional StepProfiler, profiles a window of train steps and the training batches of the
+                          preprocessor
     :return: model object instance
     """
-    use_generator = dataset_config["num_instances"] > GENERATOR_LIMIT
+    use_generator = uses_fit_generator(dataset_config)
     print('use_generator: ', use_generator)
-    spectra_pp = SpectraPreprocessor(dataset_name=dataset_name, num_channels=num_channels, num_instances=num_instances,
-                                     use_generator=use_generator)
+    spectra_pp = load_data(model, dataset_name, num_channels, num_instances, use_generator=use_generator,
+                           shared_data=None if use_generator else shared_data)
     print('SpectraPreprocessor initialized')
+    if step_timer is not None:
+        # First, so the timing of an epoch is recorded before it is checkpointed
+        spectra_pp.input_timer = step_timer.input_timer
+        callbacks = [step_timer] + (callbacks or [])
+    if step_profiler is not None:
+        spectra_pp.input_profiler = step_profiler.sampling_profiler
+        callbacks = (callbacks or []) + [step_profiler]
     if use_generator:
         print("\nUsing fit generator.\n")
         #X_test, y_test = spectra_pp.transform_test(encoded=True)
         model.fit_generator(spectra_pp, num_instances, batch_size=batch_size, epochs=n_epochs,
-                            compile_dict=compile_dict)
+                            compile_dict=compile_dict, callbacks=callbacks, initial_epoch=initial_epoch)
 
     else:
         X_train, y_train, X_test, y_test = spectra_pp.transform()
         model.fit(X_train, y_train, X_test, y_test, batch_size=batch_size, epochs=n_epochs,
-                  compile_dict=compile_dict)
+                  compile_dict=compile_dict, preprocessor=spectra_pp, callbacks=callbacks, initial_epoch=initial_epoch)
+        spectra_pp.release_shared()
 
     return model
 
 
-def get_evaluation_report(model, dataset_name, num_channels, num_instances, labels=None):
+def save_run(model, model_name, dataset_name, save_dir=None, chief=True, checkpoint=None):
+    """
+    Save a trained run and mark its checkpoint complete if it was checkpointed.
+
+    :param model: trained model object instance
+    :param model_name: string model class name
+    :param dataset_name: string dataset name
+    :param save_dir: optional string directory of the run if it was fixed before training, a new one otherwise
+    :param chief: bool False on the other workers of a distributed run, which do not keep what they save
+    :param checkpoint: optional Checkpoint callback the run was trained with
+    :return: string directory of the saved run, None on the other workers
+    """
+    if not chief:
+        # Saving reads mirrored variables with collective ops, so every worker saves, the others to a temporary directory
+        save_dir = save_dir or tempfile.mkdtemp()
+        try:
+            if checkpoint is not None:
+                checkpoint.complete()
+            else:
+                model.save(model_name, dataset_name, save_dir=save_dir)
+        finally:
+            shutil.rmtree(save_dir, ignore_errors=True)
+        return None
+
+    if checkpoint is not None:
+        # Saved with the checkpoint, so an interruption cannot pair the final weights with an earlier epoch
+        save_loc = checkpoint.complete()
+    else:
+        save_loc = model.save(model_name, dataset_name, save_dir=save_dir)
+    print(f"Saved model to {to_local_path(save_loc)}")
+    return save_loc
+
+
+def get_evaluation_report(model, dataset_name, num_channels, num_instances, labels=None, num_workers=NUM_WORKERS,
+                          profiler=None):
     """
     Get evaluation report from trained model. (Uses test data only)
 
@@ -175,14 +479,37 @@ def get_evaluation_report(model, dataset_name, num_channels, num_instances, labe
     :param num_channels: int number of channels to use from data
     :param num_instances: int number of instances of spectra in data
     :param labels: optional list of string to represent class names
+    :param num_workers: int number of processes decoding test shards
+    :param profiler: optional SamplingProfiler sampling the stages of the evaluation
     :return: evaluation report
     """
-    spectra_pp = SpectraPreprocessor(dataset_name=dataset_name, num_channels=num_channels, num_instances=num_instances,
-                                     use_generator=False, load_train=False)
-    evaluation_report = EvaluationReport(model, spectra_pp, labels)
+    with profile_stage(profiler, "load_test_set"):
+        spectra_pp = load_data(model, dataset_name, num_channels, num_instances, load_train=False,
+                               num_workers=num_workers)
+    evaluation_report = EvaluationReport(model, spectra_pp, labels, profiler=profiler)
     return evaluation_report
 
 
+def get_calibration_set(model, dataset_name, num_channels, num_instances, calibration_size, num_workers=NUM_WORKERS):
+    """
+    Draw training spectra to calibrate quantization, read shard by shard without augmentation or sampling.
+
+    :param model: model object instance
+    :param dataset_name: string dataset name
+    :param num_channels: int number of channels to use from data
+    :param num_instances: int number of instances of spectra in data
+    :param calibration_size: int number of spectra
+    :param num_workers: int number of processes decoding shards
+    :return: np.array spectra, transformed as for training
+    """
+    spectra_pp = load_data(model, dataset_name, num_channels, num_instances, use_generator=True,
+                           num_workers=num_workers)
+    spectra_pp.augmenter = None
+    spectra_pp.sampler = None
+    X_calibration, _ = next(spectra_pp.train_generator(calibration_size))
+    return X_calibration
+
+
 def visualize_evaluate_model(model, dataset_name, num_channels, num_instances, directory):
     """
     Generate images of trained model and dataset.
@@ -194,8 +521,7 @@ def visualize_evaluate_model(model, dataset_name, num_channels, num_instances, d
     :param directory: directory to save images in
     :return:
     """
-    spectra_pp = SpectraPreprocessor(dataset_name=dataset_name, num_channels=num_channels, num_instances=num_instances,
-                                     use_generator=False, load_train=False)
+    spectra_pp = load_data(model, dataset_name, num_channels, num_instances, load_train=False)
     evaluator = EvaluationReport(model, spectra_pp)
     img = complete_evaluation(evaluator, 3, 10, directory)
     return img
@@ -338,6 +664,17 @@ def prompt_previous_run(model_name):
     return msg
 
 
+def get_model_module_index(model_name):
+    """
+    :param model_name: string model class name
+    :return: int index of the loaded module defining the model class
+    """
+    for module_i, (module, module_name) in enumerate(get_loaded_models()):
+        if model_name in get_classes(module, module_name):
+            return module_i
+    raise Exception("Could not find model with model_name='%s' in '%s'" % (model_name, NETWORKS_DIR))
+
+
 def get_result_name(model_name, result_name_or_selection):
     """
     Get the name of the model class from user selection.
@@ -379,7 +716,10 @@ def continue_train_model(model_name, num_channels, num_instances, dataset_name,
     print("Using model:", model_name)
     print("Using result:", result_name)
 
-    dataset_config, model = initialize_model(dataset_name, model_name, model_module_index, num_channels, num_instances)
+    timestep_transform = get_prior_timestep_transform(result_name)
+    dataset_config, model = initialize_model(dataset_name, model_name, model_module_index, num_channels, num_instances,
+                                             timestep_transform=timestep_transform,
+                                             zoom_transform=get_prior_zoom_transform(result_name))
     model.persist(result_name)
 
     rocket = None
@@ -403,6 +743,65 @@ def continue_train_model(model_name, num_channels, num_instances, dataset_name,
         rocket.save(save_loc)
 
 
+@main.command(name="resume", help="Resume an interrupted run from its last checkpoint")
+@click.option('--result-name', "-r", required=True, help="result directory name of a run trained with --checkpoint-every")
+@click.option('--use-comet/--no-comet', is_flag=True, default=True,
+              help="flag to determine if the commet.ml experiment of the run should be continued")
+def resume_train_model(result_name, use_comet):
+    result_dir = os.path.join(MODEL_RES_DIR, result_name)
+    checkpoint_config = read_checkpoint(result_dir)
+    if checkpoint_config is None:
+        raise click.ClickException(f"{result_name} has no checkpoint, it was not trained with --checkpoint-every or "
+                                   f"stopped before its first checkpoint")
+    if checkpoint_config['complete']:
+        raise click.ClickException(f"{result_name} is complete, use 'continue' to train it further")
+
+    strategy = get_strategy(checkpoint_config['distribute'])
+    model_name = checkpoint_config['model_name']
+    dataset_name = checkpoint_config['dataset_name']
+    num_channels = checkpoint_config['num_channels']
+    num_instances = checkpoint_config['num_instances']
+    run_epoch = checkpoint_config['run_epoch']
+    print("Using dataset:", dataset_name)
+    print("Using model:", model_name)
+    print(f"Resuming {result_name} at epoch {run_epoch} of {checkpoint_config['n_epochs']}")
+
+    dataset_config, model = initialize_model(dataset_name, model_name, get_model_module_index(model_name),
+                                             num_channels, num_instances,
+                                             timestep_transform=get_prior_timestep_transform(result_name),
+                                             zoom_transform=get_prior_zoom_transform(result_name))
+    model.strategy = strategy
+    model.persist(result_name)
+
+    chief = strategy is None or is_chief()
+    rocket = None
+    comet_config_path = os.path.join(result_dir, COMET_SAVE_FILENAME)
+    if use_comet and chief and os.path.exists(comet_config_path):
+        rocket = CometConnection()
+        rocket.persist(comet_config_path)
+
+    early_stopping = load_early_stopping(result_dir, checkpoint_config)
+    settings = {k: v for k, v in checkpoint_config.items() if k not in ('run_epoch', 'complete', 'early_stopping')}
+    checkpoint = Checkpoint(model, result_dir if chief else tempfile.mkdtemp(), model_name, dataset_name,
+                            every=checkpoint_config['checkpoint_every'], settings=settings,
+                            early_stopping=early_stopping)
+    checkpoint.run_epoch = run_epoch
+    callbacks = [callback for callback in (early_stopping, checkpoint) if callback is not None]
+    step_timer = None
+    if checkpoint_config.get('step_timing'):
+        step_timer = StepTimer(model, checkpoint_config['batch_size'],
+                               experiment=None if rocket is None else rocket.experiment)
+
+    model = train_model(model, dataset_name, dataset_config, checkpoint_config['batch_size'],
+                        checkpoint_config['n_epochs'], num_channels, num_instances, callbacks=callbacks,
+                        shared_data=SharedDataRegistry() if checkpoint_config['shared_data'] else None,
+                        initial_epoch=run_epoch, step_timer=step_timer)
+    save_loc = save_run(model, model_name, dataset_name, save_dir=checkpoint.save_dir, chief=chief, checkpoint=checkpoint)
+
+    if rocket is not None:
+        rocket.save(save_loc)
+
+
 @main.command(name="evaluate", help="Evaluate an existing run")
 @click.option('--model-name', "-m", prompt=prompt_model_string(), callback=get_model_name,
               default=None, help="model class name string")
@@ -414,13 +813,23 @@ def continue_train_model(model_name, num_channels, num_instances, dataset_name,
               default=None, help="dataset name string")
 @click.option('--num-examples', "-d", prompt="Number of examples per peak to visualize predictions for.",
               default=0, type=click.IntRange(min=0), help="number of images to generate per peak class")
-def run_evaluate_model(model_name, num_channels, num_instances, dataset_name, num_examples, model_module_index=None):
+@click.option("--loader-workers", type=click.IntRange(min=1), default=NUM_WORKERS,
+              help="number of processes decoding test shards")
+@click.option("--profile/--no-profile", default=False,
+              help="sample the Python stacks of the evaluation stages, saved under profile/ in the run directory")
+@click.option("--memory-stages/--no-memory-stages", default=False,
+              help="record the peak memory of the loading and prediction stages, saved in the classification report")
+def run_evaluate_model(model_name, num_channels, num_instances, dataset_name, num_examples, loader_workers, profile,
+                       memory_stages, model_module_index=None):
     result_name = get_result_name(model_name, input(prompt_previous_run(model_name) + ": "))
     print("Using dataset:", dataset_name)
     print("Using model:", model_name)
     print("Using result:", result_name)
 
-    dataset_config, model = initialize_model(dataset_name, model_name, model_module_index, num_channels, num_instances)
+    timestep_transform = get_prior_timestep_transform(result_name)
+    dataset_config, model = initialize_model(dataset_name, model_name, model_module_index, num_channels, num_instances,
+                                             timestep_transform=timestep_transform,
+                                             zoom_transform=get_prior_zoom_transform(result_name))
     rocket = None
     comet_config_path = os.path.join(MODEL_RES_DIR, result_name, COMET_SAVE_FILENAME)
     if os.path.exists(comet_config_path):
@@ -428,23 +837,41 @@ def run_evaluate_model(model_name, num_channels, num_instances, dataset_name, nu
         rocket.persist(comet_config_path)
 
     model.persist(result_name)
+    if memory_stages:
+        enable_memory_accounting()
+    profiler = None
+    if profile:
+        profiler = SamplingProfiler()
+        profiler.start()
     labels = [str(i) for i in range(1, int(dataset_config['n_max'] + 1))]
     eval_report = get_evaluation_report(model=model, dataset_name=dataset_name, num_channels=num_channels,
-                                        num_instances=num_instances, labels=labels)
-
-    classif_report = eval_report.get_eval_classification_report()
-    print("------- Classification Report ------- ")
-    print(json.dumps(classif_report, indent=4))
-    print(confusion_matrix(eval_report.y_true_num, eval_report.preds))
+                                        num_instances=num_instances, labels=labels, num_workers=loader_workers,
+                                        profiler=profiler)
+
+    with profile_stage(profiler, "classification_report"):
+        classif_report = eval_report.get_eval_classification_report()
+        print("------- Classification Report ------- ")
+        print(f"Timesteps: {model.num_timesteps} (transform: {timestep_transform})")
+        print(json.dumps(classif_report, indent=4))
+        print(confusion_matrix(eval_report.y_true_num, eval_report.preds))
+    if memory_stages:
+        ACCOUNTING.print_report()
     dir = os.path.join(MODEL_RES_DIR, result_name)
     dir_eval = os.path.join(dir, "eval")
     try_create_directory(dir_eval)
     filename_extension = f"{str(datetime.now().strftime('%m%d.%H%M'))}"
+    eval_report.save_classification_report(dir_eval, file_extension=filename_extension)
 
     if num_examples > 0:
-        complete_evaluation(eval_report, 5, num_examples, dir_eval, file_extension=filename_extension)
+        with profile_stage(profiler, "plots"):
+            complete_evaluation(eval_report, 5, num_examples, dir_eval, file_extension=filename_extension)
         print("View images under the following directory: ", dir_eval)
 
+    if profiler is not None:
+        profiler.stop()
+        summary_path = profiler.save(os.path.join(dir, PROFILE_DIRNAME), f"evaluation-{filename_extension}")
+        print(f"Saved the profile of the evaluation to {to_local_path(summary_path)}")
+
     if rocket is not None:
         rocket.experiment.log_metrics(classif_report)
         rocket.experiment.log_confusion_matrix(eval_report.y_true_num, eval_report.preds, labels=labels)
@@ -454,6 +881,161 @@ def run_evaluate_model(model_name, num_channels, num_instances, dataset_name, nu
                 rocket.experiment.log_image(image_path)
 
 
+@main.command(name="export", help="Export a run as a SavedModel and quantized TFLite models for CPU inference")
+@click.option('--result-name', "-r", required=True, help="result directory name of a trained run")
+@click.option('--num-channels', "-nc", prompt="Number of Channels: ", type=click.IntRange(min=1),
+              help="number of channels the run was trained on")
+@click.option('--num-instances', "-ns", prompt="Number of Instances: ", type=click.IntRange(min=1),
+              help="number of test spectra the exported models are compared on")
+@click.option('--dataset-name', "-d", default=None,
+              help="dataset of the test and calibration spectra, by default the dataset the run was trained on")
+@click.option("--quantization", "-q", type=click.Choice(QUANTIZATIONS), multiple=True, default=QUANTIZATIONS,
+              help="TFLite models to export (repeatable): float32, dynamic-range or int8 quantized")
+@click.option("--calibration-size", type=click.IntRange(min=1), default=256,
+              help="number of training spectra int8 quantization is calibrated on")
+@click.option("--batch-size", "-bs", type=click.IntRange(min=1), default=32, help="batch size of the batched latency")
+@click.option("--num-runs", type=click.IntRange(min=1), default=50, help="timed calls per latency measure")
+@click.option("--num-threads", type=click.IntRange(min=1), default=None,
+              help="threads of TensorFlow and the TFLite interpreters, e.g. the cores of an inference node")
+@click.option("--loader-workers", type=click.IntRange(min=1), default=NUM_WORKERS,
+              help="number of processes decoding shards")
+def export_model(result_name, num_channels, num_instances, dataset_name, quantization, calibration_size, batch_size,
+                 num_runs, num_threads, loader_workers):
+    use_cpu_only(num_threads)
+    prior_config = get_prior_config(result_name)
+    model_name = prior_config['class_name']
+    dataset_name = dataset_name or prior_config['dataset_name']
+    print("Using dataset:", dataset_name)
+    print("Using model:", model_name)
+    print("Using result:", result_name)
+
+    dataset_config, model = initialize_model(dataset_name, model_name, get_model_module_index(model_name),
+                                             num_channels, num_instances,
+                                             timestep_transform=get_prior_timestep_transform(result_name),
+                                             zoom_transform=get_prior_zoom_transform(result_name))
+    model.persist(result_name)
+
+    spectra_pp = load_data(model, dataset_name, num_channels, num_instances, load_train=False,
+                           num_workers=loader_workers)
+    X_test, y_test = spectra_pp.transform_test()
+    calibration_X = None
+    if 'int8' in quantization:
+        calibration_X = get_calibration_set(model, dataset_name, num_channels, num_instances, calibration_size,
+                                            num_workers=loader_workers)
+
+    info = {'result_name': result_name, 'class_name': model_name, 'dataset_name': dataset_name,
+            'num_channels': num_channels, 'source_num_timesteps': int(dataset_config['num_timesteps']),
+            'num_timesteps': model.num_timesteps,
+            'labels': [str(i) for i in range(1, int(dataset_config['n_max'] + 1))],
+            'timestep_transform': model.timestep_transform, 'zoom': model.zoom}
+    export_dir = os.path.join(MODEL_RES_DIR, result_name, EXPORT_DIRNAME)
+    report = export_run(model, export_dir, X_test, y_test, calibration_X=calibration_X, quantizations=quantization,
+                        info=info, batch_size=batch_size, num_runs=num_runs, num_threads=num_threads)
+    print(f"------- Export: {len(X_test)} test spectra, {num_threads or 'all'} threads ------- ")
+    print_report(report, batch_size)
+    print(f"Exported to {to_local_path(export_dir)}")
+
+
+@main.command(name="serve", help="Serve exported runs over HTTP, batching concurrent requests")
+@click.option('--result-name', "-r", required=True, multiple=True,
+              help="result directory name of a run exported with 'export' (repeatable)")
+@click.option("--model-format", type=click.Choice(QUANTIZATIONS + (SAVED_MODEL,)), default='int8',
+              help="exported model to serve")
+@click.option("--host", default="127.0.0.1", help="address to listen on, 0.0.0.0 for all interfaces")
+@click.option("--port", type=click.IntRange(min=0), default=DEFAULT_PORT)
+@click.option("--max-batch-size", type=click.IntRange(min=1), default=32,
+              help="number of spectra concurrent requests are batched up to")
+@click.option("--max-delay-ms", type=click.FloatRange(min=0), default=5.0,
+              help="longest time a request waits for others to be batched with")
+@click.option("--num-threads", type=click.IntRange(min=1), default=None,
+              help="threads of TensorFlow and the TFLite interpreters")
+def serve_models(result_name, model_format, host, port, max_batch_size, max_delay_ms, num_threads):
+    use_cpu_only(num_threads)
+    server = create_server(result_name, host=host, port=port, model_format=model_format,
+                           max_batch_size=max_batch_size, max_delay_ms=max_delay_ms, num_threads=num_threads)
+    print(f"Serving {', '.join(result_name)} ({model_format}) on http://{host}:{server.server_address[1]}, batches of "
+          f"up to {max_batch_size} spectra within {max_delay_ms:g} ms")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+
+
+@main.command(name="predict", help="Score a dataset or a collection of .mat spectra, streamed in batches, to a file")
+@click.option('--result-name', "-r", required=True, help="result directory name of a trained run")
+@click.option('--num-channels', "-nc", type=click.IntRange(min=1), default=None,
+              help="number of channels the run was trained on, required unless an exported model is used")
+@click.option('--dataset-name', "-d", default=None, help="dataset (or view) to score")
+@click.option("--subset", type=click.Choice(('all', TRAIN_DATASET_PREFIX, TEST_DATASET_PREFIX)), default='all',
+              help="subsets of the dataset to score")
+@click.option("--mat-path", default=None, help="directory of .mat spectra (or glob pattern) to score instead")
+@click.option("--output", "-o", default=None,
+              help=f"output file ({', '.join(OUTPUT_FORMATS)}), by default predictions/<source>.<date>.parquet in "
+                   f"the run directory")
+@click.option("--model-format", type=click.Choice(('keras',) + QUANTIZATIONS + (SAVED_MODEL,)), default='keras',
+              help="trained keras model, or a model exported with 'export'")
+@click.option("--batch-size", "-bs", type=click.IntRange(min=1), default=256, help="spectra per prediction")
+@click.option("--loader-workers", type=click.IntRange(min=0), default=NUM_WORKERS,
+              help="number of processes decoding shards, 0 to decode in the main process")
+@click.option("--prefetch", type=click.IntRange(min=1), default=None,
+              help="shards decoded ahead of the model, 2 per worker by default, bounds the memory used")
+@click.option("--num-threads", type=click.IntRange(min=1), default=None,
+              help="threads of TensorFlow and the TFLite interpreters")
+def predict_dataset(result_name, num_channels, dataset_name, subset, mat_path, output, model_format, batch_size,
+                    loader_workers, prefetch, num_threads):
+    if (dataset_name is None) == (mat_path is None):
+        raise click.UsageError("Score either a dataset (--dataset-name) or .mat spectra (--mat-path)")
+    prior_config = get_prior_config(result_name)
+    model_name = prior_config['class_name']
+    print("Using model:", model_name)
+    print("Using result:", result_name)
+
+    if model_format == 'keras':
+        if num_channels is None:
+            raise click.UsageError("--num-channels is required to rebuild the keras model")
+        dataset_config, model = initialize_model(prior_config['dataset_name'], model_name,
+                                                 get_model_module_index(model_name), num_channels, None,
+                                                 timestep_transform=get_prior_timestep_transform(result_name),
+                                                 zoom_transform=get_prior_zoom_transform(result_name))
+        model.persist(result_name)
+        predictor = get_keras_predictor(model.keras_model)
+        prep = {'num_channels': num_channels, 'zoom': model.zoom, 'timestep_transform': model.timestep_transform}
+        class_labels = [str(i) for i in range(1, int(dataset_config['n_max'] + 1))]
+    else:
+        use_cpu_only(num_threads)
+        exported = ExportedModel(os.path.join(MODEL_RES_DIR, result_name, EXPORT_DIRNAME), model_format=model_format,
+                                 num_threads=num_threads)
+        predictor = exported.predictor
+        prep = {'num_channels': exported.num_channels, 'zoom': exported.info.get('zoom'),
+                'timestep_transform': exported.info.get('timestep_transform')}
+        class_labels = exported.info['labels']
+
+    if dataset_name is not None:
+        subsets = [TRAIN_DATASET_PREFIX, TEST_DATASET_PREFIX] if subset == 'all' else [subset]
+        tasks = get_dataset_tasks(dataset_name, subsets, prep)
+        source = dataset_name if subset == 'all' else f"{dataset_name}-{subset}"
+    else:
+        tasks = get_mat_tasks(mat_path, prep)
+        source = os.path.basename(os.path.normpath(mat_path.split('*')[0])) or "mat"
+    if output is None:
+        output_dir = os.path.join(MODEL_RES_DIR, result_name, "predictions")
+        try_create_directory(output_dir, silent=True)
+        output = os.path.join(output_dir, f"{source}.{datetime.now().strftime('%m%d.%H%M')}.parquet")
+    print(f"Scoring {source} ({len(tasks)} shards) with {model_format} model into {to_local_path(output)}")
+
+    metadata = {'result_name': result_name, 'model_format': model_format, 'source': dataset_name or mat_path,
+                'subset': subset if dataset_name is not None else None, 'prep': prep}
+    summary = predict_to_file(predictor, tasks, output, class_labels, batch_size=batch_size, num_workers=loader_workers,
+                              prefetch=prefetch, metadata=metadata)
+    accuracy = "" if summary['accuracy'] is None else f", accuracy {summary['accuracy']:.4f}"
+    print(f"Scored {summary['records']} spectra in {summary['seconds']:.1f} s ({summary['records_per_second']:.0f}/s): "
+          f"{summary['predict_seconds']:.1f} s predicting, {summary['decode_wait_seconds']:.1f} s waiting for "
+          f"decoded spectra{accuracy}")
+    print(f"Saved predictions to {to_local_path(output)}")
+
+
 @main.command(name="new", help="Train a new model")
 @click.option('--model-name', "-m", prompt=prompt_model_string(), callback=get_model_name,
               default=None, help="model class name string")
@@ -471,21 +1053,90 @@ def run_evaluate_model(model_name, num_channels, num_instances, dataset_name, nu
               help="flag to determine if commet.ml logging should be used")
 @click.option("--comet-name", "-cn", prompt="What would you like to call this run on comet?",
               default=f"model-{str(datetime.now().strftime('%m%d.%H%M'))}", help="name to call comet experiment")
-def train_new_model(comet_name, num_channels, num_instances, batch_size, n_epochs, dataset_name, model_name, use_comet, model_module_index=None):
+@pipeline_options
+@click.option("--jit-compile/--no-jit-compile", default=False, help="compile the train and predict steps with XLA")
+@click.option("--precision", type=click.Choice(PRECISIONS), default='float32',
+              help="mixed_bfloat16 computes in bfloat16, with a float32 output, on CPUs that support it")
+@click.option("--distribute", type=click.Choice(STRATEGIES), default='none',
+              help="data-parallel training over the workers of TF_CONFIG (see models/distributed.py), --batch-size is "
+                   "the batch size of every worker")
+@click.option("--shared-data/--no-shared-data", default=False,
+              help="share the train and test sets (in shared memory) with other runs on the same data on this host")
+@click.option("--checkpoint-every", type=click.IntRange(min=1), default=None,
+              help="save the run every N epochs, with its optimizer state, so it can be resumed with 'resume'")
+@click.option("--early-stopping-patience", type=click.IntRange(min=1), default=None,
+              help="stop training after N epochs without improvement of --early-stopping-metric")
+@click.option("--early-stopping-metric", default='val_loss', help="epoch-level metric early stopping monitors")
+@click.option("--early-stopping-mode", type=click.Choice(('min', 'max')), default='min',
+              help="minimize or maximize the early stopping metric")
+@click.option("--restore-best/--no-restore-best", default=True,
+              help="keep the weights of the best epoch when early stopping is enabled")
+@click.option("--step-timing/--no-step-timing", default=False,
+              help="record the input wait, compute and validation time of every epoch in info.json (and comet.ml)")
+@click.option("--profile-steps", callback=parse_step_window, default=None,
+              help="capture a TensorFlow trace and a Python profile of the input pipeline for train steps START:STOP "
+                   "(counted from 1 over all epochs), saved under profile/ in the run directory")
+@click.option("--memory-stages/--no-memory-stages", default=False,
+              help="record the peak memory of shard loading, Spectrum construction, array assembly, to_categorical "
+                   "and predict in info.json")
+def train_new_model(comet_name, num_channels, num_instances, batch_size, n_epochs, dataset_name, model_name, use_comet,
+                    jit_compile, precision, distribute, shared_data, checkpoint_every, early_stopping_patience,
+                    early_stopping_metric, early_stopping_mode, restore_best, step_timing, profile_steps, memory_stages,
+                    model_module_index=None, **pipeline):
+    # The strategy connects to the other workers and has to be created before any other TensorFlow operation
+    strategy = get_strategy(distribute)
     print("Using dataset:", dataset_name)
     print("Using model:", model_name)
 
-    dataset_config, model = initialize_model(dataset_name, model_name, model_module_index, num_channels, num_instances)
+    dataset_config, model = initialize_pipeline_model(dataset_name, model_name, model_module_index, num_channels,
+                                                      num_instances, **pipeline)
+    model.strategy = strategy
     rocket = None
+    if memory_stages:
+        enable_memory_accounting()
 
-    if use_comet:
+    # Only the chief worker of a distributed run logs and saves the run
+    chief = strategy is None or is_chief()
+    if use_comet and chief:
         rocket = CometConnection(comet_name=comet_name, dataset_config=dataset_config)
 
-    model = train_model(model, dataset_name, dataset_config, batch_size, n_epochs, num_channels, num_instances,
-                        compile_dict=COMPILE_DICT)
+    early_stopping = None
+    if early_stopping_patience is not None:
+        check_selection_metric(dataset_name, dataset_config, early_stopping_metric, '--early-stopping-metric')
+        early_stopping = EarlyStopping(monitor=early_stopping_metric, mode=early_stopping_mode,
+                                       patience=early_stopping_patience, restore_best_weights=restore_best)
+    save_dir = None
+    if checkpoint_every is not None or profile_steps is not None:
+        # The run directory is known up front, the other workers of a distributed run save to a temporary one
+        save_dir = BaseModel.get_save_dir(model_name, dataset_name) if chief else tempfile.mkdtemp()
+        try_create_directory(save_dir)
+        if rocket is not None:
+            rocket.save(save_dir)
+    checkpoint = None
+    if checkpoint_every is not None:
+        settings = {'model_name': model_name, 'dataset_name': dataset_name, 'num_channels': num_channels,
+                    'num_instances': num_instances, 'batch_size': batch_size, 'n_epochs': n_epochs,
+                    'checkpoint_every': checkpoint_every, 'distribute': distribute, 'shared_data': shared_data,
+                    'step_timing': step_timing}
+        checkpoint = Checkpoint(model, save_dir, model_name, dataset_name, every=checkpoint_every, settings=settings,
+                                early_stopping=early_stopping)
+    callbacks = [callback for callback in (early_stopping, checkpoint) if callback is not None]
+
+    step_timer = None
+    if step_timing:
+        step_timer = StepTimer(model, batch_size, experiment=None if rocket is None else rocket.experiment)
+    step_profiler = None
+    if profile_steps is not None and chief:
+        step_profiler = StepProfiler(os.path.join(save_dir, PROFILE_DIRNAME), profile_steps, SamplingProfiler())
 
-    save_loc = model.save(model_name, dataset_name)
-    print(f"Saved model to {to_local_path(save_loc)}")
+    model = train_model(model, dataset_name, dataset_config, batch_size, n_epochs, num_channels, num_instances,
+                        compile_dict=get_compile_dict(jit_compile, precision), callbacks=callbacks or None,
+                        shared_data=SharedDataRegistry() if shared_data else None, step_timer=step_timer,
+                        step_profiler=step_profiler)
+    if memory_stages:
+        model.memory_stages = get_memory_report()
+        ACCOUNTING.print_report()
+    save_loc = save_run(model, model_name, dataset_name, save_dir=save_dir, chief=chief, checkpoint=checkpoint)
 
     if rocket is not None:
         rocket.save(save_loc)
@@ -498,6 +1149,10 @@ def train_new_model(comet_name, num_channels, num_instances, batch_size, n_epoch
               help="model class name string")
 @click.option('--dataset-name', "-d", prompt=prompt_dataset_string(), callback=get_dataset_name,
               default=None, help="dataset name string")
+@click.option('--num-channels', "-nc", prompt="Number of Channels: ", type=click.IntRange(min=1),
+              help="number of channels to use in data")
+@click.option('--num-instances', "-ns", prompt="Number of Instances: ", type=click.IntRange(min=1),
+              help="number of spectra instances to use in data")
 @click.option("--batch-size", prompt="Batch size", default=DEFAULT_BATCH_SIZE,
               type=click.IntRange(min=1), help="size of training batch")
 @click.option("--n-epochs", prompt="Number of epochs", default=DEFAULT_N_EPOCHS,
@@ -506,8 +1161,9 @@ def train_new_model(comet_name, num_channels, num_instances, batch_size, n_epoch
               help="flag to determine if commet.ml logging should be used")
 @click.option("--comet-name", "-cn", prompt="What would you like to call this run on comet?",
               default=f"model-{str(datetime.now().strftime('%m%d.%H%M'))}", help="name to call comet experiment")
-def optimize(max_n, model_name, dataset_name, batch_size, n_epochs, use_comet, comet_name, model_module_index=None):
-    dataset_config, model = initialize_model(dataset_name, model_name, model_module_index)
+def optimize(max_n, model_name, dataset_name, num_channels, num_instances, batch_size, n_epochs, use_comet, comet_name,
+             model_module_index=None):
+    dataset_config, model = initialize_model(dataset_name, model_name, model_module_index, num_channels, num_instances)
     rocket = None
 
     #if use_comet:
@@ -518,15 +1174,255 @@ def optimize(max_n, model_name, dataset_name, batch_size, n_epochs, use_comet, c
     params_range['spec']['maxCombo'] = max_n
     optimizer = Optimizer(params_range, api_key=COMET_KEY)
 
-    for experiment in optimizer.get_experiments(project_name=PROJECT_NAME):
-        experiment.set_name(comet_name)
-        experiment.add_tag("optimizer_experiment")
-        model_exp = model
-        p = {k: experiment.get_parameter(k) for k in params_range['parameters'].keys()}
-        model_exp.params = p
-        model_exp = train_model(model, dataset_name, dataset_config, batch_size, n_epochs, compile_dict=COMPILE_DICT)
-        loss = model_exp.test_results[0]
-        experiment.log_metric("loss", loss)
+    # Every experiment runs in a fresh process, so experiments do not share (or leak) TensorFlow state
+    with multiprocessing.get_context('spawn').Pool(processes=1, maxtasksperchild=1) as pool:
+        for experiment in optimizer.get_experiments(project_name=PROJECT_NAME):
+            experiment.set_name(comet_name)
+            experiment.add_tag("optimizer_experiment")
+            experiment_args = {'model_name': model_name, 'model_module_index': model_module_index,
+                               'dataset_name': dataset_name, 'num_channels': num_channels,
+                               'num_instances': num_instances, 'batch_size': batch_size, 'n_epochs': n_epochs,
+                               'params': {k: experiment.get_parameter(k) for k in params_range['parameters'].keys()}}
+            loss = pool.apply(train_experiment, (experiment_args,))
+            experiment.log_metric("loss", loss)
+
+
+def train_experiment(experiment_args):
+    """
+    Train a model with the parameters of one experiment of the Comet optimizer. Runs in a worker process of `optimize`.
+
+    :param experiment_args: dict with the model name and module index, dataset_name, num_channels, num_instances,
+                            batch_size, n_epochs and the params of the experiment
+    :return: float test loss of the model
+    """
+    dataset_name = experiment_args['dataset_name']
+    dataset_config, model = initialize_model(dataset_name, experiment_args['model_name'],
+                                             experiment_args['model_module_index'], experiment_args['num_channels'],
+                                             experiment_args['num_instances'])
+    model.params = experiment_args['params']
+    model = train_model(model, dataset_name, dataset_config, experiment_args['batch_size'],
+                        experiment_args['n_epochs'], experiment_args['num_channels'],
+                        experiment_args['num_instances'], compile_dict=COMPILE_DICT)
+    return model.test_results['metrics'][0]
+
+
+def train_fold(fold_args):
+    """
+    Train and evaluate a model on one fold of a cross-validation. Runs in a worker process of `cross_validate`.
+
+    :param fold_args: dict with the model name and module index, the split view to train on (dataset_name),
+                      num_channels, num_instances, batch_size, n_epochs, the compile options and the pipeline options
+                      of `initialize_pipeline_model`
+    :return: dict result directory and test results of the fold
+    """
+    dataset_name = fold_args['dataset_name']
+    dataset_config, model = initialize_pipeline_model(dataset_name, fold_args['model_name'],
+                                                      fold_args['model_module_index'], fold_args['num_channels'],
+                                                      fold_args['num_instances'], **fold_args['pipeline'])
+    model = train_model(model, dataset_name, dataset_config, fold_args['batch_size'], fold_args['n_epochs'],
+                        fold_args['num_channels'], fold_args['num_instances'],
+                        compile_dict=get_compile_dict(fold_args['jit_compile'], fold_args['precision']))
+
+    save_loc = model.save(fold_args['model_name'], dataset_name)
+    print(f"Saved fold model to {to_local_path(save_loc)}")
+    return {'dataset_name': dataset_name, 'result_name': os.path.basename(save_loc), 'test_results': model.test_results}
+
+
+def summarize_folds(fold_results):
+    """
+    :param fold_results: list of dicts returned by `train_fold`
+    :return: dict {metric name: {'mean': float, 'std': float}}
+    """
+    metrics_names = fold_results[0]['test_results']['metrics_names']
+    metrics = np.array([result['test_results']['metrics'] for result in fold_results])
+    return {name: {'mean': float(metrics[:, i].mean()), 'std': float(metrics[:, i].std())}
+            for i, name in enumerate(metrics_names)}
+
+
+@main.command(name="cv", help="Cross-validate a new model on splits of a dataset")
+@click.option('--model-name', "-m", prompt=prompt_model_string(), callback=get_model_name,
+              default=None, help="model class name string")
+@click.option('--dataset-name', "-d", prompt=prompt_dataset_string(), callback=get_dataset_name, default=None,
+              help="dataset name string")
+@click.option('--num-channels', "-nc", prompt="Number of Channels: ", type=click.IntRange(min=1),
+              help="number of channels to use in data")
+@click.option('--num-instances', "-ns", prompt="Number of Instances: ", type=click.IntRange(min=1),
+              help="number of spectra instances to use in data")
+@click.option("--batch-size", "-bs", prompt="Batch size", default=DEFAULT_BATCH_SIZE, type=click.IntRange(min=1),
+              help="size of training batch")
+@click.option("--n-epochs", "-n", prompt="Number of epochs", default=DEFAULT_N_EPOCHS, type=click.IntRange(min=1),
+              help="number of epochs to train for")
+@click.option("--split-method", type=click.Choice(SPLIT_METHODS), default='kfold',
+              help="stratified k-fold or repeated stratified holdout")
+@click.option("--n-splits", "-k", type=click.IntRange(min=2), default=5, help="number of folds or repetitions")
+@click.option("--test-size", type=click.FloatRange(min=0, max=1), default=0.15,
+              help="fraction of test spectra of the holdout method")
+@click.option("--split-seed", type=int, default=42, help="seed of the split")
+@click.option("--workers", "-w", type=click.IntRange(min=1), default=1,
+              help="number of folds trained in parallel, each in its own process")
+@pipeline_options
+@click.option("--jit-compile/--no-jit-compile", default=False, help="compile the train and predict steps with XLA")
+@click.option("--precision", type=click.Choice(PRECISIONS), default='float32',
+              help="mixed_bfloat16 computes in bfloat16, with a float32 output, on CPUs that support it")
+def cross_validate(model_name, dataset_name, num_channels, num_instances, batch_size, n_epochs, split_method, n_splits,
+                   test_size, split_seed, workers, jit_compile, precision, model_module_index=None, **pipeline):
+    print("Using dataset:", dataset_name)
+    print("Using model:", model_name)
+
+    view_names = create_split_views(dataset_name, method=split_method, n_splits=n_splits, test_size=test_size,
+                                    seed=split_seed)
+    fold_args = [{'model_name': model_name, 'model_module_index': model_module_index, 'dataset_name': view_name,
+                  'num_channels': num_channels, 'num_instances': num_instances, 'batch_size': batch_size,
+                  'n_epochs': n_epochs, 'jit_compile': jit_compile, 'precision': precision, 'pipeline': pipeline}
+                 for view_name in view_names]
+
+    # Every fold runs in a fresh process, so folds do not share (or leak) TensorFlow state
+    with multiprocessing.get_context('spawn').Pool(processes=min(workers, len(fold_args)), maxtasksperchild=1) as pool:
+        fold_results = pool.map(train_fold, fold_args, chunksize=1)
+
+    summary = {'model_name': model_name, 'dataset_name': dataset_name, 'split_method': split_method,
+               'n_splits': n_splits, 'split_seed': split_seed, 'jit_compile': jit_compile, 'precision': precision,
+               'pipeline': pipeline, 'folds': fold_results,
+               'summary': summarize_folds(fold_results)}
+    summary_path = os.path.join(MODEL_RES_DIR, f"cv-{model_name}{RESULT_DIR_DELIM}{dataset_name}-{split_method}"
+                                               f"{n_splits}.{datetime.now().strftime('%m%d.%H%M')}.json")
+    json.dump(summary, open(summary_path, "w"), indent=4)
+
+    for name, stats in summary['summary'].items():
+        print(f"{name}: {stats['mean']:.5f} +/- {stats['std']:.5f}")
+    print(f"Saved cross-validation summary to {to_local_path(summary_path)}")
+
+
+def run_trial(trial_args):
+    """
+    Train a model with the parameters of one trial of a hyperparameter search. Runs in a worker process of `search`.
+
+    :param trial_args: dict with the model name and module index, dataset_name, num_channels, num_instances,
+                       batch_size, n_epochs, the compile options, the pipeline options of `initialize_pipeline_model`,
+                       the scheduler with its metric and mode, the search directory, whether the data is shared, and
+                       the trial_id, params, cpus_per_trial and cpu_set of the trial
+    :return: dict trial result, its score is the best epoch-level score of the monitored metric
+    """
+    limit_cpus(trial_args['cpus_per_trial'], trial_args['cpu_set'])
+    trial_id, metric, mode = trial_args['trial_id'], trial_args['metric'], trial_args['mode']
+    dataset_name = trial_args['dataset_name']
+    dataset_config, model = initialize_pipeline_model(dataset_name, trial_args['model_name'],
+                                                      trial_args['model_module_index'], trial_args['num_channels'],
+                                                      trial_args['num_instances'], **trial_args['pipeline'])
+    model.params = trial_args['params']
+    scheduler_callback = SchedulerCallback(trial_args['scheduler'], trial_id, metric, mode)
+    model = train_model(model, dataset_name, dataset_config, trial_args['batch_size'], trial_args['n_epochs'],
+                        trial_args['num_channels'], trial_args['num_instances'],
+                        compile_dict=get_compile_dict(trial_args['jit_compile'], trial_args['precision']),
+                        callbacks=[scheduler_callback],
+                        shared_data=SharedDataRegistry() if trial_args['shared_data'] else None)
+
+    save_loc = model.save(trial_args['model_name'], dataset_name,
+                          save_dir=os.path.join(trial_args['search_dir'], f"trial-{trial_id}"))
+    history = model.history or {}
+    scores = [get_score(value, mode) for value in history.get(metric, [])]
+    return {'trial_id': trial_id, 'params': trial_args['params'], 'score': min(scores) if scores else float('inf'),
+            'epochs': len(scores), 'stopped_epoch': scheduler_callback.stopped_epoch, 'history': history,
+            'test_results': model.test_results, 'result_dir': to_local_path(save_loc)}
+
+
+@main.command(name="search", help="Search the hyperparameters of a model locally")
+@click.option('--model-name', "-m", prompt=prompt_model_string(), callback=get_model_name,
+              default=None, help="model class name string")
+@click.option('--dataset-name', "-d", prompt=prompt_dataset_string(), callback=get_dataset_name, default=None,
+              help="dataset name string")
+@click.option('--num-channels', "-nc", prompt="Number of Channels: ", type=click.IntRange(min=1),
+              help="number of channels to use in data")
+@click.option('--num-instances', "-ns", prompt="Number of Instances: ", type=click.IntRange(min=1),
+              help="number of spectra instances to use in data")
+@click.option("--batch-size", "-bs", prompt="Batch size", default=DEFAULT_BATCH_SIZE, type=click.IntRange(min=1),
+              help="size of training batch")
+@click.option("--n-epochs", "-n", prompt="Number of epochs", default=DEFAULT_N_EPOCHS, type=click.IntRange(min=1),
+              help="maximum number of epochs of a trial")
+@click.option("--algorithm", type=click.Choice(tuple(SEARCH_ALGORITHMS)), default='bayes',
+              help="random search, or Bayesian optimization (Gaussian process, expected improvement)")
+@click.option("--scheduler", type=click.Choice(SCHEDULERS), default='asha',
+              help="stop poor trials early with asynchronous successive halving, or run all epochs of every trial")
+@click.option("--n-trials", type=click.IntRange(min=1), default=20, help="number of trials")
+@click.option("--workers", "-w", type=click.IntRange(min=1), default=1,
+              help="number of trials run in parallel, each in its own process")
+@click.option("--cpus-per-trial", type=click.IntRange(min=1), default=None,
+              help="threads (and CPUs, where affinity is supported) of every trial, all CPUs split between workers "
+                   "by default")
+@click.option("--metric", default='val_loss', help="epoch-level metric trials are compared on")
+@click.option("--mode", type=click.Choice(('min', 'max')), default='min', help="minimize or maximize the metric")
+@click.option("--min-epochs", type=click.IntRange(min=1), default=1, help="epoch of the first ASHA rung")
+@click.option("--reduction-factor", type=click.IntRange(min=2), default=3,
+              help="ASHA keeps the best 1/reduction-factor of the trials at every rung")
+@click.option("--brackets", type=click.IntRange(min=1), default=1, help="number of ASHA (Hyperband) brackets")
+@click.option("--seed", type=int, default=42, help="seed of the search")
+@click.option("--shared-data/--no-shared-data", default=False,
+              help="load the train and test sets once, in shared memory, instead of once per trial")
+@pipeline_options
+@click.option("--jit-compile/--no-jit-compile", default=False, help="compile the train and predict steps with XLA")
+@click.option("--precision", type=click.Choice(PRECISIONS), default='float32',
+              help="mixed_bfloat16 computes in bfloat16, with a float32 output, on CPUs that support it")
+def search(model_name, dataset_name, num_channels, num_instances, batch_size, n_epochs, algorithm, scheduler, n_trials,
+           workers, cpus_per_trial, metric, mode, min_epochs, reduction_factor, brackets, seed, shared_data,
+           jit_compile, precision, model_module_index=None, **pipeline):
+    print("Using dataset:", dataset_name)
+    print("Using model:", model_name)
+
+    # Built with the preprocessing of the trials, so the shared sets are those the trials attach to
+    dataset_config, model = initialize_pipeline_model(dataset_name, model_name, model_module_index, num_channels,
+                                                      num_instances, **pipeline)
+    check_selection_metric(dataset_name, dataset_config, metric, '--metric')
+    shared_data = shared_data and not uses_fit_generator(dataset_config)
+    cpus_per_trial = cpus_per_trial or max(1, NUM_WORKERS // workers)
+    search_dir = os.path.join(MODEL_RES_DIR, f"search-{model_name}{RESULT_DIR_DELIM}{dataset_name}."
+                                             f"{datetime.now().strftime('%m%d.%H%M')}")
+    try_create_directory(search_dir)
+    settings = {'model_name': model_name, 'dataset_name': dataset_name, 'algorithm': algorithm,
+                'scheduler': scheduler, 'n_trials': n_trials, 'n_epochs': n_epochs, 'metric': metric, 'mode': mode,
+                'min_epochs': min_epochs, 'reduction_factor': reduction_factor, 'brackets': brackets, 'seed': seed,
+                'workers': workers, 'cpus_per_trial': cpus_per_trial, 'shared_data': shared_data,
+                'jit_compile': jit_compile, 'precision': precision, 'pipeline': pipeline,
+                'params_range': model.params_range}
+
+    def save_results(results):
+        ranked = sorted(results, key=lambda result: result['score'])
+        json.dump(dict(settings, best=ranked[0], trials=ranked), open(os.path.join(search_dir, SEARCH_FILENAME), "w"),
+                  indent=4)
+
+    with multiprocessing.Manager() as manager:
+        trial_scheduler = FIFOScheduler() if scheduler == 'fifo' else \
+            ASHAScheduler(manager, n_epochs, min_epochs=min_epochs, reduction_factor=reduction_factor,
+                          brackets=brackets)
+        trial_args = {'model_name': model_name, 'model_module_index': model_module_index, 'dataset_name': dataset_name,
+                      'num_channels': num_channels, 'num_instances': num_instances, 'batch_size': batch_size,
+                      'n_epochs': n_epochs, 'jit_compile': jit_compile, 'precision': precision, 'pipeline': pipeline,
+                      'scheduler': trial_scheduler, 'metric': metric, 'mode': mode, 'search_dir': search_dir,
+                      'shared_data': shared_data}
+        # The search holds a reference to the shared sets, so they are kept between trials
+        spectra_pp = None
+        if shared_data:
+            spectra_pp = load_data(model, dataset_name, num_channels, num_instances, shared_data=SharedDataRegistry())
+            spectra_pp.transform()
+        try:
+            results = run_search(run_trial, trial_args, SEARCH_ALGORITHMS[algorithm](model.params_range, seed=seed),
+                                 n_trials, workers, cpus_per_trial, on_trial_end=save_results)
+        finally:
+            if spectra_pp is not None:
+                spectra_pp.release_shared()
+
+    best = min(results, key=lambda result: result['score'])
+    num_stopped = sum(1 for result in results if result.get('stopped_epoch') is not None)
+    print(f"{len(results)} trials, {num_stopped} stopped early. Best trial {best['trial_id']}: {metric} "
+          f"{get_score(best['score'], mode):.5f} with {best['params']}")
+    print(f"Saved search results to {to_local_path(search_dir)}")
+
+
+@main.command(name="prune-cache", help="Delete cached transformed arrays that were not used recently")
+@click.option("--older-than-days", type=click.FloatRange(min=0), default=0.0,
+              help="keep the arrays used in the last N days, all are deleted by default")
+def prune_transform_cache(older_than_days):
+    num_files, num_bytes = prune_cache(older_than_days)
+    print(f"Deleted {num_files} cached arrays ({num_bytes / 2 ** 20:.1f} MiB)")
 
 
 def get_params_range(model):
@@ -0,0 +1,110 @@
+import numpy as np
+
+
+class LabelSampler:
+    """
+    Draws class-balanced or custom-weighted samples of records from their labels alone, so balanced training
+    streams can be drawn from one large dataset without writing balanced copies of it.
+
+    Every epoch, class `c` gets a quota of `num_samples * weight_c` records, drawn uniformly from the records of that
+    class with or without replacement. Without replacement, the default number of samples is the largest one for
+    which every quota fits in its class. The random state is seeded from `(seed, epoch)`.
+    """
+    STRATEGIES = ('balanced', 'weighted')
+
+    def __init__(self, strategy='balanced', class_weights=None, replace=True, num_samples=None, seed=42):
+        """
+        :param strategy: str 'balanced' gives every class the same weight, 'weighted' uses `class_weights`.
+        :param class_weights: dict {label: weight} used by the 'weighted' strategy. Classes left out get no samples.
+        :param replace: bool Sample with replacement.
+        :param num_samples: int (optional) Number of records drawn per epoch.
+        :param seed: int Base seed, combined with the epoch number.
+        """
+        if strategy not in LabelSampler.STRATEGIES:
+            raise ValueError(f"Unknown sampling strategy '{strategy}', expected one of {LabelSampler.STRATEGIES}")
+        if strategy == 'weighted' and not class_weights:
+            raise ValueError("The 'weighted' sampling strategy requires class weights.")
+
+        self.strategy = strategy
+        self.class_weights = None if class_weights is None else {int(k): float(v) for k, v in class_weights.items()}
+        self.replace = replace
+        self.num_samples = num_samples
+        self.seed = int(seed)
+
+    def __repr__(self):
+        return f"{self.strategy}-{'with' if self.replace else 'without'}-replacement"
+
+    def get_weights(self, labels):
+        """
+        :param labels: np.array label of every record
+        :return: dict {label: normalized weight} for the classes present in `labels`
+        """
+        classes = np.unique(labels)
+        if self.strategy == 'balanced':
+            weights = {int(c): 1.0 for c in classes}
+        else:
+            weights = {int(c): self.class_weights.get(int(c), 0.0) for c in classes}
+
+        total = sum(weights.values())
+        if total <= 0:
+            raise ValueError("Class weights must give a positive weight to at least one class.")
+        return {c: w / total for c, w in weights.items()}
+
+    def get_num_samples(self, labels):
+        """
+        :param labels: np.array label of every record
+        :return: int number of records drawn per epoch
+        """
+        if self.num_samples is not None:
+            return int(self.num_samples)
+        if self.replace:
+            return len(labels)
+
+        classes, counts = np.unique(labels, return_counts=True)
+        weights = self.get_weights(labels)
+        return int(min(count / weights[int(c)] for c, count in zip(classes, counts) if weights[int(c)] > 0))
+
+    def sample(self, labels, epoch=0):
+        """
+        Draw the records of one epoch.
+
+        :param labels: np.array label of every record
+        :param epoch: int
+        :return: np.array shuffled positions into `labels` (may repeat when sampling with replacement)
+        """
+        labels = np.asarray(labels)
+        random_state = np.random.RandomState([self.seed, int(epoch)])
+        weights = self.get_weights(labels)
+        num_samples = self.get_num_samples(labels)
+
+        samples = []
+        for c, weight in sorted(weights.items()):
+            quota = int(round(num_samples * weight))
+            if quota == 0:
+                continue
+            members = np.flatnonzero(labels == c)
+            if not self.replace and quota > len(members):
+                raise ValueError(f"Cannot draw {quota} records of class {c} without replacement, "
+                                 f"only {len(members)} exist.")
+            samples.append(random_state.choice(members, size=quota, replace=self.replace))
+
+        samples = np.concatenate(samples)
+        random_state.shuffle(samples)
+        return samples
+
+    def serialize(self):
+        """
+        :return: dict that can be passed to `LabelSampler.from_config`.
+        """
+        return {'strategy': self.strategy, 'class_weights': self.class_weights, 'replace': self.replace,
+                'num_samples': self.num_samples, 'seed': self.seed}
+
+    @staticmethod
+    def from_config(config):
+        """
+        :param config: dict produced by `serialize`, or None.
+        :return: LabelSampler or None
+        """
+        if not config:
+            return None
+        return LabelSampler(**config)
@@ -0,0 +1,357 @@
+from utils import *
+from models.export import EXPORT_DIRNAME, ExportedModel
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import collections
+import json
+import queue
+import threading
+import time
+import urllib.error
+import urllib.request
+import numpy as np
+
+
+"""
+Local HTTP inference service of exported runs (see `models/export.py`), started with `run_train.py serve`.
+
+Every run is loaded once. Its requests are queued and coalesced into micro-batches by a single thread: a batch is run
+as soon as it holds `max_batch_size` spectra, or when its oldest request has waited `max_delay_ms`, the latency budget
+spent on batching. Batches are padded to the next power of two, so the TFLite interpreters (one per padded size) are
+not resized for every batch.
+
+Endpoints, JSON in and out:
+ - POST /predict: {"model": <run>, optional with a single run, "spectra": one spectrum (num_channels, num_timesteps)
+   or a batch (num_spectra, num_channels, num_timesteps), laid out as in the datasets} ->
+   {"model", "probabilities", "num_peaks" (predicted class of every spectrum)}
+ - GET /models: export info of the loaded runs (input shape, labels, transforms)
+ - GET /metrics: requests, spectra, batches, throughput and latency percentiles of every run
+ - GET /health
+"""
+
+
+DEFAULT_PORT = 8500
+METRICS_WINDOW = 10000  # latest requests and batches the latency percentiles are computed over
+REQUEST_TIMEOUT = 60  # seconds a request waits for its predictions
+
+
+def get_padded_size(num_spectra, max_batch_size):
+    """
+    :param num_spectra: int
+    :param max_batch_size: int
+    :return: int next power of two, at most max_batch_size unless num_spectra is larger
+    """
+    if num_spectra >= max_batch_size:
+        return num_spectra
+    return min(1 << (num_spectra - 1).bit_length(), max_batch_size)
+
+
+def get_percentiles(values):
+    """
+    :param values: list of float
+    :return: dict mean and percentiles, None without values
+    """
+    if not values:
+        return None
+    values = np.array(values)
+    return {'mean': round(float(values.mean()), 3),
+            'p50': round(float(np.percentile(values, 50)), 3),
+            'p95': round(float(np.percentile(values, 95)), 3),
+            'p99': round(float(np.percentile(values, 99)), 3)}
+
+
+class ServingMetrics:
+    """Counts and latencies of the requests and batches of a run."""
+
+    def __init__(self):
+        self.start = time.time()
+        self.requests = 0
+        self.spectra = 0
+        self.batches = 0
+        self.padded_spectra = 0
+        self.errors = 0
+        self.latencies_ms = collections.deque(maxlen=METRICS_WINDOW)  # request received to predictions ready
+        self.queue_ms = collections.deque(maxlen=METRICS_WINDOW)  # request received to batch started
+        self.batch_ms = collections.deque(maxlen=METRICS_WINDOW)  # inference of a batch
+        self.batch_sizes = collections.deque(maxlen=METRICS_WINDOW)
+        self.lock = threading.Lock()
+
+    def add_batch(self, requests, num_spectra, padded_size, start, end):
+        with self.lock:
+            self.batches += 1
+            self.requests += len(requests)
+            self.spectra += num_spectra
+            self.padded_spectra += padded_size
+            self.batch_ms.append(1000 * (end - start))
+            self.batch_sizes.append(num_spectra)
+            for request in requests:
+                self.queue_ms.append(1000 * (start - request.received))
+                self.latencies_ms.append(1000 * (end - request.received))
+
+    def add_error(self):
+        with self.lock:
+            self.errors += 1
+
+    def get_summary(self):
+        """
+        :return: dict counts since the start, throughput and percentiles of the latest requests (ms)
+        """
+        with self.lock:
+            uptime = time.time() - self.start
+            return {'requests': self.requests,
+                    'spectra': self.spectra,
+                    'batches': self.batches,
+                    'errors': self.errors,
+                    'mean_batch_size': round(self.spectra / self.batches, 2) if self.batches else None,
+                    'padding_fraction': round(1 - self.spectra / self.padded_spectra, 4) if self.padded_spectra
+                    else None,
+                    'spectra_per_second': round(self.spectra / max(uptime, 1e-9), 2),
+                    'recent_batch_size': get_percentiles(list(self.batch_sizes)),
+                    'latency_ms': get_percentiles(list(self.latencies_ms)),
+                    'queue_ms': get_percentiles(list(self.queue_ms)),
+                    'batch_ms': get_percentiles(list(self.batch_ms))}
+
+
+class PendingRequest:
+    def __init__(self, X):
+        self.X = X
+        self.received = time.perf_counter()
+        self.future = Future()
+
+
+class MicroBatcher:
+    """Coalesces the requests of a run into micro-batches, predicted by a single thread."""
+
+    def __init__(self, model, max_batch_size=32, max_delay_ms=5.0):
+        """
+        :param model: ExportedModel
+        :param max_batch_size: int number of spectra a batch is run at
+        :param max_delay_ms: float longest time the oldest request of a batch waits for others
+        """
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay_ms / 1000
+        self.metrics = ServingMetrics()
+        self.queue = queue.Queue()
+        self.predictors = {}  # {padded batch size: predictor}, only used by the batching thread
+        self.thread = threading.Thread(target=self._run, name="micro-batcher", daemon=True)
+        self.thread.start()
+
+    def submit(self, dm):
+        """
+        :param dm: spectra (num_spectra, num_channels, num_timesteps), see `ExportedModel.preprocess`
+        :return: Future of the np.array class probabilities
+        """
+        request = PendingRequest(self.model.preprocess(dm))
+        self.queue.put(request)
+        return request.future
+
+    def stop(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    def _run(self):
+        carried = None
+        while True:
+            first = carried or self.queue.get()
+            carried = None
+            if first is None:
+                return
+            requests = [first]
+            num_spectra = len(first.X)
+            deadline = first.received + self.max_delay
+            while num_spectra < self.max_batch_size:
+                try:
+                    request = self.queue.get(timeout=max(deadline - time.perf_counter(), 0))
+                except queue.Empty:
+                    break
+                if request is None:
+                    self.queue.put(None)
+                    break
+                if num_spectra + len(request.X) > self.max_batch_size:
+                    # Starts the next batch
+                    carried = request
+                    break
+                requests.append(request)
+                num_spectra += len(request.X)
+            self._predict(requests, num_spectra)
+
+    def _predict(self, requests, num_spectra):
+        padded_size = get_padded_size(num_spectra, self.max_batch_size)
+        X = np.concatenate([request.X for request in requests])
+        if padded_size > num_spectra:
+            X = np.concatenate([X, np.zeros((padded_size - num_spectra,) + X.shape[1:], dtype=X.dtype)])
+        # Requests larger than a batch share a predictor resized to their size
+        predictor_key = padded_size if padded_size <= self.max_batch_size else None
+        start = time.perf_counter()
+        try:
+            if predictor_key not in self.predictors:
+                self.predictors[predictor_key] = self.model.new_predictor()
+            probs = self.predictors[predictor_key](X)[:num_spectra]
+        except Exception as e:
+            for request in requests:
+                request.future.set_exception(e)
+                self.metrics.add_error()
+            return
+        end = time.perf_counter()
+        self.metrics.add_batch(requests, num_spectra, padded_size, start, end)
+        offset = 0
+        for request in requests:
+            request.future.set_result(probs[offset:offset + len(request.X)])
+            offset += len(request.X)
+
+
+class InferenceServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # Connections beyond the listen backlog are retried by clients after a second
+    request_queue_size = 128
+
+    def __init__(self, address, batchers):
+        """
+        :param address: (host, port)
+        :param batchers: dict {run name: MicroBatcher}
+        """
+        super(InferenceServer, self).__init__(address, InferenceRequestHandler)
+        self.batchers = batchers
+        self.start = time.time()
+
+    def get_batcher(self, name):
+        if name is None:
+            if len(self.batchers) != 1:
+                raise KeyError(f"several models are served, choose one of {sorted(self.batchers)} with 'model'")
+            return next(iter(self.batchers.items()))
+        if name not in self.batchers:
+            raise KeyError(f"model {name} is not served, choose one of {sorted(self.batchers)}")
+        return name, self.batchers[name]
+
+    def close(self):
+        """Close the socket and stop the batching threads, once `serve_forever` returned."""
+        self.server_close()
+        for batcher in self.batchers.values():
+            batcher.stop()
+
+
+class InferenceRequestHandler(BaseHTTPRequestHandler):
+    server_version = "SpectraInference/1.0"
+
+    def log_message(self, format, *args):
+        # Requests are counted in the metrics, not logged one by one
+        pass
+
+    def _send_json(self, status, content):
+        body = json.dumps(content).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/health":
+            self._send_json(200, {'status': 'ok', 'models': sorted(self.server.batchers)})
+        elif self.path == "/models":
+            self._send_json(200, {name: dict(batcher.model.info, model_format=batcher.model.model_format,
+                                             max_batch_size=batcher.max_batch_size,
+                                             max_delay_ms=1000 * batcher.max_delay)
+                                  for name, batcher in self.server.batchers.items()})
+        elif self.path == "/metrics":
+            self._send_json(200, {'uptime_seconds': round(time.time() - self.server.start, 1),
+                                  'models': {name: batcher.metrics.get_summary()
+                                             for name, batcher in self.server.batchers.items()}})
+        else:
+            self._send_json(404, {'error': f"unknown path {self.path}"})
+
+    def do_POST(self):
+        if self.path != "/predict":
+            self._send_json(404, {'error': f"unknown path {self.path}"})
+            return
+        try:
+            content = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            name, batcher = self.server.get_batcher(content.get('model'))
+        except KeyError as e:
+            self._send_json(404, {'error': e.args[0]})
+            return
+        except (ValueError, AttributeError):
+            self._send_json(400, {'error': "expected a JSON object with 'spectra'"})
+            return
+
+        try:
+            spectra = np.asarray(content['spectra'], dtype=np.float32)
+            single = spectra.ndim == 2
+            future = batcher.submit(spectra[np.newaxis] if single else spectra)
+        except (KeyError, ValueError) as e:
+            self._send_json(400, {'error': str(e)})
+            return
+        try:
+            probs = future.result(timeout=REQUEST_TIMEOUT)
+        except Exception as e:
+            self._send_json(500, {'error': f"prediction failed: {e}"})
+            return
+
+        num_peaks = probs.argmax(axis=1) + 1
+        self._send_json(200, {'model': name,
+                              'probabilities': probs[0].tolist() if single else probs.tolist(),
+                              'num_peaks': int(num_peaks[0]) if single else num_peaks.tolist()})
+
+
+def create_server(result_names, host="127.0.0.1", port=DEFAULT_PORT, model_format='int8', max_batch_size=32,
+                  max_delay_ms=5.0, num_threads=None):
+    """
+    :param result_names: list of str result directory names of exported runs
+    :param host: str
+    :param port: int, 0 for any free port
+    :param model_format: str SAVED_MODEL or one of QUANTIZATIONS
+    :param max_batch_size: int
+    :param max_delay_ms: float
+    :param num_threads: int threads of the TFLite interpreters
+    :return: InferenceServer, serve it with `serve_forever` and `close` it once `shutdown`
+    """
+    batchers = {}
+    for result_name in result_names:
+        export_dir = os.path.join(MODEL_RES_DIR, result_name, EXPORT_DIRNAME)
+        if not os.path.isdir(export_dir):
+            raise FileNotFoundError(f"{result_name} was not exported, run 'run_train.py export -r {result_name}'")
+        batchers[result_name] = MicroBatcher(ExportedModel(export_dir, model_format=model_format,
+                                                           num_threads=num_threads),
+                                             max_batch_size=max_batch_size, max_delay_ms=max_delay_ms)
+    return InferenceServer((host, port), batchers)
+
+
+class InferenceClient:
+    """Client of an InferenceServer, e.g. for local tests and load generation."""
+
+    def __init__(self, url=f"http://127.0.0.1:{DEFAULT_PORT}", timeout=REQUEST_TIMEOUT):
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+
+    def _request(self, path, content=None):
+        data = None if content is None else json.dumps(content).encode()
+        request = urllib.request.Request(self.url + path, data=data, headers={"Content-Type": "application/json"})
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                return json.loads(response.read())
+        except urllib.error.HTTPError as e:
+            raise RuntimeError(f"{e.code}: {json.loads(e.read()).get('error')}") from None
+
+    def predict(self, spectra, model=None):
+        """
+        :param spectra: array-like spectrum (num_channels, num_timesteps) or batch of them
+        :param model: str run name, None if the server serves a single run
+        :return: dict response with 'probabilities' and 'num_peaks'
+        """
+        content = {'spectra': np.asarray(spectra).tolist()}
+        if model is not None:
+            content['model'] = model
+        return self._request("/predict", content)
+
+    def get_models(self):
+        return self._request("/models")
+
+    def get_metrics(self):
+        return self._request("/metrics")
+
+    def is_healthy(self):
+        try:
+            return self._request("/health")['status'] == 'ok'
+        except (OSError, RuntimeError):
+            return False
@@ -0,0 +1,180 @@
+from utils import *
+import contextlib
+import fcntl
+import json
+import numpy as np
+
+
+"""
+Host-wide registry of read-only arrays shared by the processes training on the same data, e.g. the trials of a
+hyperparameter search. The first process attaching to a key loads the arrays and writes them as .npy files in
+SHARED_DATA_DIR, which is in shared memory (/dev/shm) where available. Every process then maps the same files
+read-only, so the data is held in RAM once however many processes train on it.
+
+Every process attached to a key holds a reference to it, an empty file named after its pid. The files of a key are
+deleted when its last reference is released; references of processes that died are dropped. Arrays that are already
+mapped stay valid after their files are deleted.
+"""
+
+
+SHARED_DATA_DIR = os.path.join("/dev/shm", f"{PROJECT_NAME}-{os.getuid()}") if os.path.isdir("/dev/shm") \
+    else os.path.join(CACHE_DIR, "shared")
+MANIFEST_FILENAME = "arrays.json"
+REFS_DIRNAME = "refs"
+
+
+def pid_exists(pid):
+    """
+    :param pid: int
+    :return: bool True if a process with this pid is running
+    """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class SharedDataRegistry:
+    """
+    Attaches the processes of a host to shared read-only arrays, keyed by the data they hold. Within a process, every
+    `attach` of a key must be matched by a `release`.
+    """
+
+    def __init__(self, root=SHARED_DATA_DIR):
+        """
+        :param root: str directory of the shared arrays, shared memory by default
+        """
+        self.root = root
+        self.attached = {}  # {key: [dict of arrays, number of attachments in this process]}
+
+    def get_entry_dir(self, key):
+        return os.path.join(self.root, key)
+
+    @contextlib.contextmanager
+    def lock(self, key, blocking=True):
+        """
+        Exclusive lock of a key across processes.
+
+        :param key: str
+        :param blocking: bool wait for the lock, otherwise yield False if another process holds it
+        :return: context manager yielding True once the lock is held
+        """
+        try_create_directory(self.root, silent=True)
+        # Lock files are never deleted: a process could otherwise lock a new file while another holds the old one
+        with open(os.path.join(self.root, f"{key}.lock"), "w") as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def attach(self, key, load_func):
+        """
+        Read-only views of the arrays of a key, loaded with `load_func` by the first process attaching to it. Other
+        processes attaching meanwhile wait for the arrays instead of loading them again.
+
+        :param key: str identifies the data, e.g. a hash of its source and preprocessing
+        :param load_func: function() -> dict {name: np.array}
+        :return: dict {name: read-only np.memmap}
+        """
+        if key in self.attached:
+            self.attached[key][1] += 1
+            return self.attached[key][0]
+
+        entry_dir = self.get_entry_dir(key)
+        with self.lock(key):
+            if not os.path.exists(os.path.join(entry_dir, MANIFEST_FILENAME)):
+                self.prune()
+                self.publish(entry_dir, load_func())
+            open(os.path.join(entry_dir, REFS_DIRNAME, str(os.getpid())), "w").close()
+            names = json.load(open(os.path.join(entry_dir, MANIFEST_FILENAME), "r"))
+            arrays = {name: np.load(os.path.join(entry_dir, f"{name}.npy"), mmap_mode="r") for name in names}
+
+        self.attached[key] = [arrays, 1]
+        return arrays
+
+    def release(self, key):
+        """
+        Drop an attachment of this process to a key. The files of the key are deleted once no process refers to it.
+
+        :param key: str
+        :return: None
+        """
+        self.attached[key][1] -= 1
+        if self.attached[key][1] > 0:
+            return
+        del self.attached[key]
+
+        entry_dir = self.get_entry_dir(key)
+        with self.lock(key):
+            ref_path = os.path.join(entry_dir, REFS_DIRNAME, str(os.getpid()))
+            if os.path.exists(ref_path):
+                os.remove(ref_path)
+            if not self.get_references(key):
+                shutil.rmtree(entry_dir, ignore_errors=True)
+
+    def release_all(self):
+        for key in list(self.attached):
+            self.attached[key][1] = 1
+            self.release(key)
+
+    def get_references(self, key):
+        """
+        Pids of the processes attached to a key. References of processes that are no longer running are removed.
+
+        :param key: str
+        :return: list of int
+        """
+        refs_dir = os.path.join(self.get_entry_dir(key), REFS_DIRNAME)
+        if not os.path.isdir(refs_dir):
+            return []
+        pids = []
+        for filename in os.listdir(refs_dir):
+            if pid_exists(int(filename)):
+                pids.append(int(filename))
+            else:
+                os.remove(os.path.join(refs_dir, filename))
+        return pids
+
+    def prune(self):
+        """
+        Delete the arrays of keys no running process refers to, e.g. left behind by processes that were killed. Keys
+        locked by other processes are skipped.
+
+        :return: None
+        """
+        for key in os.listdir(self.root):
+            if not os.path.isdir(self.get_entry_dir(key)) or key in self.attached:
+                continue
+            with self.lock(key, blocking=False) as locked:
+                if locked and not self.get_references(key):
+                    shutil.rmtree(self.get_entry_dir(key), ignore_errors=True)
+
+    @staticmethod
+    def publish(entry_dir, arrays):
+        """
+        Write arrays as .npy files. The manifest is written last, so an entry without one is incomplete.
+
+        :param entry_dir: str directory of the key
+        :param arrays: dict {name: np.array}
+        :return: None
+        """
+        num_bytes = sum(np.asarray(array).nbytes for array in arrays.values())
+        free_bytes = shutil.disk_usage(os.path.dirname(entry_dir)).free
+        if num_bytes > free_bytes:
+            raise OSError(f"Sharing the data needs {num_bytes / 2 ** 20:.0f} MiB, only {free_bytes / 2 ** 20:.0f} MiB "
+                          f"are free in {os.path.dirname(entry_dir)}")
+
+        shutil.rmtree(entry_dir, ignore_errors=True)  # incomplete entry of a process that died while publishing
+        try_create_directory(entry_dir, silent=True)
+        try_create_directory(os.path.join(entry_dir, REFS_DIRNAME), silent=True)
+        for name, array in arrays.items():
+            np.save(os.path.join(entry_dir, f"{name}.npy"), np.ascontiguousarray(array))
+        json.dump(sorted(arrays), open(os.path.join(entry_dir, MANIFEST_FILENAME), "w"))
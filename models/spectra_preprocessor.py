@@ -1,6 +1,10 @@
 from utils import *
-from datagen.spectra_loader import SpectraLoader
+from datagen.dataset_view import get_spectra_loader, get_label_index
+from datagen.spectra_loader import NUM_WORKERS
+from models.spectra_transforms import dm_to_model_input, pad_peak_locations
+from memory_accounting import memory_stage, ARRAY_ASSEMBLY, TO_CATEGORICAL
 import json
+import hashlib
 import numpy as np
 import random
 from keras.utils import to_categorical
@@ -11,48 +15,129 @@ class SpectraPreprocessor:
     Class responsible for managing spectra loaders and transforming data for training.
     """
 
-    def __init__(self, dataset_name, num_channels, num_instances, use_generator=False, load_train=True):
+    def __init__(self, dataset_name, num_channels, num_instances, use_generator=False, load_train=True,
+                 timestep_transform=None, augmenter=None, zoom_transform=None, sampler=None, num_workers=NUM_WORKERS,
+                 input_shard=(0, 1), shared_data=None):
         """
         Object constructor for Spectra Preprocessor
 
-        :param dataset_name: string for dataset name
+        :param dataset_name: string for dataset name, may be a dataset view
         :param num_channels: int number of channels to use from data
         :param num_instances: number of instances of data to use
         :param use_generator: bool for is to use training generator or not
         :param load_train: bool for if to load data immediately
+        :param timestep_transform: optional TimestepTransform applied to the timestep axis of every spectrum
+        :param augmenter: optional SpectraAugmenter applied to training batches
+        :param zoom_transform: optional ZoomTransform emulating a different gamma_amp_factor, applied before
+                               timestep_transform
+        :param sampler: optional LabelSampler drawing the training records of every epoch
+        :param num_workers: int number of processes decoding shards when loading a whole subset
+        :param input_shard: (worker index, number of workers) of data-parallel training, the training batches (`flow`
+                            and generators) only contain the share of the records of this worker
+        :param shared_data: optional SharedDataRegistry. The transformed train and test sets are then loaded by the
+                            first process of the host that needs them, and `transform` returns read-only views of them
         """
+        # Shared sets are only loaded if they are not shared yet
+        eval_now = not use_generator and shared_data is None
         if load_train:
-            self.train_spectra_loader = SpectraLoader(dataset_name=dataset_name, subset_prefix=TRAIN_DATASET_PREFIX, eval_now=not use_generator)
-        self.test_spectra_loader = SpectraLoader(dataset_name=dataset_name, subset_prefix=TEST_DATASET_PREFIX, eval_now=not use_generator)
+            self.train_spectra_loader = get_spectra_loader(dataset_name=dataset_name, subset_prefix=TRAIN_DATASET_PREFIX, eval_now=eval_now,
+                                                           num_workers=num_workers)
+        self.test_spectra_loader = get_spectra_loader(dataset_name=dataset_name, subset_prefix=TEST_DATASET_PREFIX, eval_now=eval_now,
+                                                      num_workers=num_workers)
 
+        self.dataset_name = dataset_name
         self.datagen_config = json.load(open(os.path.join(DATA_DIR, dataset_name, DATAGEN_CONFIG), "r"))
         self.max_nc = self.datagen_config['num_channels']
         self.num_channels = num_channels
         self.num_instances = num_instances
         self.num_test_instances = None
+        self.timestep_transform = timestep_transform
+        self.augmenter = augmenter
+        self.zoom_transform = zoom_transform
+        self.sampler = sampler
+        self.input_shard = input_shard
+        self.source_indices = None
+        self.test_source_indices = None
+        self.shared_data = shared_data
+        self.shared_key = None
+        self.input_timer = None  # optional InputTimer (models/step_timing.py) timing the training batches
+        self.input_profiler = None  # optional SamplingProfiler (models/profiling.py) sampling the training generators
 
     def get_data(self, loader):
         """
-        Return reshaped data from loader.
+        Return reshaped data from loader. `source_indices` is set to the indices of the loaded spectra that were kept
+        (transforms such as zooming may drop spectra).
 
         :param loader: SpectraLoader
         :return: X matrix, y vector
         """
-        dm = loader.get_dm()
-        dm_reshaped = np.array(dm[:self.num_instances])[:, :self.num_channels, :]
-        X = dm_reshaped.reshape(dm_reshaped.shape[0], dm_reshaped.shape[2], dm_reshaped.shape[1])
-        y = np.array(loader.get_n())
-        y = y.reshape(y.shape[0], 1)
-        y_reshaped = to_categorical(y[:self.num_instances, :])[:, 1:]
+        with memory_stage(ARRAY_ASSEMBLY):
+            dm = loader.get_dm()
+            dm_reshaped = np.array(dm[:self.num_instances])[:, :self.num_channels, :]
+            y = np.array(loader.get_n())[:self.num_instances]
+            cache_key = self._get_cache_key(loader)
+
+            self.source_indices = np.arange(len(y))
+            peaks = None
+            if self.zoom_transform is not None:
+                dm_reshaped, y, peaks, keep = self.zoom_transform.transform_cached(dm_reshaped,
+                                                                                   loader.get_peak_locations(), y,
+                                                                                   cache_key)
+                self.source_indices = np.flatnonzero(keep)
+                cache_key = None if cache_key is None else f"{cache_key}|{self.zoom_transform}"
+            if self.timestep_transform is not None and self.timestep_transform.changes_labels():
+                # Cropping drops the peaks in the margins, the spectra are relabelled or discarded
+                if peaks is None:
+                    peaks = pad_peak_locations(loader.get_peak_locations())[:len(y)]
+                dm_reshaped, y, _, keep = self.timestep_transform.transform_labelled(dm_reshaped, peaks, y)
+                self.source_indices = self.source_indices[keep]
+            elif self.timestep_transform is not None:
+                dm_reshaped = self.timestep_transform.transform_cached(dm_reshaped, cache_key)
+
+            X = dm_to_model_input(dm_reshaped)
+        with memory_stage(TO_CATEGORICAL):
+            y = y.reshape(y.shape[0], 1)
+            y_reshaped = to_categorical(y, num_classes=int(self.datagen_config['n_max']) + 1)[:, 1:]
         del y, dm
         return X, y_reshaped
 
+    def get_num_timesteps(self):
+        """
+        Number of timesteps in the transformed data, i.e. the number of timesteps the model should be built with.
+
+        :return: int
+        """
+        num_timesteps = self.datagen_config['num_timesteps']
+        if self.zoom_transform is not None:
+            num_timesteps = self.zoom_transform.get_num_timesteps(num_timesteps)
+        if self.timestep_transform is not None:
+            return self.timestep_transform.get_num_timesteps(num_timesteps)
+        return int(num_timesteps)
+
+    def _get_cache_key(self, loader):
+        """
+        Build a key identifying the data currently held by a loader, used to cache transformed arrays.
+        Shard modification times are included so regenerated shards are not served from a stale cache, and the loader's
+        cache token distinguishes views selecting different records from the same shards.
+
+        :param loader: SpectraLoader
+        :return: str, or None if the loaded data does not come from files
+        """
+        if not loader.loaded_files:
+            return None
+
+        shards = [f"{file}:{os.path.getmtime(file)}" for file in loader.loaded_files]
+        key = f"{loader.get_cache_token()}|{'|'.join(shards)}|nc={self.num_channels}|ni={self.num_instances}"
+        return hashlib.md5(key.encode()).hexdigest()
+
     def transform(self):
         """
         Transform loaded data.
 
         :return: train and test sets
         """
+        if self.shared_data is not None:
+            return self._transform_shared()
         X_train, y_train = self.transform_train()
         X_test, y_test = self.transform_test()
         return X_train, y_train, X_test, y_test
@@ -71,8 +156,51 @@ class SpectraPreprocessor:
         :return: X, y
         """
         X_test, y_test = self.get_data(self.test_spectra_loader)
+        self.test_source_indices = self.source_indices
         return X_test, y_test
 
+    def _transform_shared(self):
+        """
+        Attach to the shared train and test sets, loading and transforming them if no process shares them yet.
+
+        :return: read-only train and test sets
+        """
+        def load_arrays():
+            for loader in (self.train_spectra_loader, self.test_spectra_loader):
+                loader.load_from_dir(self.dataset_name, loader.subset_prefix)
+            X_train, y_train = self.transform_train()
+            X_test, y_test = self.transform_test()
+            return {'X_train': X_train, 'y_train': y_train, 'X_test': X_test, 'y_test': y_test,
+                    'test_source_indices': self.test_source_indices}
+
+        if self.shared_key is None:
+            self.shared_key = self.get_shared_key()
+        arrays = self.shared_data.attach(self.shared_key, load_arrays)
+        self.source_indices = self.test_source_indices = arrays['test_source_indices']
+        return arrays['X_train'], arrays['y_train'], arrays['X_test'], arrays['y_test']
+
+    def release_shared(self):
+        """
+        Release the shared sets attached by `transform`. Views already returned stay valid.
+
+        :return: None
+        """
+        if self.shared_key is not None and self.shared_key in self.shared_data.attached:
+            self.shared_data.release(self.shared_key)
+
+    def get_shared_key(self):
+        """
+        Key of the transformed train and test sets, from their shards (without loading them) and the preprocessing.
+
+        :return: str
+        """
+        loaders = (self.train_spectra_loader, self.test_spectra_loader)
+        sources = [loader.get_cache_token() for loader in loaders] + \
+                  [f"{file}:{os.path.getmtime(file)}" for loader in loaders for file in loader.get_data_files()]
+        key = f"{'|'.join(sources)}|nc={self.num_channels}|ni={self.num_instances}|zoom={self.zoom_transform}|" \
+              f"timesteps={self.timestep_transform}"
+        return hashlib.md5(key.encode()).hexdigest()
+
     def test_generator(self, batch_size):
         """
         Get test generator
@@ -88,23 +216,169 @@ class SpectraPreprocessor:
         :param batch_size: size of batch
         :return: train generator
         """
-        return self._generator(loader=self.train_spectra_loader, transform_func=self.transform_train,
-                               batch_size=batch_size)
+        if self.sampler is not None:
+            return self._instrumented(self._sampled_generator(loader=self.train_spectra_loader,
+                                                       transform_func=self.transform_train, batch_size=batch_size))
+        return self._instrumented(self._generator(loader=self.train_spectra_loader, transform_func=self.transform_train,
+                                           batch_size=batch_size, augment=True))
+
+    def _instrumented(self, generator):
+        """
+        :param generator: generator of training batches
+        :return: the generator, sampled by `input_profiler` and timed by `input_timer` if they are set
+        """
+        if self.input_profiler is not None:
+            generator = self.input_profiler.wrap(generator)
+        if self.input_timer is not None:
+            generator = self.input_timer.wrap(generator)
+        return generator
+
+    def uses_flow(self):
+        """
+        :return: bool True if in-memory training data has to go through `flow` (sampling or augmentation, or shared
+                 data, which would be copied into every process if keras converted it at once)
+        """
+        return self.sampler is not None or (self.augmenter is not None and not self.augmenter.is_identity()) or \
+            self.shared_data is not None
 
-    def _generator(self, loader, transform_func, batch_size):
+    def flow(self, X, y, batch_size, initial_epoch=0):
+        """
+        Endless generator of training batches over in-memory arrays, drawing records with the sampler (or shuffling
+        them) and augmenting them. Every pass over the drawn records is one epoch.
+
+        :param X: np.array training spectra
+        :param y: np.array one-hot labels
+        :param batch_size: size of batch
+        :param initial_epoch: int epoch to start at, the batches of a resumed run are those it would have trained on
+        :return: generator of (X_batch, y_batch)
+        """
+        return self._instrumented(self._flow(X, y, batch_size, initial_epoch))
+
+    def _flow(self, X, y, batch_size, initial_epoch):
+        labels = y.argmax(axis=1) + 1
+        epoch = initial_epoch
+        while True:
+            if self.augmenter is not None:
+                self.augmenter.set_epoch(epoch)
+            if self.sampler is not None:
+                order = self.sampler.sample(labels, epoch)
+            else:
+                order = np.random.RandomState(epoch).permutation(len(X))
+            order = self._get_worker_share(order)
+
+            for start in range(0, len(order) - batch_size + 1, batch_size):
+                batch_idx = order[start:start + batch_size]
+                X_batch = X[batch_idx]
+                if self.augmenter is not None:
+                    X_batch = self.augmenter.augment(X_batch)
+                yield X_batch, y[batch_idx]
+            epoch += 1
+
+    def get_train_steps(self, batch_size, num_instances=None, y=None):
+        """
+        Number of batches in a training epoch.
+
+        :param batch_size: size of batch
+        :param num_instances: int number of training spectra when training from the generator
+        :param y: np.array one-hot labels when training from in-memory arrays
+        :return: int
+        """
+        if self.sampler is not None:
+            labels = self._get_index_labels(TRAIN_DATASET_PREFIX)[1] if y is None else y.argmax(axis=1) + 1
+            num_instances = self.sampler.get_num_samples(labels)
+        elif y is not None:
+            num_instances = len(y)
+        return num_instances // (batch_size * self.input_shard[1])
+
+    def _get_worker_share(self, items):
+        """
+        :param items: np.array or list of records or files drawn identically by all workers
+        :return: the disjoint share of this worker
+        """
+        index, count = self.input_shard
+        return items[index::count]
+
+    def _get_index_labels(self, subset_prefix):
+        """
+        Labels of the records of a subset, read from the dataset's label index instead of the spectra.
+
+        :param subset_prefix: str
+        :return: label index, labels of the used records and their global indices
+        """
+        label_index = get_label_index(self.dataset_name)
+        positions = label_index.get_subset_indices(subset_prefix)[:self.num_instances]
+        return label_index, label_index.labels[positions], positions
+
+    def _sampled_generator(self, loader, transform_func, batch_size):
+        """
+        Streams batches of the records drawn by the sampler. The records of an epoch are drawn from the label index,
+        then read shard by shard, so every shard is loaded at most once per epoch.
+
+        :param loader: SpectraLoader
+        :param transform_func: data transformation function
+        :param batch_size: size of batch to use
+        :return: generator of (X_batch, y_batch)
+        """
+        label_index, labels, positions = self._get_index_labels(loader.subset_prefix)
+        epoch = 0
+        spectra_x = None
+        spectra_y = None
+
+        while True:
+            if self.augmenter is not None:
+                self.augmenter.set_epoch(epoch)
+
+            sampled = self._get_worker_share(self.sampler.sample(labels, epoch))
+            shard_ids, offsets = label_index.locate(positions[sampled])
+            shard_order = np.random.RandomState([self.sampler.seed, epoch]).permutation(np.unique(shard_ids))
+            for shard_id in shard_order:
+                loader.load_spectra([label_index.get_file(shard_id)], del_old=True)
+                X, y = transform_func()
+
+                # Map offsets in the shard to rows of X, transforms may have dropped spectra
+                rows = np.full(label_index.shard_sizes[shard_id], -1)
+                rows[self.source_indices] = np.arange(len(self.source_indices))
+                selected = rows[offsets[shard_ids == shard_id]]
+                selected = selected[selected >= 0]
+
+                spectra_x = X[selected] if spectra_x is None else np.concatenate((spectra_x, X[selected]))
+                spectra_y = y[selected] if spectra_y is None else np.concatenate((spectra_y, y[selected]))
+
+                while len(spectra_x) >= batch_size:
+                    spectra_batch_x = spectra_x[:batch_size]
+                    spectra_batch_y = spectra_y[:batch_size]
+                    spectra_x = spectra_x[batch_size:]
+                    spectra_y = spectra_y[batch_size:]
+
+                    if self.augmenter is not None:
+                        spectra_batch_x = self.augmenter.augment(spectra_batch_x)
+
+                    yield spectra_batch_x, spectra_batch_y
+            epoch += 1
+
+    def _generator(self, loader, transform_func, batch_size, augment=False):
         """
         Loads sharded data from directory in chunks of batch size.
 
         :param loader: SpectraLoader
         :param transform_func: data transformation function
         :param batch_size: size of batch to use
+        :param augment: bool apply the augmenter (if any) to every batch, re-seeding it on each pass over the files
         :return:
         """
         cur_set_i = 0
+        epoch = 0
         files = loader.get_data_files()
+        # Workers of data-parallel training read their share of the files, or of the records if there are fewer files
+        shard_files = len(files) >= self.input_shard[1]
+        if shard_files:
+            files = self._get_worker_share(files)
         num_files = len(files)
         spectra_x = None
         spectra_y = None
+        augmenter = self.augmenter if augment else None
+        if augmenter is not None:
+            augmenter.set_epoch(epoch)
 
         while True:
             if cur_set_i >= num_files:
@@ -112,11 +386,16 @@ class SpectraPreprocessor:
                 random.shuffle(files)
 
                 print("Reached end of files, reshuffling...")
+                epoch += 1
+                if augmenter is not None:
+                    augmenter.set_epoch(epoch)
 
             loader.load_spectra([files[cur_set_i]], del_old=True)
             cur_set_i += 1
             #dat = self.transform_train(encoded=encoded)
             dat = transform_func()
+            if not shard_files:
+                dat = [self._get_worker_share(array) for array in dat]
 
             if spectra_x is None:
                 spectra_x = dat[0]
@@ -134,6 +413,9 @@ class SpectraPreprocessor:
                 spectra_x = spectra_x[batch_size:]
                 spectra_y = spectra_y[batch_size:]
 
+                if augmenter is not None:
+                    spectra_batch_x = augmenter.augment(spectra_batch_x)
+
                 yield spectra_batch_x, spectra_batch_y
 
     def get_num_test_instances(self):
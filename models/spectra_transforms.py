@@ -0,0 +1,620 @@
+from utils import *
+import hashlib
+import math
+import tempfile
+import time
+import numpy as np
+from scipy.signal import decimate
+
+
+TRANSFORM_CACHE_DIR = os.path.join(CACHE_DIR, "transforms")
+OUTSIDE_POLICIES = ('relabel', 'discard')  # spectra with peaks outside a narrowed window are relabelled or discarded
+
+
+def dm_to_model_input(dm):
+    """
+    Lay out spectra the way models are trained on them.
+
+    Note: this is a reshape, not a transpose, of the (num_instances, num_channels, num_timesteps) spectra. Existing
+    results were trained with this layout, so transforms below operate on `dm` before this is applied.
+
+    :param dm: np.array of shape (num_instances, num_channels, num_timesteps)
+    :return: np.array of shape (num_instances, num_timesteps, num_channels)
+    """
+    return dm.reshape(dm.shape[0], dm.shape[2], dm.shape[1])
+
+
+def model_input_to_dm(X):
+    """
+    Inverse of `dm_to_model_input`.
+
+    :param X: np.array of shape (num_instances, num_timesteps, num_channels)
+    :return: np.array of shape (num_instances, num_channels, num_timesteps)
+    """
+    return X.reshape(X.shape[0], X.shape[2], X.shape[1])
+
+
+def write_cache_file(cache_path, save_func, *args, **kwargs):
+    """
+    Write a cache file so that other processes never read it half-written: it is written to a temporary file in the
+    same directory and renamed in place.
+
+    :param cache_path: str path of the cache file
+    :param save_func: function writing to an open file, e.g. np.save or np.savez
+    :return: None
+    """
+    try_create_directory(os.path.dirname(cache_path), silent=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(cache_path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            save_func(f, *args, **kwargs)
+        os.replace(tmp_path, cache_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def read_cache_file(cache_path):
+    """
+    :param cache_path: str path of a cache file written by `write_cache_file`
+    :return: its np.load result, None if it does not exist. Reading a file marks it as used for `prune_cache`.
+    """
+    try:
+        cached = np.load(cache_path)
+        os.utime(cache_path)
+    except FileNotFoundError:
+        return None
+    return cached
+
+
+def prune_cache(max_age_days=0.0):
+    """
+    Delete the cached transformed arrays that were not used in the last `max_age_days`. Every transform, dataset and
+    number of spectra or channels adds its own arrays, so the cache grows until it is pruned.
+
+    :param max_age_days: float
+    :return: (int number of files deleted, int bytes freed)
+    """
+    if not os.path.isdir(TRANSFORM_CACHE_DIR):
+        return 0, 0
+    oldest = time.time() - max_age_days * 24 * 3600
+    num_files, num_bytes = 0, 0
+    for name in os.listdir(TRANSFORM_CACHE_DIR):
+        path = os.path.join(TRANSFORM_CACHE_DIR, name)
+        try:
+            stat = os.stat(path)
+            if stat.st_mtime <= oldest:
+                os.remove(path)
+                num_files += 1
+                num_bytes += stat.st_size
+        except FileNotFoundError:
+            # Pruned or replaced by another process
+            pass
+    return num_files, num_bytes
+
+
+def normalize_channels(dm):
+    """
+    Min-max normalize every channel to [0, 1], as the MATLAB scripts do for the spectral window.
+
+    :param dm: np.array of shape (num_instances, num_channels, num_timesteps)
+    :return: normalized np.array
+    """
+    dm_min = dm.min(axis=2, keepdims=True)
+    dm_range = dm.max(axis=2, keepdims=True) - dm_min
+    return (dm - dm_min) / np.where(dm_range == 0, 1, dm_range)
+
+
+class TimestepTransform:
+    """
+    Preprocessing stage that shortens the timestep axis of spectra before they are fed to a model.
+
+    Recurrent layers scale linearly with the number of timesteps, so reducing the resolution of the window trades
+    a little accuracy for much faster training and inference.
+
+    Modes:
+        decimate: low-pass (anti-aliasing) FIR filter followed by keeping every `factor`-th timestep.
+        pool: average `factor` consecutive timesteps (the boxcar average acts as the anti-aliasing filter).
+        crop: keep the central `num_timesteps // factor` timesteps of the window. Peaks lying in the cropped
+              margins are handled like the peaks outside a zoomed window (see `ZoomTransform`): the spectrum is
+              relabelled (`outside='relabel'`) or discarded (`outside='discard'`). Cropping needs one of them to
+              transform training or test sets.
+    """
+    MODES = ('decimate', 'pool', 'crop')
+
+    def __init__(self, mode='decimate', factor=1, outside=None):
+        """
+        :param mode: str One of `TimestepTransform.MODES`.
+        :param factor: int Factor by which the number of timesteps is reduced.
+        :param outside: str One of `OUTSIDE_POLICIES`, what to do with the spectra that have peaks in the margins
+                        removed by 'crop'. Unused by the other modes.
+        """
+        if mode not in TimestepTransform.MODES:
+            raise ValueError(f"Unknown timestep mode '{mode}', expected one of {TimestepTransform.MODES}")
+        if int(factor) < 1:
+            raise ValueError(f"Timestep factor must be at least 1, got {factor}")
+        if outside is not None and outside not in OUTSIDE_POLICIES:
+            raise ValueError(f"Unknown policy '{outside}', expected one of {OUTSIDE_POLICIES}")
+
+        self.mode = mode
+        self.factor = int(factor)
+        self.outside = outside if mode == 'crop' else None
+
+    def __repr__(self):
+        if self.outside is not None:
+            return f"{self.mode}x{self.factor}-{self.outside}"
+        return f"{self.mode}x{self.factor}"
+
+    def changes_labels(self):
+        """
+        :return: bool True if the transform drops peaks, so the labels of the spectra must be transformed too
+                 (see `transform_labelled`).
+        """
+        return self.mode == 'crop' and self.factor > 1
+
+    def get_num_timesteps(self, num_timesteps):
+        """
+        Number of timesteps remaining after the transformation.
+
+        :param num_timesteps: int Number of timesteps in the original spectra.
+        :return: int
+        """
+        num_timesteps = int(num_timesteps)
+        if self.factor == 1:
+            return num_timesteps
+        if self.mode == 'decimate':
+            return int(math.ceil(num_timesteps / self.factor))
+        return num_timesteps // self.factor
+
+    def transform(self, dm):
+        """
+        Apply the transformation to a batch of spectra.
+
+        :param dm: np.array of shape (num_instances, num_channels, num_timesteps)
+        :return: np.array of shape (num_instances, num_channels, get_num_timesteps(num_timesteps))
+        """
+        if self.factor == 1:
+            return dm
+
+        num_timesteps = dm.shape[2]
+        if self.mode == 'decimate':
+            return decimate(dm, self.factor, ftype='fir', axis=2, zero_phase=True).astype(dm.dtype)
+        elif self.mode == 'pool':
+            new_timesteps = num_timesteps // self.factor
+            dm_pool = dm[:, :, :new_timesteps * self.factor]
+            return dm_pool.reshape(dm.shape[0], dm.shape[1], new_timesteps, self.factor).mean(axis=3)
+        else:
+            new_timesteps = num_timesteps // self.factor
+            start = (num_timesteps - new_timesteps) // 2
+            return dm[:, :, start:start + new_timesteps]
+
+    def get_window(self, num_timesteps):
+        """
+        :param num_timesteps: int Number of timesteps in the original spectra.
+        :return: (start, end) of the cropped window, relative to the original window
+        """
+        new_timesteps = self.get_num_timesteps(num_timesteps)
+        start = (num_timesteps - new_timesteps) // 2
+        return start / (num_timesteps - 1), (start + new_timesteps - 1) / (num_timesteps - 1)
+
+    def transform_labelled(self, dm, peak_locations, n):
+        """
+        Apply the transformation to spectra and their labels. Cropped spectra with peaks in the cropped margins are
+        relabelled or discarded according to `outside`.
+
+        :param dm: np.array of shape (num_instances, num_channels, num_timesteps)
+        :param peak_locations: np.array of shape (num_instances, max_num_peaks) padded with nan, see
+                               `pad_peak_locations`
+        :param n: np.array of shape (num_instances,) number of peaks of every spectrum
+        :return: transformed dm, number of peaks, peak locations relative to the new window (nan padded) and the
+                 boolean mask of the spectra that were kept
+        """
+        if not self.changes_labels():
+            return self.transform(dm), np.asarray(n), peak_locations, np.ones(len(dm), dtype=bool)
+        if self.outside is None:
+            raise ValueError(f"Cropping removes the peaks in the margins of the window: choose whether spectra with "
+                             f"such peaks are relabelled or discarded (outside one of {OUTSIDE_POLICIES})")
+
+        remapped = remap_peaks(peak_locations, *self.get_window(dm.shape[2]))
+        n, keep = select_inside(peak_locations, remapped, n, self.outside)
+        return self.transform(dm[keep]), n, remapped[keep], keep
+
+    def transform_cached(self, dm, cache_key):
+        """
+        Apply the transformation, reusing a previously cached result when one exists.
+
+        :param dm: np.array of shape (num_instances, num_channels, num_timesteps)
+        :param cache_key: str Identifies the source of dm (e.g. dataset shards and subset sizes). If None, the
+                          transformation is not cached.
+        :return: transformed np.array
+        """
+        if cache_key is None or self.factor == 1:
+            return self.transform(dm)
+
+        cache_path = self.get_cache_path(cache_key)
+        cached = read_cache_file(cache_path)
+        if cached is not None:
+            return cached
+
+        dm_transformed = self.transform(dm)
+        write_cache_file(cache_path, np.save, dm_transformed)
+        return dm_transformed
+
+    def get_cache_path(self, cache_key):
+        """
+        :param cache_key: str Identifies the source data.
+        :return: str Path of the cached array for this transformation.
+        """
+        digest = hashlib.md5(f"{cache_key}|{self}".encode()).hexdigest()
+        return os.path.join(TRANSFORM_CACHE_DIR, f"timesteps-{self}-{digest}.npy")
+
+    def serialize(self):
+        """
+        :return: dict that can be passed to `TimestepTransform.from_config`.
+        """
+        return {'mode': self.mode, 'factor': self.factor, 'outside': self.outside}
+
+    @staticmethod
+    def from_config(config):
+        """
+        :param config: dict produced by `serialize`, or None.
+        :return: TimestepTransform or None
+        """
+        if not config:
+            return None
+        return TimestepTransform(**config)
+
+
+class SpectraAugmenter:
+    """
+    Train-time augmentation applied to batches of spectra, so one clean dataset can stand in for datasets regenerated
+    with different noise levels.
+
+    Noise is parameterized like the generator: `D + epsilon2 * max(D) * rand` per channel, optionally followed by the
+    same min-max normalization the MATLAB scripts apply. Channels can be permuted and spectra shifted (circularly, so
+    no peak leaves the window) along the timestep axis. The random state is re-seeded at the start of every epoch
+    from `(seed, epoch)`, so runs are reproducible.
+
+    Batches are taken in model input layout and augmented in `dm` layout (see `dm_to_model_input`).
+    """
+
+    def __init__(self, epsilon2=0.0, permute_channels=False, max_shift=0, normalize=True, seed=42):
+        """
+        :param epsilon2: float Scales white noise: `D + epsilon2 * max(D) * rand`. Use 0 for no noise.
+        :param permute_channels: bool If True, channels of every spectrum are randomly permuted.
+        :param max_shift: int Maximum number of timesteps a spectrum is shifted by (in either direction).
+        :param normalize: bool If True, rescale every channel to [0, 1] after adding noise, as the generator does.
+        :param seed: int Base seed, combined with the epoch number.
+        """
+        self.epsilon2 = float(epsilon2)
+        self.permute_channels = permute_channels
+        self.max_shift = int(max_shift)
+        self.normalize = normalize
+        self.seed = int(seed)
+        self.epoch = 0
+        self.random_state = None
+        self.set_epoch(0)
+
+    def __repr__(self):
+        return f"eps{self.epsilon2}-perm{int(self.permute_channels)}-shift{self.max_shift}-seed{self.seed}"
+
+    def is_identity(self):
+        """
+        :return: bool True if the augmenter leaves spectra unchanged.
+        """
+        return self.epsilon2 == 0 and not self.permute_channels and self.max_shift == 0
+
+    def set_epoch(self, epoch):
+        """
+        Re-seed the random state for an epoch.
+
+        :param epoch: int
+        :return: None
+        """
+        self.epoch = int(epoch)
+        self.random_state = np.random.RandomState([self.seed, self.epoch])
+
+    def add_noise(self, dm):
+        """
+        :param dm: np.array of shape (batch_size, num_channels, num_timesteps)
+        :return: np.array with white noise added to every channel
+        """
+        noise = self.random_state.rand(*dm.shape) * (self.epsilon2 * dm.max(axis=2, keepdims=True))
+        dm = dm + noise
+        if self.normalize:
+            dm = normalize_channels(dm)
+        return dm
+
+    def permute(self, dm):
+        """
+        :param dm: np.array of shape (batch_size, num_channels, num_timesteps)
+        :return: np.array with the channels of every spectrum independently permuted
+        """
+        order = self.random_state.rand(dm.shape[0], dm.shape[1]).argsort(axis=1)
+        return np.take_along_axis(dm, order[:, :, np.newaxis], axis=1)
+
+    def shift(self, dm):
+        """
+        :param dm: np.array of shape (batch_size, num_channels, num_timesteps)
+        :return: np.array with every spectrum circularly shifted along the timestep axis
+        """
+        num_timesteps = dm.shape[2]
+        shifts = self.random_state.randint(-self.max_shift, self.max_shift + 1, size=dm.shape[0])
+        indices = (np.arange(num_timesteps)[np.newaxis, :] - shifts[:, np.newaxis]) % num_timesteps
+        return np.take_along_axis(dm, indices[:, np.newaxis, :], axis=2)
+
+    def augment(self, X):
+        """
+        Augment a batch of spectra.
+
+        :param X: np.array of shape (batch_size, num_timesteps, num_channels), as produced by SpectraPreprocessor
+        :return: augmented np.array of the same shape
+        """
+        dm = model_input_to_dm(X)
+        if self.epsilon2 > 0:
+            dm = self.add_noise(dm)
+        if self.permute_channels:
+            dm = self.permute(dm)
+        if self.max_shift > 0:
+            dm = self.shift(dm)
+        return dm_to_model_input(dm)
+
+    def serialize(self):
+        """
+        :return: dict that can be passed to `SpectraAugmenter.from_config`.
+        """
+        return {'epsilon2': self.epsilon2, 'permute_channels': self.permute_channels, 'max_shift': self.max_shift,
+                'normalize': self.normalize, 'seed': self.seed}
+
+    @staticmethod
+    def from_config(config):
+        """
+        :param config: dict produced by `serialize`, or None.
+        :return: SpectraAugmenter or None
+        """
+        if not config:
+            return None
+        return SpectraAugmenter(**config)
+
+
+def pad_peak_locations(peak_locations):
+    """
+    Stack per-spectrum peak locations into a single array.
+
+    :param peak_locations: list of peak locations as stored in spectra (a float, a list or a nested list per spectrum)
+    :return: np.array of shape (num_instances, max_num_peaks), padded with nan
+    """
+    peaks = [np.ravel(np.asarray(p, dtype=float)) for p in peak_locations]
+    max_num_peaks = max([len(p) for p in peaks] + [1])
+    padded = np.full((len(peaks), max_num_peaks), np.nan)
+    for i, p in enumerate(peaks):
+        padded[i, :len(p)] = p
+    return padded
+
+
+def remap_peaks(peak_locations, start, end):
+    """
+    :param peak_locations: np.array of shape (num_instances, max_num_peaks) padded with nan, relative to the window
+    :param start: float start of a narrower window, relative to the window
+    :param end: float end of the narrower window
+    :return: np.array of the same shape with locations relative to the narrower window, sorted with the peaks outside
+             it set to nan (last)
+    """
+    remapped = (peak_locations - start) / (end - start)
+    with np.errstate(invalid='ignore'):
+        outside = (remapped < 0) | (remapped > 1)
+    remapped[outside] = np.nan
+    return np.sort(remapped, axis=1)
+
+
+def select_inside(peak_locations, remapped, n, outside):
+    """
+    Apply an outside policy to spectra whose window was narrowed: peaks outside the new window are dropped and the
+    spectrum relabelled with the number of peaks left ('relabel', spectra left with no peaks are removed), or the
+    spectrum is removed ('discard').
+
+    :param peak_locations: np.array of shape (num_instances, max_num_peaks) padded with nan
+    :param remapped: np.array of the same shape from `remap_peaks`
+    :param n: np.array of shape (num_instances,) number of peaks of every spectrum
+    :param outside: str One of OUTSIDE_POLICIES.
+    :return: number of peaks of the kept spectra and the boolean mask of the kept spectra
+    """
+    n_inside = np.sum(~np.isnan(remapped), axis=1)
+    if outside == 'relabel':
+        keep = n_inside > 0
+        n = n_inside
+    else:
+        keep = n_inside == np.sum(~np.isnan(peak_locations), axis=1)
+    return np.asarray(n)[keep], keep
+
+
+class ZoomTransform:
+    """
+    Emulates generating a dataset with a different `gamma_amp_factor` by zooming into the spectral window.
+
+    In `spectra_generator_v2.m` the window always spans `scale` in frequency while peak widths scale with
+    `1 / gammaAmpFactor`, and the number of timesteps grows with `gammaAmpFactor` so a peak covers a similar number of
+    timesteps. Lowering the factor from `source_gamma_amp_factor` to `gamma_amp_factor` is therefore the same as
+    keeping the central `gamma_amp_factor / source_gamma_amp_factor` of the window and resampling it to the number
+    of timesteps the generator would produce. Raising the factor would need data outside the window, so it is not
+    supported.
+
+    Peaks outside the new window are either dropped and the spectrum relabelled with the number of peaks left
+    (`outside='relabel'`, spectra left with no peaks are removed), or the spectrum is removed (`outside='discard'`).
+    Unlike direct generation, tails of peaks outside the window remain visible near its edges.
+    """
+    OUTSIDE_POLICIES = OUTSIDE_POLICIES
+
+    def __init__(self, gamma_amp_factor, source_gamma_amp_factor, dg, scale=1.0, num_timesteps=None,
+                 outside='relabel'):
+        """
+        :param gamma_amp_factor: float Target effective gamma amp factor.
+        :param source_gamma_amp_factor: float Gamma amp factor the dataset was generated with.
+        :param dg: float Variation in gamma for liquid modes used to generate the dataset.
+        :param scale: float The scale of the spectrum data.
+        :param num_timesteps: int (optional) Number of timesteps to resample to. Defaults to what
+                              `spectra_generator_v2.m` would produce for `gamma_amp_factor`.
+        :param outside: str One of `ZoomTransform.OUTSIDE_POLICIES`.
+        """
+        if gamma_amp_factor > source_gamma_amp_factor:
+            raise ValueError(f"Cannot zoom from gamma_amp_factor={source_gamma_amp_factor} to {gamma_amp_factor}: "
+                             f"only lower factors can be emulated from an existing window.")
+        if outside not in ZoomTransform.OUTSIDE_POLICIES:
+            raise ValueError(f"Unknown policy '{outside}', expected one of {ZoomTransform.OUTSIDE_POLICIES}")
+
+        self.gamma_amp_factor = float(gamma_amp_factor)
+        self.source_gamma_amp_factor = float(source_gamma_amp_factor)
+        self.dg = float(dg)
+        self.scale = float(scale)
+        self.num_timesteps = num_timesteps
+        self.outside = outside
+        self.zoom = self.gamma_amp_factor / self.source_gamma_amp_factor
+
+    def __repr__(self):
+        return f"zoom{self.source_gamma_amp_factor}to{self.gamma_amp_factor}-{self.outside}"
+
+    @staticmethod
+    def get_generated_num_timesteps(gamma_amp_factor, dg, scale=1.0):
+        """
+        Number of timesteps `spectra_generator_v2.m` produces: `length(range)` with
+        `omega_res = floor(1/(GammaAmp*(1-dG*0.5)))*50*(2*omegaShift+1)`.
+
+        :param gamma_amp_factor: float
+        :param dg: float
+        :param scale: float
+        :return: int
+        """
+        gamma_amp = scale / (1 + 0.5 * dg) / gamma_amp_factor
+        return int(math.floor(1 / (gamma_amp * (1 - dg * 0.5)))) * 50 + 1
+
+    @staticmethod
+    def from_dataset_config(dataset_config, gamma_amp_factor, outside='relabel'):
+        """
+        Create a zoom transform for a dataset.
+
+        :param dataset_config: dict Dataset config (gen_info.json).
+        :param gamma_amp_factor: float Target effective gamma amp factor.
+        :param outside: str One of `ZoomTransform.OUTSIDE_POLICIES`.
+        :return: ZoomTransform
+        """
+        if dataset_config.get('gamma_amp_factor') is None:
+            raise ValueError("The dataset config does not record the gamma_amp_factor it was generated with.")
+
+        num_timesteps = None
+        if dataset_config.get('matlab_script') != 'spectra_generator_v2.m':
+            num_timesteps = int(dataset_config['num_timesteps'])
+        return ZoomTransform(gamma_amp_factor, dataset_config['gamma_amp_factor'], dataset_config['dg'],
+                             scale=dataset_config['scale'], num_timesteps=num_timesteps, outside=outside)
+
+    def get_num_timesteps(self, num_timesteps=None):
+        """
+        :param num_timesteps: int Number of timesteps in the source spectra (unused unless no target is known).
+        :return: int Number of timesteps after zooming.
+        """
+        if self.num_timesteps is not None:
+            return int(self.num_timesteps)
+        return ZoomTransform.get_generated_num_timesteps(self.gamma_amp_factor, self.dg, self.scale)
+
+    def get_window(self):
+        """
+        :return: (start, end) of the zoomed window, relative to the source window.
+        """
+        start = (1 - self.zoom) / 2
+        return start, start + self.zoom
+
+    def resample(self, dm):
+        """
+        Crop and linearly resample every channel to the zoomed window, then renormalize it.
+
+        :param dm: np.array of shape (num_instances, num_channels, num_timesteps)
+        :return: np.array of shape (num_instances, num_channels, get_num_timesteps())
+        """
+        num_timesteps = dm.shape[2]
+        start, end = self.get_window()
+        positions = np.linspace(start, end, self.get_num_timesteps(num_timesteps)) * (num_timesteps - 1)
+        lower = np.clip(np.floor(positions).astype(int), 0, num_timesteps - 2)
+        weights = positions - lower
+        resampled = dm[:, :, lower] * (1 - weights) + dm[:, :, lower + 1] * weights
+        return normalize_channels(resampled)
+
+    def remap_peaks(self, peak_locations):
+        """
+        :param peak_locations: np.array of shape (num_instances, max_num_peaks) padded with nan
+        :return: np.array of the same shape with locations relative to the zoomed window, sorted with the peaks
+                 outside the window set to nan (last)
+        """
+        return remap_peaks(peak_locations, *self.get_window())
+
+    def transform(self, dm, peak_locations, n):
+        """
+        Zoom a set of spectra.
+
+        :param dm: np.array of shape (num_instances, num_channels, num_timesteps)
+        :param peak_locations: list of peak locations, as returned by `SpectraLoader.get_peak_locations`
+        :param n: np.array of shape (num_instances,) number of peaks of every spectrum
+        :return: zoomed dm, number of peaks, remapped peak locations (nan padded) and the boolean mask of the
+                 source spectra that were kept
+        """
+        peaks = pad_peak_locations(peak_locations)[:len(dm)]
+        remapped = self.remap_peaks(peaks)
+        n, keep = select_inside(peaks, remapped, n, self.outside)
+        return self.resample(dm[keep]), n, remapped[keep], keep
+
+    def transform_cached(self, dm, peak_locations, n, cache_key):
+        """
+        Zoom a set of spectra, reusing a previously cached result when one exists.
+
+        :param dm: np.array of shape (num_instances, num_channels, num_timesteps)
+        :param peak_locations: list of peak locations
+        :param n: np.array of shape (num_instances,)
+        :param cache_key: str Identifies the source data. If None, the result is not cached.
+        :return: see `transform`
+        """
+        if cache_key is None:
+            return self.transform(dm, peak_locations, n)
+
+        digest = hashlib.md5(f"{cache_key}|{self}|{self.get_num_timesteps()}".encode()).hexdigest()
+        cache_path = os.path.join(TRANSFORM_CACHE_DIR, f"{self}-{digest}.npz")
+        cached = read_cache_file(cache_path)
+        if cached is not None:
+            return cached['dm'], cached['n'], cached['peak_locations'], cached['keep']
+
+        dm, n, peaks, keep = self.transform(dm, peak_locations, n)
+        write_cache_file(cache_path, np.savez, dm=dm, n=n, peak_locations=peaks, keep=keep)
+        return dm, n, peaks, keep
+
+    def serialize(self):
+        """
+        :return: dict that can be passed to `ZoomTransform.from_config`.
+        """
+        return {'gamma_amp_factor': self.gamma_amp_factor, 'source_gamma_amp_factor': self.source_gamma_amp_factor,
+                'dg': self.dg, 'scale': self.scale, 'num_timesteps': self.num_timesteps, 'outside': self.outside}
+
+    @staticmethod
+    def from_config(config):
+        """
+        :param config: dict produced by `serialize`, or None.
+        :return: ZoomTransform or None
+        """
+        if not config:
+            return None
+        return ZoomTransform(**config)
+
+
+def get_peak_width_profile(dm, threshold=0.5):
+    """
+    Summarize how wide features are relative to the window: for every channel, the number of timesteps after which
+    its autocorrelation drops below `threshold`. Used to check zoomed datasets against directly generated ones.
+
+    :param dm: np.array of shape (num_instances, num_channels, num_timesteps)
+    :param threshold: float
+    :return: np.array of shape (num_instances * num_channels,), widths as a fraction of the window
+    """
+    centered = dm - dm.mean(axis=2, keepdims=True)
+    num_timesteps = dm.shape[2]
+    spectrum = np.fft.rfft(centered, n=2 * num_timesteps, axis=2)
+    autocorr = np.fft.irfft(spectrum * np.conj(spectrum), axis=2)[:, :, :num_timesteps]
+    autocorr = autocorr / np.where(autocorr[:, :, :1] == 0, 1, autocorr[:, :, :1])
+    below = autocorr < threshold
+    widths = np.where(below.any(axis=2), below.argmax(axis=2), num_timesteps)
+    return widths.ravel() / num_timesteps
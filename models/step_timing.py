@@ -0,0 +1,145 @@
+from utils import *
+from tensorflow.keras.callbacks import Callback
+import collections
+import time
+import numpy as np
+
+
+"""
+Step-time instrumentation of training runs, telling input-bound runs (shard decoding, transforms and augmentation in
+the SpectraPreprocessor generators) from compute-bound ones.
+
+Keras prefetches the batches of the training generators in a background thread, so producing a batch overlaps with the
+train steps. The InputTimer hooked into the generators records when every batch was ready and how long it took to
+produce; steps consume batches in order, so a step waited for its batch from the start of the step until the batch was
+ready. The rest of the step is compute. In-memory arrays are sliced by keras within the train step, their input wait is
+not measured.
+"""
+
+
+class InputTimer:
+    """Records when the batches of a training generator were ready and how long they took to produce."""
+
+    def __init__(self):
+        self.batches = collections.deque()  # (ready time, seconds producing, number of samples), in order
+
+    def wrap(self, generator):
+        """
+        :param generator: generator of (X_batch, y_batch)
+        :return: generator of the same batches, timed
+        """
+        while True:
+            start = time.perf_counter()
+            try:
+                batch = next(generator)
+            except StopIteration:
+                return
+            end = time.perf_counter()
+            self.batches.append((end, end - start, len(batch[1])))
+            yield batch
+
+    def pop(self):
+        """
+        :return: (ready time, seconds producing, number of samples) of the oldest batch not yet consumed, None if the
+                 generator was not used
+        """
+        return self.batches.popleft() if self.batches else None
+
+
+class StepTimer(Callback):
+    """
+    Times the train steps and the validation of every epoch and appends a summary of the epoch to the
+    `step_timing` of the model, saved in info.json. The first epoch includes the tracing of the train step.
+    """
+
+    def __init__(self, model, batch_size, experiment=None):
+        """
+        :param model: BaseModel being trained
+        :param batch_size: int batch size of this worker, counts the samples of steps the InputTimer did not see
+        :param experiment: optional comet_ml Experiment the summaries are logged to
+        """
+        super(StepTimer, self).__init__()
+        self.base_model = model
+        self.batch_size = batch_size
+        self.experiment = experiment
+        self.input_timer = InputTimer()
+        self.step_start = None
+        self.test_start = None
+        self.epoch_start = None
+        self.steps = []
+        self.waits = []
+        self.input_seconds = 0.0
+        self.num_samples = 0
+        self.validation_seconds = 0.0
+        self.summaries = []
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.epoch_start = time.perf_counter()
+        self.steps = []
+        self.waits = []
+        self.input_seconds = 0.0
+        self.num_samples = 0
+        self.validation_seconds = 0.0
+
+    def on_train_batch_begin(self, batch, logs=None):
+        self.step_start = time.perf_counter()
+
+    def on_train_batch_end(self, batch, logs=None):
+        step_end = time.perf_counter()
+        self.steps.append(step_end - self.step_start)
+        timed_batch = self.input_timer.pop()
+        if timed_batch is None:
+            self.num_samples += self.batch_size
+            return
+        ready, seconds, num_samples = timed_batch
+        self.waits.append(min(max(ready - self.step_start, 0.0), step_end - self.step_start))
+        self.input_seconds += seconds
+        self.num_samples += num_samples
+
+    def on_test_begin(self, logs=None):
+        self.test_start = time.perf_counter()
+
+    def on_test_end(self, logs=None):
+        self.validation_seconds += time.perf_counter() - self.test_start
+
+    def on_epoch_end(self, epoch, logs=None):
+        summary = self.summarize(epoch + 1, time.perf_counter() - self.epoch_start)
+        self.base_model.step_timing = (self.base_model.step_timing or []) + [summary]
+        if self.experiment is not None:
+            self.experiment.log_metrics({f"time_{key}": value for key, value in summary.items()
+                                         if key != 'epoch' and value is not None}, epoch=epoch + 1)
+        self.summaries.append(summary)
+
+    def on_train_end(self, logs=None):
+        # Printed once training ends, the progress bar of keras is still writing during the epoch
+        for summary in self.summaries:
+            wait = "not measured" if summary['input_wait_fraction'] is None else \
+                f"{100 * summary['input_wait_fraction']:.0f}% ({summary['input_wait_seconds']:.1f} s)"
+            print(f"Epoch {summary['epoch']} timing: {summary['seconds']:.1f} s, {summary['steps']} steps of "
+                  f"{summary['step_ms']:.0f} ms (p95 {summary['step_p95_ms']:.0f} ms), input wait {wait}, "
+                  f"{summary['samples_per_second']:.0f} samples/s, validation {summary['validation_seconds']:.1f} s")
+        self.summaries = []
+
+    def summarize(self, epoch, seconds):
+        """
+        :param epoch: int epoch of the run, from 1
+        :param seconds: float duration of the epoch
+        :return: dict summary of the epoch, times in seconds unless suffixed with _ms. Input times are None when the
+                 batches did not come from a generator.
+        """
+        steps = np.array(self.steps) if self.steps else np.zeros(1)
+        step_seconds = float(np.sum(steps))
+        timed = len(self.waits) > 0
+        input_wait = float(np.sum(self.waits)) if timed else None
+        return {'epoch': epoch,
+                'seconds': round(seconds, 3),
+                'steps': len(self.steps),
+                'step_ms': round(1000 * float(np.mean(steps)), 2),
+                'step_p50_ms': round(1000 * float(np.percentile(steps, 50)), 2),
+                'step_p95_ms': round(1000 * float(np.percentile(steps, 95)), 2),
+                'input_wait_seconds': round(input_wait, 3) if timed else None,
+                'input_wait_fraction': round(input_wait / max(step_seconds, 1e-9), 4) if timed else None,
+                'compute_seconds': round(step_seconds - (input_wait or 0.0), 3),
+                'input_seconds': round(self.input_seconds, 3) if timed else None,
+                'samples_per_second': round(self.num_samples / max(seconds - self.validation_seconds, 1e-9), 1),
+                'validation_seconds': round(self.validation_seconds, 3)}
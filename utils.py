@@ -13,6 +13,7 @@ NETWORKS_DIR = os.path.join(MODELS_DIR, "networks")
 DATA_ROOT = os.path.join(PROJECT_ROOT, "data")
 DATA_DIR = os.path.join(DATA_ROOT, "datasets")
 MODEL_RES_DIR = os.path.join(DATA_ROOT, "results")
+CACHE_DIR = os.path.join(DATA_ROOT, "cache")
 
 TRAIN_DATASET_PREFIX = "train"
 TEST_DATASET_PREFIX = "test"
@@ -102,3 +103,4 @@ def get_classes(module, package_name):
 try_create_directory(DATA_ROOT, silent=True)
 try_create_directory(DATA_DIR, silent=True)
 try_create_directory(MODEL_RES_DIR, silent=True)
+try_create_directory(CACHE_DIR, silent=True)